@@ -1,13 +1,42 @@
+import time
+_inicio_importacao = time.perf_counter() # cold start do worker (ver WorkerStartup)
 import os
+import atexit
+import bisect
+import contextlib
+import cProfile
+import pstats
+import random
 import zipfile
+import hashlib
+import mimetypes
+import tempfile
 import json
+import subprocess
+import sys
+import platform
+import shutil
+import tracemalloc
+import gzip
+import csv
+import io
 import requests
+import click
 import threading
-from urllib.parse import quote_plus
-from flask import Flask, render_template, request, jsonify, send_from_directory
+import math
+import re
+import unicodedata
+from urllib.parse import quote, quote_plus
+from flask import Flask, Response, g, has_request_context, render_template, request, jsonify, send_file
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime, timedelta
-from werkzeug.utils import secure_filename
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.exc import IntegrityError
+import sqlalchemy.dialects.postgresql # registra to_tsvector/to_tsquery (busca), não exige o driver
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from werkzeug.utils import safe_join, secure_filename
+from xml.sax.saxutils import escape as xml_escape
 
 # --- Configuração ---
 
@@ -22,6 +51,47 @@ if DATABASE_URL:
 
 app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL or 'sqlite:///workflow.db'
 
+# (NOVO) Engine e pool de conexões, ajustáveis por variáveis de ambiente.
+# Por worker do gunicorn: até DB_POOL_SIZE + DB_MAX_OVERFLOW conexões ao mesmo tempo
+# (threads de requisição + dispatcher de notificações + observador do SSE).
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', '10'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10')) # espera máxima por uma conexão livre (s)
+# O Render derruba conexões ociosas: recicla antes disso e testa (pre-ping) ao retirar do pool
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', '280'))
+DB_CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', '5'))
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', '30000'))
+DB_IDLE_IN_TRANSACTION_TIMEOUT_MS = int(os.environ.get('DB_IDLE_IN_TRANSACTION_TIMEOUT_MS', '60000'))
+# SQLite (local): espera o lock em vez de falhar na hora com "database is locked"
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+
+def build_engine_options(uri):
+    """Opções do create_engine com padrões por banco (Postgres no Render, SQLite local)."""
+    if uri.startswith('sqlite'):
+        return {
+            "connect_args": {
+                "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000,
+                "check_same_thread": False, # conexões passam entre as threads do gunicorn pelo pool
+            },
+        }
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": True,
+        "pool_use_lifo": True, # reaproveita as conexões quentes; as ociosas expiram pelo recycle
+        "connect_args": {
+            "connect_timeout": DB_CONNECT_TIMEOUT,
+            "options": (
+                f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS} "
+                f"-c idle_in_transaction_session_timeout={DB_IDLE_IN_TRANSACTION_TIMEOUT_MS}"
+            ),
+        },
+    }
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = build_engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+
 # 2. Configuração de Uploads (Render Disks)
 # A variável RENDER_DISK_MOUNT_PATH será definida como '/var/data' no Render.
 # Localmente, usará a pasta 'instance/persistent_uploads' para testes.
@@ -31,20 +101,401 @@ app.config['UPLOAD_FOLDER'] = os.path.join(UPLOAD_DIR, 'persistent_uploads')
 
 db = SQLAlchemy(app)
 
-# (NOVO) Garantir que a pasta de upload exista ANTES da primeira requisição
+def configure_sqlite(dbapi_connection, connection_record):
+    # WAL: leituras não bloqueiam a escrita (e vice-versa); NORMAL é seguro com WAL e bem mais rápido
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.close()
+
+# Métricas do pool (ver /api/db/pool): totais desde o início do worker
+_pool_metricas = {"conexoes_abertas": 0, "checkouts": 0, "invalidadas": 0}
+_pool_metricas_lock = threading.Lock()
+
+def _contar_pool(chave):
+    def ouvinte(*args):
+        with _pool_metricas_lock:
+            _pool_metricas[chave] += 1
+    return ouvinte
+
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        event.listen(db.engine, 'connect', configure_sqlite)
+    event.listen(db.engine.pool, 'connect', _contar_pool("conexoes_abertas"))
+    event.listen(db.engine.pool, 'checkout', _contar_pool("checkouts"))
+    event.listen(db.engine.pool, 'invalidate', _contar_pool("invalidadas"))
+
+def db_pool_stats():
+    """Estado atual do pool deste worker (em uso, livres, overflow) e os totais acumulados."""
+    pool = db.engine.pool
+    with _pool_metricas_lock:
+        stats = dict(_pool_metricas)
+    # StaticPool/SingletonThreadPool (SQLite em memória) não têm estes contadores
+    for nome, metodo in (("tamanho", "size"), ("em_uso", "checkedout"), ("livres", "checkedin"), ("overflow", "overflow")):
+        if hasattr(pool, metodo):
+            stats[nome] = getattr(pool, metodo)()
+    if "overflow" in stats:
+        stats["overflow"] = max(stats["overflow"], 0) # o QueuePool conta negativo enquanto não enche
+    stats["max_overflow"] = getattr(pool, "_max_overflow", None)
+    stats["pool"] = type(pool).__name__
+    return stats
+
+# --- Métricas e Profiling (NOVO) ---
+
+# Cada worker do gunicorn acumula as métricas em memória e grava um retrato (JSON) em
+# METRICS_DIR a cada METRICS_FLUSH_INTERVAL segundos. O /metrics, em qualquer worker, soma
+# os retratos de todos os workers do mesmo master (arquivos '<pid do master>-<pid>.json').
+METRICS_DIR = os.environ.get('METRICS_DIR') or os.path.join(tempfile.gettempdir(), 'workflow-metrics')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+# Com METRICS_TOKEN definido, o /metrics exige 'Authorization: Bearer <token>'
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# Retratos deixados por execuções anteriores (outro master) são apagados depois disso (s)
+METRICS_RETENCAO = 24 * 3600
+
+LATENCIA_BALDES = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONSULTAS_BALDES = (1, 2, 3, 5, 10, 20, 50, 100, 250)
+NOTIFICACAO_BALDES = (1, 5, 15, 30, 60, 300, 900, 3600, 4 * 3600, 24 * 3600)
+
+# nome -> (tipo, descrição, baldes dos histogramas)
+METRICAS = {
+    "workflow_http_requests_total": (
+        "counter", "Requisições atendidas, por rota, método e status.", None),
+    "workflow_http_request_duration_seconds": (
+        "histogram", "Tempo até a resposta ficar pronta (streams: até o início do envio).", LATENCIA_BALDES),
+    "workflow_db_queries_per_request": (
+        "histogram", "Consultas SQL por requisição.", CONSULTAS_BALDES),
+    "workflow_db_query_seconds_per_request": (
+        "histogram", "Tempo gasto em SQL por requisição.", LATENCIA_BALDES),
+    "workflow_db_queries_total": (
+        "counter", "Consultas SQL executadas (origem: request ou fundo).", None),
+    "workflow_db_pool_events_total": (
+        "counter", "Eventos do pool de conexões (conexoes_abertas, checkouts, invalidadas).", None),
+    "workflow_serialization_seconds": (
+        "histogram", "Montagem e codificação dos payloads, por etapa.", LATENCIA_BALDES),
+    "workflow_notifications_total": (
+        "counter", "Tentativas de envio de notificação, por resultado.", None),
+    "workflow_notification_send_seconds": (
+        "histogram", "Duração da chamada à API de WhatsApp.", LATENCIA_BALDES),
+    "workflow_notification_latency_seconds": (
+        "histogram", "Da criação ao envio da notificação (fila, rate limit e novas tentativas).", NOTIFICACAO_BALDES),
+    "workflow_previews_total": (
+        "counter", "Prévias de anexos processadas, por resultado.", None),
+    "workflow_preview_seconds": (
+        "histogram", "Geração de uma prévia (miniatura, páginas e texto).", LATENCIA_BALDES),
+}
+
+class MetricsRegistry:
+    """
+    Contadores e histogramas deste worker. Os rótulos das rotas vêm do url_rule
+    (não do caminho), então a quantidade de séries fica limitada ao número de rotas.
+    Os histogramas guardam a contagem de cada balde (sem acumular) e a soma.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # Também roda no processo filho depois de um fork (gunicorn --preload):
+        # o filho começa zerado, com lock e thread próprios
+        self._lock = threading.Lock()
+        self._contadores = {}
+        self._histogramas = {}
+        self._thread = None
+
+    def inc(self, nome, valor=1, **rotulos):
+        chave = (nome, tuple(sorted(rotulos.items())))
+        with self._lock:
+            self._contadores[chave] = self._contadores.get(chave, 0) + valor
+
+    def observe(self, nome, valor, **rotulos):
+        baldes = METRICAS[nome][2]
+        chave = (nome, tuple(sorted(rotulos.items())))
+        with self._lock:
+            histograma = self._histogramas.get(chave)
+            if histograma is None:
+                histograma = self._histogramas[chave] = [0] * (len(baldes) + 1) + [0.0]
+            histograma[bisect.bisect_left(baldes, valor)] += 1 # o último balde é o +Inf
+            histograma[-1] += valor
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "contadores": [[nome, rotulos, valor] for (nome, rotulos), valor in self._contadores.items()],
+                "histogramas": [[nome, rotulos, list(valores)] for (nome, rotulos), valores in self._histogramas.items()],
+            }
+
+    def arquivo(self):
+        return os.path.join(METRICS_DIR, f"{os.getppid()}-{os.getpid()}.json")
+
+    def flush(self):
+        """Grava o retrato deste worker (troca atômica: quem lê nunca vê um arquivo pela metade)."""
+        with app.app_context():
+            retrato = local_metrics_snapshot()
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        caminho = self.arquivo()
+        with open(f"{caminho}.tmp", 'w') as f:
+            json.dump(retrato, f)
+        os.replace(f"{caminho}.tmp", caminho)
+
+    def ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='metricas', daemon=True)
+        self._limpar_antigos()
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.flush()
+            except Exception as e:
+                app.logger.error(f"Erro ao gravar métricas em {METRICS_DIR}: {e}")
+            time.sleep(METRICS_FLUSH_INTERVAL)
+
+    def _limpar_antigos(self):
+        limite = time.time() - METRICS_RETENCAO
+        prefixo = f"{os.getppid()}-"
+        try:
+            for nome in os.listdir(METRICS_DIR):
+                caminho = os.path.join(METRICS_DIR, nome)
+                if not nome.startswith(prefixo) and os.path.getmtime(caminho) < limite:
+                    os.remove(caminho)
+        except OSError:
+            pass
+
+metricas = MetricsRegistry()
+os.register_at_fork(after_in_child=metricas.reset)
+
+@atexit.register
+def flush_metrics_on_exit():
+    # Worker reciclado/encerrado: os contadores dele continuam somando no /metrics
+    if metricas._thread is not None:
+        try:
+            metricas.flush()
+        except Exception:
+            pass
+
+def local_metrics_snapshot():
+    """Retrato deste worker: métricas acumuladas mais os contadores e o estado do pool."""
+    retrato = metricas.snapshot()
+    pool = db_pool_stats()
+    for evento in ("conexoes_abertas", "checkouts", "invalidadas"):
+        retrato["contadores"].append(["workflow_db_pool_events_total", [["evento", evento]], pool[evento]])
+    retrato["pool"] = {estado: pool[estado] for estado in ("tamanho", "em_uso", "livres", "overflow") if estado in pool}
+    if worker_startup.pronto:
+        retrato["inicializacao_s"] = (TEMPO_IMPORTACAO_MS + worker_startup.total_ms) / 1000
+    return retrato
+
+@contextlib.contextmanager
+def medir_etapa(etapa):
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        metricas.observe("workflow_serialization_seconds", time.perf_counter() - inicio, etapa=etapa)
+
+def _rota_atual():
+    return request.url_rule.rule if request.url_rule else 'sem_rota'
+
+def count_query_start(conn, cursor, statement, parameters, context, executemany):
+    context._metricas_inicio = time.perf_counter()
+
+def count_query_end(conn, cursor, statement, parameters, context, executemany):
+    duracao = time.perf_counter() - context._metricas_inicio
+    if has_request_context() and 'consultas_sql' in g:
+        g.consultas_sql += 1
+        g.tempo_sql += duracao
+        metricas.inc("workflow_db_queries_total", origem='request')
+    else:
+        metricas.inc("workflow_db_queries_total", origem='fundo')
+
+with app.app_context():
+    event.listen(db.engine, 'before_cursor_execute', count_query_start)
+    event.listen(db.engine, 'after_cursor_execute', count_query_end)
+
 @app.before_request
-def ensure_upload_folder_exists():
-    upload_path = app.config['UPLOAD_FOLDER']
-    if not os.path.exists(upload_path):
+def start_request_metrics():
+    g.metricas_inicio = time.perf_counter()
+    g.consultas_sql = 0
+    g.tempo_sql = 0.0
+
+@app.after_request
+def record_request_metrics(response):
+    # Registrado antes dos outros after_request, roda por último: inclui compressão e profiler
+    inicio = g.pop('metricas_inicio', None)
+    if inicio is None:
+        return response
+    rota = _rota_atual()
+    metricas.inc("workflow_http_requests_total", rota=rota, metodo=request.method, status=str(response.status_code))
+    metricas.observe("workflow_http_request_duration_seconds", time.perf_counter() - inicio, rota=rota, metodo=request.method)
+    metricas.observe("workflow_db_queries_per_request", g.consultas_sql, rota=rota)
+    metricas.observe("workflow_db_query_seconds_per_request", g.tempo_sql, rota=rota)
+    return response
+
+def _escapar_rotulo(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _rotulos_prometheus(rotulos):
+    if not rotulos:
+        return ""
+    return "{" + ",".join(f'{nome}="{_escapar_rotulo(valor)}"' for nome, valor in rotulos) + "}"
+
+def notification_queue_stats():
+    """Profundidade da fila de notificações (no banco, igual para todos os workers)."""
+    por_status = dict(db.session.execute(
+        db.select(Notificacao.status, db.func.count())
+        .where(Notificacao.status.in_(('pendente', 'enviando', 'falhou')))
+        .group_by(Notificacao.status)
+    ).all())
+    mais_antiga = db.session.scalar(
+        db.select(db.func.min(Notificacao.criado_em)).where(Notificacao.status == 'pendente')
+    )
+    espera = (datetime.utcnow() - mais_antiga).total_seconds() if mais_antiga else 0
+    return por_status, espera
+
+def render_metrics():
+    """
+    Texto no formato de exposição do Prometheus com os retratos de todos os workers
+    somados (contadores e histogramas). O estado do pool sai por worker e só dos
+    workers vivos (retrato recente); a fila de notificações vem do banco.
+    """
+    retratos = [(os.getpid(), local_metrics_snapshot(), True)]
+    prefixo = f"{os.getppid()}-"
+    try:
+        nomes = os.listdir(METRICS_DIR)
+    except OSError:
+        nomes = []
+    agora = time.time()
+    for nome in nomes:
+        if not (nome.startswith(prefixo) and nome.endswith('.json')):
+            continue
+        pid = int(nome[len(prefixo):-len('.json')])
+        if pid == os.getpid():
+            continue
+        caminho = os.path.join(METRICS_DIR, nome)
         try:
-            os.makedirs(upload_path)
-        except OSError as e:
-            app.logger.error(f"Erro ao criar pasta de upload {upload_path}: {e}")
+            with open(caminho) as f:
+                retrato = json.load(f)
+            vivo = agora - os.path.getmtime(caminho) < 3 * METRICS_FLUSH_INTERVAL
+        except (OSError, ValueError):
+            continue
+        retratos.append((pid, retrato, vivo))
+
+    contadores, histogramas = {}, {}
+    for _, retrato, _ in retratos:
+        for nome, rotulos, valor in retrato["contadores"]:
+            chave = (nome, tuple(map(tuple, rotulos)))
+            contadores[chave] = contadores.get(chave, 0) + valor
+        for nome, rotulos, valores in retrato["histogramas"]:
+            chave = (nome, tuple(map(tuple, rotulos)))
+            atual = histogramas.setdefault(chave, [0] * len(valores))
+            histogramas[chave] = [a + b for a, b in zip(atual, valores)]
+
+    linhas = []
+    for nome, (tipo, descricao, baldes) in METRICAS.items():
+        linhas.append(f"# HELP {nome} {descricao}")
+        linhas.append(f"# TYPE {nome} {tipo}")
+        if tipo == "counter":
+            for (nome_serie, rotulos), valor in sorted(contadores.items()):
+                if nome_serie == nome:
+                    linhas.append(f"{nome}{_rotulos_prometheus(rotulos)} {valor}")
+            continue
+        for (nome_serie, rotulos), valores in sorted(histogramas.items()):
+            if nome_serie != nome:
+                continue
+            acumulado = 0
+            for limite, quantidade in zip(baldes + ('+Inf',), valores):
+                acumulado += quantidade
+                le = limite if limite == '+Inf' else f"{limite:g}"
+                linhas.append(f"{nome}_bucket{_rotulos_prometheus(rotulos + (('le', le),))} {acumulado}")
+            linhas.append(f"{nome}_sum{_rotulos_prometheus(rotulos)} {valores[-1]}")
+            linhas.append(f"{nome}_count{_rotulos_prometheus(rotulos)} {acumulado}")
+
+    linhas.append("# HELP workflow_db_pool_connections Conexões do pool por worker e estado.")
+    linhas.append("# TYPE workflow_db_pool_connections gauge")
+    for pid, retrato, vivo in sorted(retratos, key=lambda r: r[0]):
+        if vivo:
+            for estado, valor in sorted(retrato.get("pool", {}).items()):
+                linhas.append(f"workflow_db_pool_connections{_rotulos_prometheus((('worker', pid), ('estado', estado)))} {valor}")
+    linhas.append("# HELP workflow_worker_startup_seconds Cold start de cada worker (importação e inicialização).")
+    linhas.append("# TYPE workflow_worker_startup_seconds gauge")
+    for pid, retrato, vivo in sorted(retratos, key=lambda r: r[0]):
+        if vivo and "inicializacao_s" in retrato:
+            linhas.append(f'workflow_worker_startup_seconds{{worker="{pid}"}} {retrato["inicializacao_s"]:.3f}')
+    linhas.append("# HELP workflow_workers Workers com retrato recente de métricas.")
+    linhas.append("# TYPE workflow_workers gauge")
+    linhas.append(f"workflow_workers {sum(1 for _, _, vivo in retratos if vivo)}")
+
+    por_status, espera = notification_queue_stats()
+    linhas.append("# HELP workflow_notification_queue Notificações na fila, por status.")
+    linhas.append("# TYPE workflow_notification_queue gauge")
+    for status in ('pendente', 'enviando', 'falhou'):
+        linhas.append(f'workflow_notification_queue{{status="{status}"}} {por_status.get(status, 0)}')
+    linhas.append("# HELP workflow_notification_oldest_pending_seconds Idade da notificação pendente mais antiga.")
+    linhas.append("# TYPE workflow_notification_oldest_pending_seconds gauge")
+    linhas.append(f"workflow_notification_oldest_pending_seconds {espera:.3f}")
+    return "\n".join(linhas) + "\n"
+
+# Profiler por requisição, para investigar lentidão em produção (ex.: /api/workflow).
+# Desligado sem PROFILE_DIR. A requisição é perfilada (cProfile) quando:
+#  - traz o cabeçalho 'X-Profile: <PROFILE_TOKEN>': o .prof é sempre gravado e o nome
+#    volta no cabeçalho X-Profile-Arquivo; ou
+#  - cai na amostragem: fração PROFILE_AMOSTRAGEM (0 a 1) das requisições de PROFILE_ROTAS,
+#    gravando só as que passarem de PROFILE_LENTA_MS.
+# Leia com 'flask profile-report <arquivo>' (ou python -m pstats).
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+PROFILE_AMOSTRAGEM = float(os.environ.get('PROFILE_AMOSTRAGEM', '0'))
+PROFILE_ROTAS = set(filter(None, os.environ.get('PROFILE_ROTAS', '/api/workflow').split(',')))
+PROFILE_LENTA_MS = float(os.environ.get('PROFILE_LENTA_MS', '500'))
+PROFILE_MAX_ARQUIVOS = int(os.environ.get('PROFILE_MAX_ARQUIVOS', '200'))
+
+@app.before_request
+def start_request_profiler():
+    if not PROFILE_DIR:
+        return
+    pedido = bool(PROFILE_TOKEN) and request.headers.get('X-Profile') == PROFILE_TOKEN
+    if not pedido and not (PROFILE_AMOSTRAGEM > 0 and _rota_atual() in PROFILE_ROTAS
+                           and random.random() < PROFILE_AMOSTRAGEM):
+        return
+    perfil = cProfile.Profile()
+    try:
+        perfil.enable()
+    except ValueError:
+        # Outro profiler já ativo (no Python 3.12+ é um por processo): deixa esta passar
+        return
+    g.perfil = (perfil, pedido, time.perf_counter())
+
+@app.after_request
+def stop_request_profiler(response):
+    if 'perfil' not in g:
+        return response
+    perfil, pedido, inicio = g.pop('perfil')
+    perfil.disable()
+    duracao_ms = (time.perf_counter() - inicio) * 1000
+    if not pedido and duracao_ms < PROFILE_LENTA_MS:
+        return response
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    if len(os.listdir(PROFILE_DIR)) >= PROFILE_MAX_ARQUIVOS:
+        app.logger.warning(f"Profiler: {PROFILE_DIR} já tem {PROFILE_MAX_ARQUIVOS} arquivos, perfil descartado.")
+        return response
+    rota = re.sub(r'[^A-Za-z0-9]+', '_', _rota_atual()).strip('_') or 'raiz'
+    nome = f"{datetime.utcnow():%Y%m%dT%H%M%S}-{rota}-{duracao_ms:.0f}ms-{os.getpid()}.prof"
+    perfil.dump_stats(os.path.join(PROFILE_DIR, nome))
+    app.logger.info(f"Profiler: {request.method} {request.path} ({duracao_ms:.0f} ms) gravado em {nome}")
+    if pedido:
+        response.headers['X-Profile-Arquivo'] = nome
+    return response
 
 
 # --- Configuração de Notificações (NOVO) ---
 API_KEY = "9102015"
-API_URL = "https://api.callmebot.com/whatsapp.php"
+# Pode ser sobrescrita para apontar para um servidor local em testes
+API_URL = os.environ.get('CALLMEBOT_API_URL', "https://api.callmebot.com/whatsapp.php")
 PHONE_ADMIN = "554188368319"
 PHONE_PAULO = "554100000000"
 PHONE_RENATO = "554100000001"
@@ -52,33 +503,350 @@ PHONE_RENATO = "554100000001"
 # Lista de destinatários
 LISTA_GERAL = [PHONE_ADMIN, PHONE_PAULO, PHONE_RENATO]
 
+# Fila de envio (tabela 'notificacao')
+NOTIFY_WORKERS = int(os.environ.get('NOTIFY_WORKERS', '2'))
+NOTIFY_POLL_INTERVAL = float(os.environ.get('NOTIFY_POLL_INTERVAL', '5'))
+NOTIFY_MAX_TENTATIVAS = int(os.environ.get('NOTIFY_MAX_TENTATIVAS', '6'))
+NOTIFY_BACKOFF_BASE = float(os.environ.get('NOTIFY_BACKOFF_BASE', '30'))   # segundos
+NOTIFY_BACKOFF_MAX = float(os.environ.get('NOTIFY_BACKOFF_MAX', '3600'))   # segundos
+# A CallMeBot bloqueia rajadas para o mesmo número; espaçamos as mensagens por destinatário
+NOTIFY_INTERVALO_POR_TELEFONE = float(os.environ.get('NOTIFY_INTERVALO_POR_TELEFONE', '10'))
+# Envios 'enviando' há mais que isso são de um worker que morreu no meio: voltam para a fila
+NOTIFY_TRAVA_EXPIRA = 300
+# Janela (segundos) em que atualizações de tarefas do mesmo orçamento para o mesmo
+# destinatário são juntadas em uma única mensagem (digest). 0 desliga o agrupamento.
+NOTIFY_JANELA_AGRUPAMENTO = float(os.environ.get('NOTIFY_JANELA_AGRUPAMENTO', '60'))
+
+# Templates das notificações de tarefa (Trigger 5).
+# {itens} e {colaborador} podem conter vários valores quando a mensagem é um digest.
+TAREFA_NOTIFICATION_TEMPLATES = {
+    'Iniciou a Produção': "⚙️ Início de Produção\n\n👤 Cliente: {numero} {cliente}\n\n🧑‍🏭 Responsável: {colaborador}\n\n🚀 Itens iniciados: {itens}",
+    'Fase de Acabamento': "🛠️ Atualização de Produção\n\n👤 Cliente: {numero} {cliente}\n\n🧑‍🏭 Responsável: {colaborador}\n\n🎨 Itens em fase de acabamento: {itens}",
+    'Produção Finalizada': "✅ Produção Concluída!\n\n👤 Cliente: {numero} {cliente}\n\n🧑‍🏭 Responsável: {colaborador}\n\n📦 Itens finalizados: {itens}",
+    'Aguardando Vidro / Pedra': "📦 Aguardando Materiais\n\n👤 Cliente: {numero} {cliente}\n\n🧑‍🏭 Responsável: {colaborador}\n\n🪟 Situação: Aguardando vidro/pedra para iniciar a produção.",
+    'Reforma em Andamento': "🔨 Reforma em Andamento\n\n👤 Cliente: {numero} {cliente}\n\n🧑‍🏭 Responsável: {colaborador}\n\n🔁 Situação: Reforma em andamento na linha de produção.",
+    'StandBy': "⏸️ Produção em StandBy\n\n👤 Cliente: {numero} {cliente}\n\n🧑‍🏭 Responsável: {colaborador}\n\n📦 Situação: Projeto pausado temporariamente.",
+}
+TAREFA_NOTIFICATION_PRONTOS = "\n\n📁 Movido para o grupo: Prontos\n\n📅 Agende uma data de instalação ou entrega."
+
+# Templates das notificações de orçamento (mudança de status e arraste manual).
+# Referenciados pelo nome na tabela de transições (WORKFLOW_TRANSITIONS).
+ORCAMENTO_NOTIFICATION_TEMPLATES = {
+    # Trigger 2: Mudança no grupo "Entrada"
+    'atualizacao_orcamento': "📋 Atualização de Orçamento\n\n👤 Cliente: {numero} {cliente}\n\n🔄 Mudou o status de: {status_antigo}\n\n➡️ Para: {novo_status}",
+    'atualizacao_orcamento_movido': "📋 Atualização de Orçamento\n\n👤 Cliente: {numero} {cliente}\n\n🔄 Mudou o status de: {status_antigo}\n\n➡️ Para: {novo_status}\n\n📁 E foi movido para o grupo: {grupo_novo}",
+    # Trigger 7: Mudança nos grupos "Standby" e "Instalados"
+    'atualizacao_status': "🔄 Atualização de Status\n\n👤 Cliente: {numero} {cliente}\n\n📍 Mudou o status de: {status_antigo}\n\n➡️ Para: {novo_status}",
+    # Trigger 3: Agendamento de Visita
+    'visita_agendada': "📆 Visita Agendada!\n\n👤 Cliente: {numero} {cliente}\n\n📍 Data: {data_visita}\n\n👷 Responsável: {responsavel_visita}",
+    # Trigger 4: Agendamento de Instalação
+    'instalacao_agendada': "🔧 Instalação Agendada!\n\n👤 Cliente: {numero} {cliente}\n\n📍 Data: {data_instalacao}\n\n👷 Responsável: {responsavel_instalacao}",
+    # Trigger 6: Instalação Concluída
+    'instalacao_concluida': "🎉 Instalação Concluída!\n\n👤 Cliente: {numero} {cliente}\n\n🔧 Etapa: 2ª Etapa\n\n👷 Responsável: {responsavel_instalacao_ou_na}",
+    'instalacao_concluida_etapa1': "🎉 Instalação Concluída!\n\n👤 Cliente: {numero} {cliente}\n\n🔧 Etapa: 1ª Etapa\n\n👷 Responsável: {responsavel_instalacao_ou_na}\n\n📁 Movido para Visitas e Medidas — agendar a visita para medidas da segunda etapa.",
+    # Trigger 8: Arrastar
+    'movido_manualmente': "↔️ Item Movido Manualmente\n\n👤 Cliente: {numero} {cliente}\n\n📁 Movido de: {grupo_antigo}\n\n➡️ Para: {grupo_novo}",
+}
+
 # --- Função Auxiliar de Notificação (NOVO) ---
 
 def send_whatsapp_notification(message, phone_numbers):
     """
-    Envia uma notificação por WhatsApp para uma lista de números em threads separadas.
+    Enfileira uma notificação por WhatsApp para uma lista de números.
+    As linhas entram na transação atual: chame ANTES do db.session.commit() da
+    mudança de estado, assim a notificação só existe se a mudança foi gravada.
+    O envio é feito pelo notification_dispatcher depois do commit.
+    """
+    if not isinstance(phone_numbers, list):
+        phone_numbers = [phone_numbers]
+
+    for phone in phone_numbers:
+        db.session.add(Notificacao(telefone=phone, mensagem=message))
+    db.session.info['notificacoes_novas'] = True
+
+
+def _unicos(valores):
+    # Remove repetidos mantendo a ordem
+    return list(dict.fromkeys(v for v in valores if v))
+
+def render_tarefa_notification(numero, cliente, eventos):
+    """
+    Monta a mensagem de uma ou mais atualizações de tarefa do mesmo orçamento
+    usando os TAREFA_NOTIFICATION_TEMPLATES (um bloco por status).
+    Cada evento: {"tarefa_id", "status", "colaborador", "item", "movido_prontos"}.
+    O aviso de ida para Prontos vale para o digest inteiro: vai no bloco das finalizadas
+    ou, se nenhuma tarefa está finalizada agora, no fim da mensagem.
+    """
+    movido_prontos = any(e.get('movido_prontos') for e in eventos)
+    por_status = {}
+    for evento in eventos:
+        por_status.setdefault(evento['status'], []).append(evento)
+
+    blocos = []
+    for status, eventos_status in por_status.items():
+        template = TAREFA_NOTIFICATION_TEMPLATES.get(status)
+        if not template:
+            continue
+        itens = _unicos(e['item'] for e in eventos_status)
+        itens_str = ", ".join(itens)
+        if len(itens) > 1:
+            itens_str += f" ({len(itens)} itens)"
+        bloco = template.format(
+            numero=numero,
+            cliente=cliente,
+            colaborador=", ".join(_unicos(e['colaborador'] for e in eventos_status)),
+            itens=itens_str
+        )
+        if status == 'Produção Finalizada' and movido_prontos:
+            bloco += TAREFA_NOTIFICATION_PRONTOS
+            movido_prontos = False
+        blocos.append(bloco)
+    mensagem = "\n\n➖➖➖\n\n".join(blocos)
+    if movido_prontos and mensagem:
+        mensagem += TAREFA_NOTIFICATION_PRONTOS
+    return mensagem
+
+def render_orcamento_notification(template, orcamento, **extra):
+    """Monta uma mensagem de ORCAMENTO_NOTIFICATION_TEMPLATES com os dados atuais do orçamento."""
+    campos = {
+        "numero": orcamento.numero,
+        "cliente": orcamento.cliente,
+        "grupo_novo": grupos_cache.nome(orcamento.grupo_id),
+        "data_visita": orcamento.data_visita.strftime('%d/%m %H:%M') if orcamento.data_visita else 'N/A',
+        "responsavel_visita": orcamento.responsavel_visita,
+        "data_instalacao": orcamento.data_instalacao.strftime('%d/%m %H:%M') if orcamento.data_instalacao else 'N/A',
+        "responsavel_instalacao": orcamento.responsavel_instalacao,
+        "responsavel_instalacao_ou_na": orcamento.responsavel_instalacao or 'N/A',
+    }
+    campos.update(extra)
+    return ORCAMENTO_NOTIFICATION_TEMPLATES[template].format(**campos)
+
+def send_tarefa_notification(orcamento, eventos, phone_numbers):
+    """
+    Enfileira a notificação de uma ou mais atualizações de tarefa do mesmo orçamento
+    (uma mensagem só por destinatário). Dentro da janela de agrupamento, se já existe
+    uma mensagem pendente do mesmo orçamento para o destinatário, os eventos são
+    juntados a ela (digest) em vez de gerar outro envio.
+    Assim como send_whatsapp_notification, chame ANTES do commit.
+    """
+    if not eventos:
+        return
+    if NOTIFY_JANELA_AGRUPAMENTO <= 0:
+        mensagem = render_tarefa_notification(orcamento.numero, orcamento.cliente, eventos)
+        if mensagem:
+            send_whatsapp_notification(mensagem, phone_numbers)
+        return
+
+    agora = datetime.utcnow()
+    tarefa_ids = {e['tarefa_id'] for e in eventos}
+    for phone in phone_numbers:
+        pendente = (
+            Notificacao.query
+            .filter(
+                Notificacao.telefone == phone,
+                Notificacao.orcamento_id == orcamento.id,
+                Notificacao.status == 'pendente',
+                Notificacao.tentativas == 0,
+                Notificacao.eventos.isnot(None),
+                Notificacao.proxima_tentativa > agora
+            )
+            .order_by(Notificacao.id.desc())
+            .first()
+        )
+        if pendente:
+            # A última atualização de cada tarefa é a que vale, mas a ida para Prontos já
+            # aconteceu: o aviso passa do evento substituído para o que entra no lugar
+            anteriores = json.loads(pendente.eventos)
+            movidos = {e['tarefa_id'] for e in anteriores if e.get('movido_prontos')}
+            juntos = [e for e in anteriores if e['tarefa_id'] not in tarefa_ids]
+            juntos.extend(dict(e, movido_prontos=e.get('movido_prontos') or e['tarefa_id'] in movidos) for e in eventos)
+            mensagem = render_tarefa_notification(orcamento.numero, orcamento.cliente, juntos)
+            # Só altera se o dispatcher ainda não pegou a mensagem para envio
+            result = db.session.execute(
+                db.update(Notificacao)
+                .where(Notificacao.id == pendente.id, Notificacao.status == 'pendente')
+                .values(eventos=json.dumps(juntos, ensure_ascii=False), mensagem=mensagem or pendente.mensagem)
+            )
+            if result.rowcount == 1:
+                continue
+
+        mensagem = render_tarefa_notification(orcamento.numero, orcamento.cliente, eventos)
+        if not mensagem:
+            continue
+        db.session.add(Notificacao(
+            telefone=phone,
+            mensagem=mensagem,
+            orcamento_id=orcamento.id,
+            eventos=json.dumps(eventos, ensure_ascii=False),
+            # Segura o envio até o fim da janela para juntar as próximas atualizações
+            proxima_tentativa=agora + timedelta(seconds=NOTIFY_JANELA_AGRUPAMENTO)
+        ))
+
+
+class NotificationDispatcher:
+    """
+    Pool fixo de threads que envia as notificações da tabela 'notificacao'.
+    Cada worker do gunicorn tem o seu pool; a reserva de cada linha é atômica
+    no banco, então vários workers podem consumir a mesma fila com segurança.
+    Falhas são reenviadas com backoff exponencial e, esgotadas as tentativas,
+    ficam com status 'falhou' (dead-letter) para análise/reenvio manual.
     """
-    def send_request_target(phone, encoded_message):
+
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self._acordar = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._http = None
+
+    def ensure_started(self):
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            if len(self._threads) >= self.num_workers:
+                return
+            if self._http is None:
+                # Sessão única com pool de conexões (reaproveita TCP/TLS entre envios)
+                self._http = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.num_workers)
+                self._http.mount('http://', adapter)
+                self._http.mount('https://', adapter)
+            while len(self._threads) < self.num_workers:
+                thread = threading.Thread(target=self._run, name=f'notificacoes-{len(self._threads)}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def wake(self):
+        self._acordar.set()
+
+    def _run(self):
+        with app.app_context():
+            while True:
+                try:
+                    enviou = self.process_next()
+                except Exception as e:
+                    app.logger.error(f"Erro na fila de notificações: {e}")
+                    db.session.rollback()
+                    enviou = False
+                finally:
+                    db.session.remove()
+                if not enviou:
+                    self._acordar.wait(NOTIFY_POLL_INTERVAL)
+                    self._acordar.clear()
+
+    def process_next(self):
+        """Reserva e envia uma notificação. Retorna False se não havia nada pronto para enviar."""
+        reservada = self._claim_next()
+        if reservada is None:
+            return False
+        notificacao_id, telefone, mensagem = reservada
+
+        inicio = time.perf_counter()
         try:
-            full_url = f"{API_URL}?phone={phone}&text={encoded_message}&apikey={API_KEY}"
-            response = requests.get(full_url, timeout=10)
-            print(f"Notificação enviada para {phone}. Status: {response.status_code}")
+            full_url = f"{API_URL}?phone={telefone}&text={quote_plus(mensagem)}&apikey={API_KEY}"
+            response = self._http.get(full_url, timeout=10)
+            response.raise_for_status()
+            erro = None
         except Exception as e:
-            print(f"Erro ao enviar notificação para {phone}: {e}")
+            erro = str(e)
+        metricas.observe("workflow_notification_send_seconds", time.perf_counter() - inicio)
 
-    try:
-        encoded_message = quote_plus(message)
-        
-        if not isinstance(phone_numbers, list):
-            phone_numbers = [phone_numbers]
-            
-        for phone in phone_numbers:
-            # Inicia uma nova thread para cada requisição
-            thread = threading.Thread(target=send_request_target, args=(phone, encoded_message))
-            thread.start()
-            
-    except Exception as e:
-        print(f"Erro ao preparar notificação: {e}")
+        notificacao = db.session.get(Notificacao, notificacao_id)
+        notificacao.tentativas += 1
+        notificacao.travado_em = None
+        resultado = 'enviada' if erro is None else 'erro'
+        if erro is None:
+            notificacao.status = 'enviada'
+            notificacao.enviado_em = datetime.utcnow()
+            notificacao.ultimo_erro = None
+            metricas.observe("workflow_notification_latency_seconds",
+                             (notificacao.enviado_em - notificacao.criado_em).total_seconds())
+            app.logger.info(f"Notificação {notificacao_id} enviada para {telefone}.")
+        elif notificacao.tentativas >= NOTIFY_MAX_TENTATIVAS:
+            notificacao.status = resultado = 'falhou'
+            notificacao.ultimo_erro = erro[:500]
+            app.logger.error(f"Notificação {notificacao_id} para {telefone} desistiu após {notificacao.tentativas} tentativas: {erro}")
+        else:
+            espera = min(NOTIFY_BACKOFF_BASE * (2 ** (notificacao.tentativas - 1)), NOTIFY_BACKOFF_MAX)
+            notificacao.status = 'pendente'
+            notificacao.proxima_tentativa = datetime.utcnow() + timedelta(seconds=espera)
+            notificacao.ultimo_erro = erro[:500]
+            app.logger.warning(f"Falha ao enviar notificação {notificacao_id} para {telefone} (nova tentativa em {espera:.0f}s): {erro}")
+        db.session.commit()
+        metricas.inc("workflow_notifications_total", resultado=resultado)
+        return True
+
+    def _claim_next(self):
+        agora = datetime.utcnow()
+
+        # Devolve para a fila envios que ficaram presos (worker reciclado no meio do envio)
+        db.session.execute(
+            db.update(Notificacao)
+            .where(Notificacao.status == 'enviando', Notificacao.travado_em < agora - timedelta(seconds=NOTIFY_TRAVA_EXPIRA))
+            .values(status='pendente', travado_em=None)
+        )
+        db.session.commit()
+
+        candidatas = db.session.execute(
+            db.select(Notificacao.id, Notificacao.telefone, Notificacao.mensagem)
+            .where(Notificacao.status == 'pendente', Notificacao.proxima_tentativa <= agora)
+            .order_by(Notificacao.id)
+            .limit(20)
+        ).all()
+
+        telefones_bloqueados = set()
+        for notificacao_id, telefone, mensagem in candidatas:
+            # Mantém a ordem por destinatário: se a mais antiga não pode sair, as seguintes também esperam
+            if telefone in telefones_bloqueados:
+                continue
+            if not self._reserve_recipient(telefone, agora):
+                telefones_bloqueados.add(telefone)
+                continue
+            result = db.session.execute(
+                db.update(Notificacao)
+                .where(Notificacao.id == notificacao_id, Notificacao.status == 'pendente')
+                .values(status='enviando', travado_em=agora)
+            )
+            if result.rowcount == 1:
+                db.session.commit()
+                return notificacao_id, telefone, mensagem
+            # Outro worker pegou primeiro
+            db.session.rollback()
+        return None
+
+    def _reserve_recipient(self, telefone, agora):
+        """Rate limit por destinatário, compartilhado entre workers (linha em 'notificacao_destinatario')."""
+        proximo = agora + timedelta(seconds=NOTIFY_INTERVALO_POR_TELEFONE)
+        result = db.session.execute(
+            db.update(NotificacaoDestinatario)
+            .where(NotificacaoDestinatario.telefone == telefone, NotificacaoDestinatario.proximo_envio <= agora)
+            .values(proximo_envio=proximo)
+        )
+        if result.rowcount == 1:
+            return True
+        if db.session.get(NotificacaoDestinatario, telefone) is not None:
+            return False
+        try:
+            with db.session.begin_nested():
+                db.session.add(NotificacaoDestinatario(telefone=telefone, proximo_envio=proximo))
+            return True
+        except IntegrityError:
+            # Outro worker criou a linha ao mesmo tempo e já reservou
+            return False
+
+notification_dispatcher = NotificationDispatcher(NOTIFY_WORKERS)
+
+@event.listens_for(db.session, 'after_commit')
+def wake_notification_dispatcher(session):
+    # Notificações novas acabaram de ser gravadas: não espera o próximo ciclo de polling
+    if session.info.pop('notificacoes_novas', False):
+        notification_dispatcher.wake()
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def discard_notification_flag(session, previous_transaction):
+    # Savepoint (ou flush dentro dele) desfeito: as notificações da transação externa continuam valendo
+    if previous_transaction.parent is not None:
+        return
+    session.info.pop('notificacoes_novas', None)
 
 
 # Mapeamento de Itens (do .ZIP) para Colaboradores (DETALhado)
@@ -168,9 +936,10 @@ class Orcamento(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     numero = db.Column(db.String(50), nullable=False)
     cliente = db.Column(db.String(200), nullable=False)
-    grupo_id = db.Column(db.Integer, db.ForeignKey('grupo.id'), nullable=False)
+    # active_history: o valor anterior é carregado ao trocar (o histórico de transições depende dele)
+    grupo_id = db.column_property(db.Column(db.Integer, db.ForeignKey('grupo.id'), nullable=False), active_history=True)
     
-    status_atual = db.Column(db.String(100), default='Orçamento Aprovado')
+    status_atual = db.column_property(db.Column(db.String(100), default='Orçamento Aprovado'), active_history=True)
     
     data_entrada_producao = db.Column(db.DateTime)
     data_limite_producao = db.Column(db.DateTime)
@@ -190,13 +959,30 @@ class Orcamento(db.Model):
     tarefas = db.relationship('TarefaProducao', backref='orcamento', lazy=True, cascade="all, delete-orphan")
     arquivos = db.relationship('ArquivoAnexado', backref='orcamento', lazy=True, cascade="all, delete-orphan")
 
+    # (NOVO) Instalados antigos saem do quadro ('flask archive-installed') e só
+    # aparecem sob demanda em /api/grupo/<id>/arquivados
+    arquivado = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
+
+    # (NOVO) Contadores de produção mantidos a cada inserção/mudança de status de tarefa
+    # (ver track_tarefa_counters); 'flask reconcile-progress' reconstrói a partir das tarefas
+    tarefas_total = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    tarefas_nao_iniciadas = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    tarefas_finalizadas = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # Índices dos caminhos quentes (criados em bancos antigos pela migração 3, ver MIGRATIONS)
+    __table_args__ = (
+        db.Index('ix_orcamento_quadro', 'arquivado', 'grupo_id', 'id'), # quadro e páginas de arquivados
+        db.Index('ix_orcamento_grupo', 'grupo_id', 'id'), # Grupo.orcamentos e consultas por grupo
+        db.Index('ix_orcamento_numero', 'numero'), # busca pelo número do orçamento
+    )
+
     def to_dict(self):
         return {
             "id": self.id,
             "numero": self.numero,
             "cliente": self.cliente,
             "grupo_id": self.grupo_id,
-            "grupo_nome": self.grupo.nome,
+            "grupo_nome": grupos_cache.nome(self.grupo_id),
             
             "status_atual": self.status_atual,
             "data_entrada_producao": self.data_entrada_producao.strftime('%Y-%m-%d') if self.data_entrada_producao else None,
@@ -214,15 +1000,45 @@ class Orcamento(db.Model):
 
             # MODIFICAÇÃO: Ordenar tarefas por colaborador e depois por item
             "tarefas": sorted([t.to_dict() for t in self.tarefas], key=lambda x: (x['colaborador'], x['item_descricao'])),
+            "progresso": self.progresso(),
             "arquivos": [a.to_dict() for a in self.arquivos]
         }
 
+    def progresso(self):
+        total = self.tarefas_total or 0
+        finalizadas = self.tarefas_finalizadas or 0
+        return {
+            "total": total,
+            "finalizadas": finalizadas,
+            "nao_iniciadas": self.tarefas_nao_iniciadas or 0,
+            "percentual": round(100 * finalizadas / total) if total else 0
+        }
+
+    def producao_concluida(self):
+        """Todas as tarefas finalizadas? (pelos contadores, sem carregar as tarefas)"""
+        return bool(self.tarefas_total) and self.tarefas_finalizadas == self.tarefas_total
+
+@event.listens_for(Orcamento.grupo_id, 'set')
+def desarquivar_ao_mover(orcamento, novo_grupo_id, grupo_anterior_id, initiator):
+    # Um arquivado que muda de grupo volta a ser trabalho ativo (e a aparecer no quadro)
+    if orcamento.arquivado and novo_grupo_id != grupo_anterior_id:
+        orcamento.arquivado = False
+
 class TarefaProducao(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     orcamento_id = db.Column(db.Integer, db.ForeignKey('orcamento.id'), nullable=False)
     colaborador = db.Column(db.String(100), nullable=False)
     item_descricao = db.Column(db.String(500))
-    status = db.Column(db.String(50), default='Não Iniciado')
+    # active_history: o valor antigo é carregado ao trocar o status (os contadores do orçamento dependem dele)
+    status = db.column_property(db.Column(db.String(50), default='Não Iniciado'), active_history=True)
+    # (NOVO) Quando chegou em 'Produção Finalizada' (ver marcar_finalizacao); base do relatório semanal
+    finalizada_em = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_tarefa_orcamento', 'orcamento_id', 'status'), # selectinload do quadro e "todas prontas?"
+        db.Index('ix_tarefa_colaborador', 'colaborador', 'status'), # fila de trabalho de cada colaborador
+        db.Index('ix_tarefa_finalizada', 'finalizada_em'), # relatório de produção por semana
+    )
     
     def to_dict(self):
         return {
@@ -232,47 +1048,2764 @@ class TarefaProducao(db.Model):
             "status": self.status
         }
 
-class ArquivoAnexado(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    orcamento_id = db.Column(db.Integer, db.ForeignKey('orcamento.id'), nullable=False)
-    nome_arquivo = db.Column(db.String(300))
-    # (MODIFICADO) Não armazenamos mais o caminho, apenas o nome do arquivo.
-    # caminho_arquivo = db.Column(db.String(500))
+TAREFA_STATUS_INICIAL = 'Não Iniciado'
+TAREFA_STATUS_FINAL = 'Produção Finalizada'
+
+@event.listens_for(TarefaProducao.status, 'set')
+def marcar_finalizacao(tarefa, novo_status, status_anterior, initiator):
+    if novo_status == TAREFA_STATUS_FINAL and status_anterior != TAREFA_STATUS_FINAL:
+        tarefa.finalizada_em = datetime.utcnow()
+    elif novo_status != TAREFA_STATUS_FINAL and status_anterior == TAREFA_STATUS_FINAL:
+        tarefa.finalizada_em = None # voltou para a produção
+
+def _contadores_do_status(status):
+    # (total, nao_iniciadas, finalizadas) com que uma tarefa neste status contribui
+    status = status or TAREFA_STATUS_INICIAL # o default da coluna só é aplicado no INSERT
+    return (1, int(status == TAREFA_STATUS_INICIAL), int(status == TAREFA_STATUS_FINAL))
+
+def _status_gravado(tarefa):
+    # Valor que está no banco (antes das mudanças ainda não gravadas)
+    historico = inspect(tarefa).attrs.status.history
+    return historico.deleted[0] if historico.deleted else tarefa.status
+
+@event.listens_for(db.session, 'before_flush')
+def track_tarefa_counters(session, flush_context, instances):
+    """
+    Mantém os contadores de produção do orçamento na mesma transação das tarefas.
+    Orçamentos já gravados recebem 'coluna = coluna + delta' (atômico no banco, sem
+    perder incrementos de workers concorrentes); isso também os marca como alterados
+    para o feed do quadro. Registrado antes de collect_board_changes de propósito.
+    """
+    deltas = {}
+    def somar(tarefa, status, sinal):
+        orcamento = tarefa.orcamento
+        if orcamento is None and tarefa.orcamento_id is not None:
+            orcamento = session.get(Orcamento, tarefa.orcamento_id)
+        if orcamento is None or orcamento in session.deleted:
+            return
+        atual = deltas.setdefault(orcamento, [0, 0, 0])
+        for i, valor in enumerate(_contadores_do_status(status)):
+            atual[i] += sinal * valor
+
+    for obj in session.new:
+        if isinstance(obj, TarefaProducao):
+            somar(obj, obj.status, +1)
+    for obj in session.deleted:
+        if isinstance(obj, TarefaProducao):
+            somar(obj, _status_gravado(obj), -1)
+    for obj in session.dirty:
+        if isinstance(obj, TarefaProducao) and inspect(obj).attrs.status.history.has_changes():
+            somar(obj, _status_gravado(obj), -1)
+            somar(obj, obj.status, +1)
+
+    colunas = ('tarefas_total', 'tarefas_nao_iniciadas', 'tarefas_finalizadas')
+    for orcamento, delta in deltas.items():
+        if not any(delta):
+            continue
+        pendente = inspect(orcamento).pending
+        for coluna, valor in zip(colunas, delta):
+            if pendente:
+                setattr(orcamento, coluna, (getattr(orcamento, coluna) or 0) + valor)
+            elif valor:
+                setattr(orcamento, coluna, getattr(Orcamento, coluna) + valor)
+
+class ArquivoAnexado(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    orcamento_id = db.Column(db.Integer, db.ForeignKey('orcamento.id'), nullable=False)
+    nome_arquivo = db.Column(db.String(300))
+    # (MODIFICADO) Não armazenamos mais o caminho, apenas o nome do arquivo.
+    # caminho_arquivo = db.Column(db.String(500))
+    # (NOVO) Conteúdo no armazenamento por hash; NULL = anexo antigo ainda em UPLOAD_FOLDER/nome_arquivo
+    blob_sha256 = db.Column(db.String(64), db.ForeignKey('arquivo_blob.sha256'), nullable=True, index=True)
+
+    # (NOVO) Prévia do conteúdo: anexos com o mesmo blob dividem a mesma
+    previa = db.relationship(
+        'PreviaArquivo',
+        primaryjoin='foreign(ArquivoAnexado.blob_sha256) == PreviaArquivo.sha256',
+        viewonly=True,
+        uselist=False
+    )
+
+    __table_args__ = (
+        db.Index('ix_arquivo_orcamento', 'orcamento_id'), # selectinload do quadro
+    )
+
+    def to_dict(self):
+        if self.blob_sha256:
+            # O hash na URL identifica o conteúdo; o nome só define o nome do download
+            url = f"/uploads/blob/{self.blob_sha256}/{self.nome_arquivo}"
+        else:
+            url = f"/uploads/{self.nome_arquivo}"
+        previa = self.previa if self.blob_sha256 else None
+        return {
+            "id": self.id,
+            "nome_arquivo": self.nome_arquivo,
+            # (MODIFICADO) A URL é gerada dinamicamente
+            "url": url,
+            "previa": preview_url(self.blob_sha256, previa.formato) if previa else None,
+            "paginas": previa.paginas if previa else None
+        }
+
+class ArquivoBlob(db.Model):
+    # Conteúdo de anexo endereçado pelo SHA-256 (um arquivo em disco por conteúdo distinto)
+    sha256 = db.Column(db.String(64), primary_key=True)
+    tamanho = db.Column(db.BigInteger, nullable=False)
+    refcount = db.Column(db.Integer, nullable=False, default=0) # quantos ArquivoAnexado apontam para ele
+    criado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class PreviaArquivo(db.Model):
+    # (NOVO) Miniatura da 1ª página, número de páginas e texto de um blob, gerados em
+    # segundo plano pelo preview_worker. A linha nasce junto com o blob (fila 'pendente').
+    sha256 = db.Column(db.String(64), db.ForeignKey('arquivo_blob.sha256'), primary_key=True)
+    status = db.Column(db.String(20), nullable=False, default='pendente') # pendente, gerando, pronta, falhou, ignorada
+    tentativas = db.Column(db.Integer, nullable=False, default=0)
+    proxima_tentativa = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    travado_em = db.Column(db.DateTime)
+    ultimo_erro = db.Column(db.String(500))
+    # Preenchidos quando a miniatura existe (continuam valendo enquanto uma nova é gerada)
+    formato = db.Column(db.String(10)) # extensão da miniatura: 'webp' ou 'png'
+    largura = db.Column(db.Integer)
+    altura = db.Column(db.Integer)
+    paginas = db.Column(db.Integer)
+    texto = db.Column(db.Text) # texto das primeiras PREVIA_TEXTO_PAGINAS páginas
+    criado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    gerado_em = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_previa_fila', 'status', 'proxima_tentativa'),
+    )
+
+class Notificacao(db.Model):
+    # Fila persistente (outbox) de mensagens de WhatsApp
+    id = db.Column(db.Integer, primary_key=True)
+    telefone = db.Column(db.String(30), nullable=False)
+    mensagem = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pendente') # pendente, enviando, enviada, falhou
+    tentativas = db.Column(db.Integer, nullable=False, default=0)
+    proxima_tentativa = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    travado_em = db.Column(db.DateTime)
+    ultimo_erro = db.Column(db.String(500))
+    criado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    enviado_em = db.Column(db.DateTime)
+    # Preenchidos apenas nas notificações agrupáveis (atualizações de tarefa)
+    orcamento_id = db.Column(db.Integer)
+    eventos = db.Column(db.Text) # JSON com os eventos juntados na mensagem
+
+    __table_args__ = (
+        db.Index('ix_notificacao_fila', 'status', 'proxima_tentativa'),
+        db.Index('ix_notificacao_agrupamento', 'telefone', 'orcamento_id', 'status'),
+    )
+
+class NotificacaoDestinatario(db.Model):
+    # Controle de rate limit por número (compartilhado entre os workers)
+    telefone = db.Column(db.String(30), primary_key=True)
+    proximo_envio = db.Column(db.DateTime, nullable=False)
+
+class BoardVersion(db.Model):
+    # Linha única (id=1) com o contador de versão do quadro.
+    # Fica no banco para ser consistente entre todos os workers do gunicorn.
+    id = db.Column(db.Integer, primary_key=True)
+    versao = db.Column(db.Integer, nullable=False, default=0)
+
+class BoardChange(db.Model):
+    # Feed de alterações: quais linhas mudaram em cada versão do quadro
+    id = db.Column(db.Integer, primary_key=True)
+    versao = db.Column(db.Integer, nullable=False, index=True)
+    entidade = db.Column(db.String(20), nullable=False) # 'orcamento', 'tarefa' ou 'arquivo'
+    entidade_id = db.Column(db.Integer, nullable=False)
+    orcamento_id = db.Column(db.Integer)
+    acao = db.Column(db.String(20), nullable=False) # 'created', 'updated', 'moved' ou 'deleted'
+
+class SchemaVersion(db.Model):
+    # Última migração aplicada neste banco (linha única, ver MIGRATIONS)
+    id = db.Column(db.Integer, primary_key=True)
+    versao = db.Column(db.Integer, nullable=False, default=0)
+
+class EstimativaItem(db.Model):
+    # (NOVO) Esforço estimado (horas) para produzir um item, pela descrição usada nas tarefas
+    item_descricao = db.Column(db.String(500), primary_key=True)
+    horas = db.Column(db.Float, nullable=False)
+    atualizado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class CapacidadeColaborador(db.Model):
+    # (NOVO) Horas de produção por dia útil de cada colaborador
+    colaborador = db.Column(db.String(100), primary_key=True)
+    horas_por_dia = db.Column(db.Float, nullable=False)
+    atualizado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class BuscaOrcamento(db.Model):
+    # (NOVO) Texto pesquisável de cada orçamento (número, cliente, etapas, itens e anexos),
+    # já normalizado por normalizar_busca; mantido por sync_search_index a cada flush.
+    # Sem FK: a linha de um orçamento apagado só é removida depois do DELETE dele.
+    orcamento_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    texto = db.Column(db.Text, nullable=False, default='')
+
+    __table_args__ = (
+        # Postgres: tsvector indexado (prefixo com 'termo:*'); no SQLite o índice é a tabela FTS5 abaixo
+        db.Index(
+            'ix_busca_orcamento_tsv',
+            db.func.to_tsvector(db.literal_column("'simple'"), texto),
+            postgresql_using='gin'
+        ).ddl_if(dialect='postgresql'),
+    )
+
+# SQLite: índice FTS5 com conteúdo externo (lê o texto de busca_orcamento), sincronizado por triggers
+for _ddl in (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS busca_orcamento_fts USING fts5("
+    "texto, content='busca_orcamento', content_rowid='orcamento_id', "
+    "tokenize='unicode61 remove_diacritics 2', prefix='1 2 3')",
+    "CREATE TRIGGER IF NOT EXISTS busca_orcamento_ai AFTER INSERT ON busca_orcamento BEGIN "
+    "INSERT INTO busca_orcamento_fts(rowid, texto) VALUES (new.orcamento_id, new.texto); END",
+    "CREATE TRIGGER IF NOT EXISTS busca_orcamento_ad AFTER DELETE ON busca_orcamento BEGIN "
+    "INSERT INTO busca_orcamento_fts(busca_orcamento_fts, rowid, texto) VALUES ('delete', old.orcamento_id, old.texto); END",
+    "CREATE TRIGGER IF NOT EXISTS busca_orcamento_au AFTER UPDATE ON busca_orcamento BEGIN "
+    "INSERT INTO busca_orcamento_fts(busca_orcamento_fts, rowid, texto) VALUES ('delete', old.orcamento_id, old.texto); "
+    "INSERT INTO busca_orcamento_fts(rowid, texto) VALUES (new.orcamento_id, new.texto); END",
+):
+    event.listen(BuscaOrcamento.__table__, 'after_create', db.DDL(_ddl).execute_if(dialect='sqlite'))
+event.listen(
+    BuscaOrcamento.__table__, 'after_drop',
+    db.DDL("DROP TABLE IF EXISTS busca_orcamento_fts").execute_if(dialect='sqlite')
+)
+
+class TransicaoStatus(db.Model):
+    # (NOVO) Histórico só de inserção: uma linha por criação/mudança de grupo ou status
+    # de orçamento ('orcamento') e por criação/mudança de status de tarefa ('tarefa').
+    # Gravado por record_status_transitions no mesmo flush da mudança.
+    id = db.Column(db.Integer, primary_key=True)
+    entidade = db.Column(db.String(10), nullable=False)
+    entidade_id = db.Column(db.Integer, nullable=False)
+    orcamento_id = db.Column(db.Integer, nullable=False)
+    grupo_anterior_id = db.Column(db.Integer) # só orçamentos; NULL na criação
+    grupo_id = db.Column(db.Integer) # só orçamentos
+    status_anterior = db.Column(db.String(100)) # NULL na criação
+    status = db.Column(db.String(100))
+    em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # Orçamento que trocou de grupo: tempo no grupo anterior. Tarefa finalizada: tempo de ciclo.
+    # NULL quando o início não está no histórico (registros anteriores a ele).
+    duracao_s = db.Column(db.Integer)
+
+    __table_args__ = (
+        db.Index('ix_transicao_entidade', 'entidade', 'entidade_id', 'em'), # início da etapa/ciclo
+        db.Index('ix_transicao_orcamento', 'orcamento_id', 'id'), # histórico de um orçamento
+    )
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "entidade": self.entidade,
+            "entidade_id": self.entidade_id,
+            "grupo_anterior": grupos_cache.nome(self.grupo_anterior_id) if self.grupo_anterior_id else None,
+            "grupo": grupos_cache.nome(self.grupo_id) if self.grupo_id else None,
+            "status_anterior": self.status_anterior,
+            "status": self.status,
+            "em": self.em.strftime('%Y-%m-%d %H:%M:%S'),
+            "duracao_s": self.duracao_s,
+        }
+
+class EstatisticaDuracao(db.Model):
+    # (NOVO) Rollup das durações do histórico: histograma (baldes logarítmicos) por
+    # métrica, chave e mês, incrementado a cada transição; as análises leem só daqui
+    metrica = db.Column(db.String(20), primary_key=True) # 'grupo' ou 'ciclo_tarefa'
+    chave = db.Column(db.String(100), primary_key=True) # id do grupo ou nome do colaborador
+    periodo = db.Column(db.String(7), primary_key=True) # 'AAAA-MM' em que a etapa/ciclo terminou
+    balde = db.Column(db.Integer, primary_key=True) # ver balde_duracao
+    quantidade = db.Column(db.Integer, nullable=False, default=0)
+    soma_s = db.Column(db.Float, nullable=False, default=0)
+
+
+# --- Versão e Cache do Board ---
+
+BOARD_VERSION_ID = 1
+
+# Quantas versões de alterações são mantidas para o /api/workflow/changes.
+# Clientes mais atrasados que isso recebem {"full": true} e recarregam o quadro todo.
+BOARD_CHANGES_RETENCAO = 2000
+
+BOARD_CHANGE_ENTITIES = {
+    Orcamento: 'orcamento',
+    TarefaProducao: 'tarefa',
+    ArquivoAnexado: 'arquivo',
+}
+
+# Prioridade quando a mesma linha aparece várias vezes na mesma versão
+_ACAO_PRIORIDADE = {'updated': 0, 'moved': 1, 'created': 2, 'deleted': 3}
+
+# Snapshot serializado da última versão montada por este worker, por formato
+# ('completo'/'compacto'): {"versao": v, "corpos": {None: json, 'gzip': ..., 'br': ...}}
+_board_snapshots = {}
+
+def get_board_version():
+    """Lê a versão atual do quadro direto do banco (sem passar pelo identity map)."""
+    versao = db.session.execute(
+        db.select(BoardVersion.versao).where(BoardVersion.id == BOARD_VERSION_ID)
+    ).scalar()
+    return versao or 0
+
+@event.listens_for(db.session, 'before_flush')
+def collect_board_changes(session, flush_context, instances):
+    """Anota os orçamentos/tarefas/arquivos alterados até o próximo bump_board_version()."""
+    pendentes = session.info.setdefault('board_changes', [])
+    for obj in session.new:
+        entidade = BOARD_CHANGE_ENTITIES.get(type(obj))
+        if entidade:
+            pendentes.append((obj, entidade, 'created'))
+    for obj in session.dirty:
+        entidade = BOARD_CHANGE_ENTITIES.get(type(obj))
+        if entidade and session.is_modified(obj, include_collections=False):
+            acao = 'updated'
+            if entidade == 'orcamento' and inspect(obj).attrs.grupo_id.history.has_changes():
+                acao = 'moved'
+            pendentes.append((obj, entidade, acao))
+    for obj in session.deleted:
+        entidade = BOARD_CHANGE_ENTITIES.get(type(obj))
+        if entidade:
+            pendentes.append((obj, entidade, 'deleted'))
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def discard_board_changes(session, previous_transaction):
+    # Só a transação externa descarta: um savepoint desfeito (ex.: corrida no incref_blob) e a
+    # subtransação do flush que falhou dentro dele não desfazem o que já foi anotado antes
+    if previous_transaction.parent is not None:
+        return
+    session.info.pop('board_changes', None)
+
+def bump_board_version():
+    """
+    Incrementa a versão do quadro na transação atual e grava no feed de
+    alterações as linhas modificadas desde o último bump.
+    Deve ser chamada por toda rota de escrita ANTES do db.session.commit().
+    """
+    # Garante que as linhas novas já tenham id antes de registrar as alterações
+    db.session.flush()
+    pendentes = db.session.info.pop('board_changes', [])
+
+    result = db.session.execute(
+        db.update(BoardVersion)
+        .where(BoardVersion.id == BOARD_VERSION_ID)
+        .values(versao=BoardVersion.versao + 1)
+    )
+    if result.rowcount == 0:
+        db.session.add(BoardVersion(id=BOARD_VERSION_ID, versao=1))
+        versao = 1
+    else:
+        versao = get_board_version()
+
+    alteracoes = {}
+    for obj, entidade, acao in pendentes:
+        chave = (entidade, obj.id)
+        anterior = alteracoes.get(chave)
+        if anterior is None or _ACAO_PRIORIDADE[acao] > _ACAO_PRIORIDADE[anterior[1]]:
+            orcamento_id = obj.id if entidade == 'orcamento' else obj.orcamento_id
+            alteracoes[chave] = (orcamento_id, acao)
+
+    for (entidade, entidade_id), (orcamento_id, acao) in alteracoes.items():
+        db.session.add(BoardChange(
+            versao=versao,
+            entidade=entidade,
+            entidade_id=entidade_id,
+            orcamento_id=orcamento_id,
+            acao=acao
+        ))
+
+    # Limpeza periódica do feed (não precisa acontecer a cada escrita)
+    if versao % 100 == 0:
+        db.session.execute(
+            db.delete(BoardChange).where(BoardChange.versao <= versao - BOARD_CHANGES_RETENCAO)
+        )
+
+    return versao
+
+def board_etag(versao, compacto=False, codificacao=None):
+    # ETag forte: cada codificação negociada (gzip, br) é outra representação e tem o seu
+    etag = f"board-v{versao}-compacto" if compacto else f"board-v{versao}"
+    return f"{etag}-{codificacao}" if codificacao else etag
+
+def board_bodies(versao, compacto=False):
+    """Corpos do quadro nesta versão (o JSON e, sob demanda, as versões comprimidas)."""
+    formato = 'compacto' if compacto else 'completo'
+    snapshot = _board_snapshots.get(formato)
+    if snapshot and snapshot["versao"] == versao:
+        return snapshot["corpos"]
+    with medir_etapa('quadro_compacto' if compacto else 'quadro'):
+        quadro = load_board(compacto)
+    with medir_etapa('json'):
+        corpos = {None: dumps_json(quadro)}
+    # Só guarda o snapshot se nenhuma escrita aconteceu durante a montagem
+    if get_board_version() == versao:
+        _board_snapshots[formato] = {"versao": versao, "corpos": corpos}
+    return corpos
+
+# --- Serialização e Compressão das Respostas (NOVO) ---
+
+# Opcionais: 'pip install orjson brotli'. Sem eles, json da biblioteca padrão e só gzip.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+COMPRESS_GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 5))
+COMPRESS_MIMETYPES = {'application/json', 'text/html', 'text/css', 'text/javascript', 'application/javascript'}
+
+# Campos de cada cartão, na ordem do Orcamento.to_dict; o modo compacto manda só os valores
+ORCAMENTO_CAMPOS = (
+    "id", "numero", "cliente", "grupo_id", "grupo_nome", "status_atual",
+    "data_entrada_producao", "data_limite_producao", "data_visita", "responsavel_visita",
+    "data_pronto", "data_instalacao", "responsavel_instalacao", "grupo_origem_standby",
+    "etapa1_descricao", "etapa2_descricao", "tarefas", "progresso", "arquivos",
+)
+TAREFA_CAMPOS = ("id", "colaborador", "item_descricao", "status")
+ARQUIVO_CAMPOS = ("id", "nome_arquivo", "url", "previa", "paginas")
+PROGRESSO_CAMPOS = ("total", "finalizadas", "nao_iniciadas", "percentual")
+
+def dumps_json(dados):
+    """JSON em bytes UTF-8: orjson quando instalado, senão json (mesma saída, sem espaços)."""
+    if orjson is not None:
+        return orjson.dumps(dados)
+    return json.dumps(dados, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def _dia(valor):
+    # isoformat é bem mais barato que strftime; mesmo texto de '%Y-%m-%d'
+    return valor.isoformat()[:10] if valor else None
+
+def _minuto(valor):
+    return valor.isoformat(' ')[:16] if valor else None
+
+def _ordem_textual(coluna):
+    # Ordem por código (a do sorted() do Python e do frontend); o Postgres usaria a do locale
+    if db.engine.dialect.name == 'postgresql':
+        return coluna.collate('C')
+    return coluna
+
+def serialize_orcamentos(condicao, ordem=None, limite=None, compacto=False):
+    """
+    Cartões dos orçamentos que atendem 'condicao', montados a partir de tuplas (sem
+    instanciar objetos do ORM) em três consultas: orçamentos, tarefas (já ordenadas
+    pelo banco) e arquivos. Mesmo conteúdo do Orcamento.to_dict; com compacto=True
+    cada cartão é a lista de valores na ordem de ORCAMENTO_CAMPOS.
+    """
+    consulta = db.select(
+        Orcamento.id, Orcamento.numero, Orcamento.cliente, Orcamento.grupo_id, Orcamento.status_atual,
+        Orcamento.data_entrada_producao, Orcamento.data_limite_producao, Orcamento.data_visita,
+        Orcamento.responsavel_visita, Orcamento.data_pronto, Orcamento.data_instalacao,
+        Orcamento.responsavel_instalacao, Orcamento.grupo_origem_standby,
+        Orcamento.etapa1_descricao, Orcamento.etapa2_descricao,
+        Orcamento.tarefas_total, Orcamento.tarefas_finalizadas, Orcamento.tarefas_nao_iniciadas,
+    ).where(condicao).order_by(*(ordem if ordem is not None else (Orcamento.id,)))
+    if limite is not None:
+        consulta = consulta.limit(limite)
+    linhas = db.session.execute(consulta).all()
+    if not linhas:
+        return []
+
+    # Filhos: pelo mesmo filtro (quadro inteiro) ou pelos ids (páginas e deltas)
+    if limite is None:
+        filhos = lambda modelo: db.and_(Orcamento.id == modelo.orcamento_id, condicao)
+    else:
+        ids = [linha[0] for linha in linhas]
+        filhos = lambda modelo: db.and_(Orcamento.id == modelo.orcamento_id, Orcamento.id.in_(ids))
+
+    tarefas = {}
+    for orcamento_id, tarefa_id, colaborador, item, status in db.session.execute(
+        db.select(TarefaProducao.orcamento_id, TarefaProducao.id, TarefaProducao.colaborador,
+                  TarefaProducao.item_descricao, TarefaProducao.status)
+        .join(Orcamento, filhos(TarefaProducao))
+        .order_by(TarefaProducao.orcamento_id, _ordem_textual(TarefaProducao.colaborador),
+                  _ordem_textual(TarefaProducao.item_descricao), TarefaProducao.id)
+    ):
+        valores = [tarefa_id, colaborador, item, status]
+        tarefas.setdefault(orcamento_id, []).append(valores if compacto else dict(zip(TAREFA_CAMPOS, valores)))
+
+    arquivos = {}
+    for orcamento_id, arquivo_id, nome, sha256, formato, paginas in db.session.execute(
+        db.select(ArquivoAnexado.orcamento_id, ArquivoAnexado.id, ArquivoAnexado.nome_arquivo,
+                  ArquivoAnexado.blob_sha256, PreviaArquivo.formato, PreviaArquivo.paginas)
+        .join(Orcamento, filhos(ArquivoAnexado))
+        .outerjoin(PreviaArquivo, PreviaArquivo.sha256 == ArquivoAnexado.blob_sha256)
+        .order_by(ArquivoAnexado.orcamento_id, ArquivoAnexado.id)
+    ):
+        url = f"/uploads/blob/{sha256}/{nome}" if sha256 else f"/uploads/{nome}"
+        valores = [arquivo_id, nome, url, preview_url(sha256, formato), paginas]
+        arquivos.setdefault(orcamento_id, []).append(valores if compacto else dict(zip(ARQUIVO_CAMPOS, valores)))
+
+    nomes_grupos = {}
+    cartoes = []
+    for (orcamento_id, numero, cliente, grupo_id, status_atual, entrada, limite_producao, visita,
+         responsavel_visita, pronto, instalacao, responsavel_instalacao, origem_standby,
+         etapa1, etapa2, total, finalizadas, nao_iniciadas) in linhas:
+        if grupo_id not in nomes_grupos:
+            nomes_grupos[grupo_id] = grupos_cache.nome(grupo_id)
+        total, finalizadas = total or 0, finalizadas or 0
+        progresso = [total, finalizadas, nao_iniciadas or 0, round(100 * finalizadas / total) if total else 0]
+        valores = [
+            orcamento_id, numero, cliente, grupo_id, nomes_grupos[grupo_id], status_atual,
+            _dia(entrada), _dia(limite_producao), _minuto(visita), responsavel_visita,
+            _minuto(pronto), _minuto(instalacao), responsavel_instalacao, origem_standby,
+            etapa1, etapa2, tarefas.get(orcamento_id, []),
+            progresso if compacto else dict(zip(PROGRESSO_CAMPOS, progresso)),
+            arquivos.get(orcamento_id, []),
+        ]
+        cartoes.append(valores if compacto else dict(zip(ORCAMENTO_CAMPOS, valores)))
+    return cartoes
+
+def negotiate_encoding():
+    """'br', 'gzip' ou None conforme o Accept-Encoding da requisição (e o que está instalado)."""
+    aceitas = request.accept_encodings
+    if brotli is not None and aceitas.quality('br') > 0:
+        return 'br'
+    if aceitas.quality('gzip') > 0:
+        return 'gzip'
+    return None
+
+def compress_body(corpo, codificacao):
+    with medir_etapa(codificacao):
+        if codificacao == 'br':
+            return brotli.compress(corpo, quality=COMPRESS_BROTLI_QUALITY)
+        # mtime=0: mesma entrada, mesmos bytes (o corpo pode ser guardado e reenviado)
+        return gzip.compress(corpo, compresslevel=COMPRESS_GZIP_LEVEL, mtime=0)
+
+@app.after_request
+def compress_response(response):
+    """Comprime respostas de texto/JSON quando o cliente aceita (streaming e arquivos passam direto)."""
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code != 200
+            or response.mimetype not in COMPRESS_MIMETYPES
+            or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    codificacao = negotiate_encoding()
+    corpo = response.get_data()
+    if codificacao is None or len(corpo) < COMPRESS_MIN_BYTES:
+        return response
+    response.set_data(compress_body(corpo, codificacao))
+    response.headers['Content-Encoding'] = codificacao
+    return response
+
+
+# --- Máquina de Estados do Workflow ---
+
+class GroupCache:
+    """
+    Cache em memória (por worker) de nome <-> id dos grupos fixos.
+    Os grupos só mudam no 'flask init-db', que chama invalidate(); um id/nome
+    desconhecido também força recarregar (ex.: init-db rodou em outro processo).
+    """
+
+    def __init__(self):
+        self._por_nome = None
+        self._por_id = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            linhas = db.session.execute(db.select(Grupo.id, Grupo.nome)).all()
+            self._por_nome = {nome: grupo_id for grupo_id, nome in linhas}
+            self._por_id = {grupo_id: nome for grupo_id, nome in linhas}
+
+    def id(self, nome):
+        if self._por_nome is None or nome not in self._por_nome:
+            self._load()
+        return self._por_nome.get(nome)
+
+    def nome(self, grupo_id):
+        if self._por_id is None or grupo_id not in self._por_id:
+            self._load()
+        return self._por_id.get(grupo_id)
+
+    def invalidate(self):
+        with self._lock:
+            self._por_nome = None
+            self._por_id = None
+
+grupos_cache = GroupCache()
+
+# Destino especial: volta para o grupo de onde o orçamento entrou no StandBy
+ORIGEM_STANDBY = '__origem_standby__'
+
+# Transições do PUT /api/orcamento/<id>/status:
+# (grupo atual, novo status[, etapa instalada]) -> grupo destino, campos, ações e notificação.
+# Status sem transição só atualizam o status_atual (e podem notificar pelo grupo/status abaixo).
+WORKFLOW_TRANSITIONS = [
+    # Entrada de Orçamento
+    {"grupo": 'Entrada de Orçamento', "status": ['Visita Agendada'], "destino": 'Visitas e Medidas', "acoes": ['dados_visita']},
+    {"grupo": 'Entrada de Orçamento', "status": ['Desenhar', 'Produzir'], "destino": 'Projetar'},
+    {"grupo": 'Entrada de Orçamento', "status": ['Em Produção'], "destino": 'Linha de Produção', "acoes": ['entrada_producao']},
+    {"grupo": 'Entrada de Orçamento', "status": ['Aguardando Cliente', 'Aguardando Arq/Eng', 'Aguardando Obra', 'Parado'],
+     "destino": 'StandBy', "acoes": ['guardar_origem_standby']},
+
+    # Visitas e Medidas
+    {"grupo": 'Visitas e Medidas', "status": ['Mandar para Produção'], "destino": 'Projetar'},
+    {"grupo": 'Visitas e Medidas', "status": ['Em Produção'], "destino": 'Linha de Produção', "acoes": ['entrada_producao']},
+    {"grupo": 'Visitas e Medidas', "status": ['Instalado'], "etapa": 'Etapa 1', "destino": 'Visitas e Medidas',
+     "campos": {"status_atual": 'Agendar Visita'}, "notificacao": 'instalacao_concluida_etapa1'},
+    {"grupo": 'Visitas e Medidas', "status": ['Instalado'], "etapa": 'Etapa 2', "destino": 'Instalados',
+     "campos": {"status_atual": 'Instalado'}, "notificacao": 'instalacao_concluida'},
+    {"grupo": 'Visitas e Medidas', "status": ['Instalado'], "notificacao": 'instalacao_concluida'},
+
+    # Projetar
+    {"grupo": 'Projetar', "status": ['Aprovado para Produção'], "destino": 'Linha de Produção', "acoes": ['entrada_producao']},
+    {"grupo": 'Projetar', "status": ['StandBy'], "destino": 'StandBy', "acoes": ['guardar_origem_standby']},
+
+    # Linha de Produção
+    {"grupo": 'Linha de Produção', "status": ['StandBy'], "destino": 'StandBy', "acoes": ['guardar_origem_standby']},
+
+    # Prontos
+    {"grupo": 'Prontos', "status": ['Instalação Agendada'], "acoes": ['dados_instalacao']},
+    {"grupo": 'Prontos', "status": ['StandBy'], "destino": 'StandBy', "acoes": ['guardar_origem_standby']},
+    {"grupo": 'Prontos', "status": ['Instalado'], "etapa": 'Etapa 1', "destino": 'Visitas e Medidas',
+     "campos": {"status_atual": 'Agendar Visita'}, "notificacao": 'instalacao_concluida_etapa1'},
+    {"grupo": 'Prontos', "status": ['Instalado'], "etapa": 'Etapa 2', "destino": 'Instalados',
+     "campos": {"status_atual": 'Instalado'}, "notificacao": 'instalacao_concluida'},
+    {"grupo": 'Prontos', "status": ['Instalado'], "notificacao": 'instalacao_concluida'},
+
+    # StandBy
+    {"grupo": 'StandBy', "status": ['Liberado'], "destino": ORIGEM_STANDBY, "acoes": ['liberar_standby']},
+]
+
+# Ao arrastar um orçamento (PUT /api/orcamento/<id>/move): padrões do grupo de destino
+MOVE_DEFAULTS = {
+    'Entrada de Orçamento': {"campos": {"status_atual": 'Orçamento Aprovado'}},
+    'Visitas e Medidas': {"campos": {"status_atual": 'Agendar Visita'}},
+    'Projetar': {"campos": {"status_atual": 'Em Desenho'}},
+    'Linha de Produção': {"campos": {"status_atual": 'Não Iniciado'}, "acoes": ['entrada_producao']},
+    'Prontos': {"campos": {"status_atual": 'Agendar Instalação/Entrega'}, "acoes": ['marcar_pronto']},
+    'StandBy': {"campos": {"status_atual": 'Parado'}, "acoes": ['guardar_origem_standby_se_vazio']},
+    'Instalados': {"campos": {"status_atual": 'Instalado'}},
+}
+
+# Notificação quando a transição não define uma: primeiro pelo novo status, depois pelo grupo atual
+STATUS_NOTIFICATIONS = {
+    'Visita Agendada': 'visita_agendada',
+    'Instalação Agendada': 'instalacao_agendada',
+}
+GROUP_NOTIFICATIONS = {
+    'Entrada de Orçamento': {"padrao": 'atualizacao_orcamento', "movido": 'atualizacao_orcamento_movido'},
+    'StandBy': {"padrao": 'atualizacao_status'},
+    'Instalados': {"padrao": 'atualizacao_status'},
+}
+
+def _acao_dados_visita(orcamento, dados, grupo_atual_id):
+    orcamento.data_visita = parse_datetime(dados.get('data_visita'))
+    orcamento.responsavel_visita = dados.get('responsavel_visita')
+
+def _acao_dados_instalacao(orcamento, dados, grupo_atual_id):
+    orcamento.data_instalacao = parse_datetime(dados.get('data_instalacao'))
+    orcamento.responsavel_instalacao = dados.get('responsavel_instalacao')
+
+def _acao_entrada_producao(orcamento, dados, grupo_atual_id):
+    orcamento.data_entrada_producao = parse_datetime(dados.get('data_entrada'))
+    orcamento.data_limite_producao = parse_datetime(dados.get('data_limite'))
+    for tarefa in orcamento.tarefas:
+        tarefa.status = 'Não Iniciado'
+
+def _acao_guardar_origem_standby(orcamento, dados, grupo_atual_id):
+    orcamento.grupo_origem_standby = grupo_atual_id
+
+def _acao_guardar_origem_standby_se_vazio(orcamento, dados, grupo_atual_id):
+    # Bug fix: Nao setar grupo origem se ja estiver em standby
+    if orcamento.grupo_origem_standby is None:
+        orcamento.grupo_origem_standby = grupo_atual_id
+
+def _acao_liberar_standby(orcamento, dados, grupo_atual_id):
+    orcamento.grupo_origem_standby = None
+
+def _acao_marcar_pronto(orcamento, dados, grupo_atual_id):
+    if not orcamento.data_pronto:
+        orcamento.data_pronto = datetime.utcnow()
+
+TRANSITION_ACTIONS = {
+    'dados_visita': _acao_dados_visita,
+    'dados_instalacao': _acao_dados_instalacao,
+    'entrada_producao': _acao_entrada_producao,
+    'guardar_origem_standby': _acao_guardar_origem_standby,
+    'guardar_origem_standby_se_vazio': _acao_guardar_origem_standby_se_vazio,
+    'liberar_standby': _acao_liberar_standby,
+    'marcar_pronto': _acao_marcar_pronto,
+}
+
+def _compile_regra(regra):
+    acoes = tuple(regra.get('acoes', ()))
+    for acao in acoes:
+        if acao not in TRANSITION_ACTIONS:
+            raise ValueError(f"Ação de transição desconhecida: {acao}")
+    notificacao = regra.get('notificacao')
+    if notificacao and notificacao not in ORCAMENTO_NOTIFICATION_TEMPLATES:
+        raise ValueError(f"Template de notificação desconhecido: {notificacao}")
+    return {
+        "destino": regra.get('destino'),
+        "campos": dict(regra.get('campos', {})),
+        "acoes": tuple(TRANSITION_ACTIONS[acao] for acao in acoes),
+        "notificacao": notificacao,
+    }
+
+def compile_transitions(transitions):
+    """Compila a tabela de transições em um dict (grupo, status, etapa) -> transição."""
+    indice = {}
+    for regra in transitions:
+        compilada = _compile_regra(regra)
+        for status in regra['status']:
+            chave = (regra['grupo'], status, regra.get('etapa'))
+            if chave in indice:
+                raise ValueError(f"Transição duplicada: {chave}")
+            indice[chave] = compilada
+    return indice
+
+TRANSITION_INDEX = compile_transitions(WORKFLOW_TRANSITIONS)
+MOVE_INDEX = {grupo: _compile_regra(regra) for grupo, regra in MOVE_DEFAULTS.items()}
+
+def find_transition(grupo_nome, novo_status, etapa=None):
+    return (TRANSITION_INDEX.get((grupo_nome, novo_status, etapa))
+            or TRANSITION_INDEX.get((grupo_nome, novo_status, None)))
+
+def _apply_regra(orcamento, regra, dados, grupo_atual_id):
+    for campo, valor in regra["campos"].items():
+        setattr(orcamento, campo, valor)
+    for acao in regra["acoes"]:
+        acao(orcamento, dados, grupo_atual_id)
+
+def apply_status_transition(orcamento, novo_status, dados_adicionais):
+    """
+    Aplica a mudança de status (e a transição de grupo, se houver) no orçamento.
+    Retorna a mensagem de notificação a enviar, ou None.
+    """
+    status_antigo = orcamento.status_atual
+    grupo_atual_id = orcamento.grupo_id
+    grupo_atual_nome = grupos_cache.nome(grupo_atual_id)
+
+    orcamento.status_atual = novo_status
+
+    transicao = find_transition(grupo_atual_nome, novo_status, dados_adicionais.get('etapa_instalada'))
+    if transicao:
+        destino = transicao["destino"]
+        if destino == ORIGEM_STANDBY:
+            orcamento.grupo_id = orcamento.grupo_origem_standby or grupos_cache.id('Entrada de Orçamento')
+        elif destino:
+            orcamento.grupo_id = grupos_cache.id(destino)
+        _apply_regra(orcamento, transicao, dados_adicionais, grupo_atual_id)
+
+    template = (transicao and transicao["notificacao"]) or STATUS_NOTIFICATIONS.get(novo_status)
+    if not template and grupo_atual_nome in GROUP_NOTIFICATIONS:
+        notificacoes_grupo = GROUP_NOTIFICATIONS[grupo_atual_nome]
+        moveu = orcamento.grupo_id != grupo_atual_id
+        template = notificacoes_grupo.get("movido") if moveu and "movido" in notificacoes_grupo else notificacoes_grupo["padrao"]
+    if not template:
+        return None
+    return render_orcamento_notification(template, orcamento, status_antigo=status_antigo, novo_status=novo_status)
+
+def apply_manual_move(orcamento, novo_grupo_id, dados):
+    """Aplica o arraste manual para outro grupo. Retorna a mensagem de notificação."""
+    grupo_atual_id = orcamento.grupo_id
+    grupo_antigo_nome = grupos_cache.nome(grupo_atual_id)
+    grupo_novo_nome = grupos_cache.nome(novo_grupo_id)
+
+    orcamento.grupo_id = novo_grupo_id
+    regra = MOVE_INDEX.get(grupo_novo_nome)
+    if regra:
+        _apply_regra(orcamento, regra, dados, grupo_atual_id)
+
+    return render_orcamento_notification(
+        'movido_manualmente', orcamento,
+        grupo_antigo=grupo_antigo_nome, grupo_novo=grupo_novo_nome
+    )
+
+
+# --- Ingestão de Uploads ---
+
+# Arquivos são copiados em blocos deste tamanho (memória constante, independente do tamanho do PDF)
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Proteção contra zip-bomb: limites sobre o conteúdo DESCOMPACTADO do .zip
+ZIP_MAX_MEMBROS = int(os.environ.get('ZIP_MAX_MEMBROS', '200'))
+ZIP_MAX_TOTAL_BYTES = int(os.environ.get('ZIP_MAX_TOTAL_MB', '500')) * 1024 * 1024
+ZIP_MAX_JSON_BYTES = 5 * 1024 * 1024
+# Limite para um único arquivo anexado fora do .zip
+UPLOAD_MAX_BYTES = int(os.environ.get('UPLOAD_MAX_MB', '500')) * 1024 * 1024
+# Subpasta de UPLOAD_FOLDER com o armazenamento endereçado por conteúdo
+BLOB_FOLDER = 'blobs'
+
+class UploadRejeitado(ValueError):
+    """Upload inválido ou acima dos limites; vira uma resposta 400."""
+
+def copy_limited(src, dst, limite, hasher=None):
+    """Copia src -> dst em blocos (estilo shutil.copyfileobj), abortando se passar de 'limite' bytes."""
+    total = 0
+    while True:
+        chunk = src.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            return total
+        total += len(chunk)
+        if total > limite:
+            raise UploadRejeitado("Conteúdo enviado excede o tamanho máximo permitido")
+        if hasher is not None:
+            hasher.update(chunk)
+        dst.write(chunk)
+
+def read_limited(src, limite):
+    data = src.read(limite + 1)
+    if len(data) > limite:
+        raise UploadRejeitado("Arquivo .json do .zip é grande demais")
+    return data
+
+def validate_zip_members(zf):
+    """Confere os limites pelo cabeçalho do .zip antes de extrair qualquer coisa."""
+    membros = [info for info in zf.infolist() if not info.is_dir()]
+    if len(membros) > ZIP_MAX_MEMBROS:
+        raise UploadRejeitado(f"O .zip tem arquivos demais ({len(membros)}, máximo {ZIP_MAX_MEMBROS})")
+    total = sum(info.file_size for info in membros)
+    if total > ZIP_MAX_TOTAL_BYTES:
+        raise UploadRejeitado(f"O .zip descompactado excede {ZIP_MAX_TOTAL_BYTES // (1024 * 1024)} MB")
+    return membros
+
+def blob_path(sha256):
+    """Caminho do blob: blobs/ab/cd/<sha256> (dois níveis para não acumular milhares de arquivos numa pasta)."""
+    return os.path.join(app.config['UPLOAD_FOLDER'], BLOB_FOLDER, sha256[:2], sha256[2:4], sha256)
+
+def incref_blob(sha256, tamanho, quantidade=1):
+    """Soma 'quantidade' referências ao blob, criando a linha se for conteúdo novo (na transação atual)."""
+    incremento = (
+        db.update(ArquivoBlob)
+        .where(ArquivoBlob.sha256 == sha256)
+        .values(refcount=ArquivoBlob.refcount + quantidade)
+    )
+    if db.session.execute(incremento).rowcount:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(ArquivoBlob(sha256=sha256, tamanho=tamanho, refcount=quantidade))
+            # Conteúdo novo entra na fila de prévias (gerada depois do commit, fora da requisição)
+            db.session.add(PreviaArquivo(sha256=sha256))
+    except IntegrityError:
+        # Outro worker criou o mesmo blob ao mesmo tempo
+        db.session.execute(incremento)
+
+def attach_blob(orcamento_id, nome_arquivo, sha256, tamanho):
+    """
+    Cria o ArquivoAnexado apontando para o blob e soma uma referência.
+    Conteúdo repetido só incrementa o refcount; o arquivo em disco continua um só.
+    """
+    incref_blob(sha256, tamanho)
+    anexo = ArquivoAnexado(orcamento_id=orcamento_id, nome_arquivo=nome_arquivo, blob_sha256=sha256)
+    db.session.add(anexo)
+    return anexo
+
+class StagedFiles:
+    """
+    Arquivos gravados como temporários dentro da pasta de upload e só movidos
+    (os.replace, atômico) para o blob final depois do commit no banco.
+    Se algo falhar antes disso, discard() apaga os temporários e nada fica pela metade.
+    """
+
+    def __init__(self, pasta):
+        self.pasta = pasta
+        self._arquivos = []
+
+    def stage(self, src, limite):
+        """Grava o stream 'src' num temporário calculando o SHA-256. Retorna (sha256, tamanho)."""
+        fd, temp_path = tempfile.mkstemp(prefix='.upload-', dir=self.pasta)
+        hasher = hashlib.sha256()
+        try:
+            with os.fdopen(fd, 'wb') as dst:
+                tamanho = copy_limited(src, dst, limite, hasher)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        sha256 = hasher.hexdigest()
+        self._arquivos.append((temp_path, blob_path(sha256)))
+        return sha256, tamanho
+
+    def commit(self):
+        """
+        Move os temporários para os blobs (depois do commit no banco). Um arquivo que não
+        pode ser movido não impede os outros; no fim levanta OSError para a rota responder
+        500, já que o banco aponta para um blob que não existe ('flask check-blobs' encontra).
+        """
+        novos = False
+        falhas = []
+        for temp_path, final_path in self._arquivos:
+            try:
+                if os.path.exists(final_path):
+                    # Conteúdo já armazenado: o temporário é só uma cópia repetida
+                    os.remove(temp_path)
+                    continue
+                os.makedirs(os.path.dirname(final_path), exist_ok=True)
+                os.replace(temp_path, final_path)
+                novos = True
+            except OSError as e:
+                app.logger.error(f"Erro ao mover {temp_path} para {final_path}: {e}")
+                falhas.append(os.path.basename(final_path))
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+        self._arquivos = []
+        if novos:
+            # Os blobs novos já estão no lugar: as prévias podem ser geradas
+            preview_worker.wake()
+        if falhas:
+            raise OSError(f"Dados gravados, mas {len(falhas)} anexo(s) não foram salvos no disco: {', '.join(falhas)}")
+
+    def discard(self):
+        for temp_path, _ in self._arquivos:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+        self._arquivos = []
+
+def parse_upload_zip(arquivo, staged):
+    """
+    Valida o .zip (caminho ou arquivo aberto), lê o .json e grava os PDFs como
+    temporários em 'staged'. Devolve (dados do .json ou None, [{"nome", "sha256", "tamanho"}]).
+    Não usa o banco: pode rodar em paralelo (ver import_zip_bundles).
+    """
+    json_data = None
+    pdf_files = []
+    with zipfile.ZipFile(arquivo, 'r') as zf:
+        membros = validate_zip_members(zf)
+        restante = ZIP_MAX_TOTAL_BYTES
+        for info in membros:
+            filename = info.filename
+            if filename.endswith('.json'):
+                with zf.open(info) as f:
+                    json_data = json.loads(read_limited(f, ZIP_MAX_JSON_BYTES))
+            elif filename.endswith('.pdf'):
+                safe_filename = secure_filename(os.path.basename(filename))
+                if not safe_filename:
+                    continue
+                # Copia em blocos direto do .zip para o disco (sem carregar o PDF inteiro na memória)
+                with zf.open(info) as f:
+                    sha256, tamanho = staged.stage(f, restante)
+                restante -= tamanho
+                # (MODIFICADO) Salva apenas o nome do arquivo
+                pdf_files.append({"nome": safe_filename, "sha256": sha256, "tamanho": tamanho})
+    return json_data, pdf_files
+
+def validate_upload_data(dados):
+    """Confere tipos e tamanhos do .json antes de gravar (no Postgres o excesso viraria erro 500)."""
+    if not isinstance(dados, dict):
+        raise UploadRejeitado("O .json precisa ser um objeto")
+    for chave, coluna in (('numero_orcamento', Orcamento.numero), ('nome_cliente', Orcamento.cliente),
+                          ('itens_etapa_1', Orcamento.etapa1_descricao), ('itens_etapa_2', Orcamento.etapa2_descricao)):
+        valor = dados.get(chave)
+        if valor is not None and not isinstance(valor, str):
+            raise UploadRejeitado(f"'{chave}' precisa ser texto")
+        if valor and len(valor) > coluna.type.length:
+            raise UploadRejeitado(f"'{chave}' passa de {coluna.type.length} caracteres")
+    tarefas = dados.get('tarefas_producao', [])
+    if not isinstance(tarefas, list) or not all(isinstance(tarefa, dict) for tarefa in tarefas):
+        raise UploadRejeitado("'tarefas_producao' precisa ser uma lista de objetos")
+    for tarefa in tarefas:
+        item = tarefa.get('item', '')
+        if not isinstance(item, str) or len(item) > TarefaProducao.item_descricao.type.length:
+            raise UploadRejeitado("Item de 'tarefas_producao' inválido ou longo demais")
+
+
+# --- Importação de .zip em Lote (NOVO) ---
+
+# Backlogs de dezenas/centenas de .zip: 'flask import-zips <pasta>' ou POST /api/upload/lote.
+# Os .zip são validados e extraídos em paralelo (threads: a descompressão e o SHA-256 soltam
+# o GIL) e gravados em lotes de IMPORT_LOTE pacotes por transação, com inserções em lote.
+IMPORT_WORKERS = int(os.environ.get('IMPORT_WORKERS', min(8, os.cpu_count() or 1)))
+IMPORT_LOTE = int(os.environ.get('IMPORT_LOTE', '50'))
+# Uma notificação por importação (não uma por .zip), listando até tantos orçamentos
+IMPORT_NOTIFICACAO_MAX = 10
+
+PacoteZip = namedtuple('PacoteZip', 'arquivo dados pdfs staged')
+ResultadoImportacao = namedtuple('ResultadoImportacao', 'arquivo orcamento_id numero cliente erro')
+# Linha gravada fora do ORM, no formato que o bump_board_version espera (id e orcamento_id)
+LinhaInserida = namedtuple('LinhaInserida', 'id orcamento_id')
+
+def insert_zip_bundles(pacotes):
+    """
+    Grava os pacotes (já validados) na transação atual: orçamentos com RETURNING dos
+    ids, tarefas e anexos em inserções em lote e uma atualização de refcount por blob
+    distinto. As inserções em lote não passam pelos hooks do flush, então o que eles
+    fariam vem junto: contadores, histórico, índice de busca e feed do quadro.
+    Devolve os ids dos orçamentos, na ordem dos pacotes.
+    """
+    grupo_id = grupos_cache.id('Entrada de Orçamento')
+    status = 'Orçamento Aprovado'
+    itens = [
+        [tarefa.get('item', 'Item não descrito') for tarefa in pacote.dados.get('tarefas_producao', [])]
+        for pacote in pacotes
+    ]
+    ids = db.session.scalars(
+        db.insert(Orcamento).returning(Orcamento.id, sort_by_parameter_order=True),
+        [
+            {
+                "numero": pacote.dados.get('numero_orcamento', 'N/A'),
+                "cliente": pacote.dados.get('nome_cliente', 'N/A'),
+                "grupo_id": grupo_id,
+                "status_atual": status,
+                "etapa1_descricao": pacote.dados.get('itens_etapa_1', ''),
+                "etapa2_descricao": pacote.dados.get('itens_etapa_2', ''),
+                "tarefas_total": len(itens_pacote),
+                "tarefas_nao_iniciadas": len(itens_pacote),
+                "tarefas_finalizadas": 0,
+            }
+            for pacote, itens_pacote in zip(pacotes, itens)
+        ]
+    ).all()
+
+    # Upload ZIP usa o mapa antigo (detalhado) de itens para colaboradores
+    tarefas = [
+        {"orcamento_id": orcamento_id, "item_descricao": item, "status": TAREFA_STATUS_INICIAL,
+         "colaborador": ITEM_DEFINITIONS_PRODUCAO.get(item, "Indefinido")}
+        for orcamento_id, itens_pacote in zip(ids, itens) for item in itens_pacote
+    ]
+    tarefa_ids = []
+    if tarefas:
+        tarefa_ids = db.session.scalars(
+            db.insert(TarefaProducao).returning(TarefaProducao.id, sort_by_parameter_order=True), tarefas
+        ).all()
+
+    anexos = [
+        {"orcamento_id": orcamento_id, "nome_arquivo": pdf["nome"], "blob_sha256": pdf["sha256"]}
+        for orcamento_id, pacote in zip(ids, pacotes) for pdf in pacote.pdfs
+    ]
+    if anexos:
+        referencias = Counter(anexo["blob_sha256"] for anexo in anexos)
+        tamanhos = {pdf["sha256"]: pdf["tamanho"] for pacote in pacotes for pdf in pacote.pdfs}
+        for sha256 in sorted(referencias): # ordem fixa: dois lotes ao mesmo tempo não travam um ao outro
+            incref_blob(sha256, tamanhos[sha256], referencias[sha256])
+        db.session.execute(db.insert(ArquivoAnexado), anexos)
+
+    conn = db.session.connection()
+    agora = datetime.utcnow()
+    conn.execute(db.insert(TransicaoStatus), [
+        {"entidade": 'orcamento', "entidade_id": orcamento_id, "orcamento_id": orcamento_id,
+         "grupo_anterior_id": None, "grupo_id": grupo_id, "status_anterior": None, "status": status,
+         "em": agora, "duracao_s": None}
+        for orcamento_id in ids
+    ] + [
+        {"entidade": 'tarefa', "entidade_id": tarefa_id, "orcamento_id": tarefa["orcamento_id"],
+         "grupo_anterior_id": None, "grupo_id": None, "status_anterior": None, "status": TAREFA_STATUS_INICIAL,
+         "em": agora, "duracao_s": None}
+        for tarefa_id, tarefa in zip(tarefa_ids, tarefas)
+    ])
+    refresh_search_rows(conn, ids)
+    # O orçamento inteiro (com tarefas e anexos) vai no delta do próximo bump_board_version
+    db.session.info.setdefault('board_changes', []).extend(
+        (LinhaInserida(orcamento_id, orcamento_id), 'orcamento', 'created') for orcamento_id in ids
+    )
+    return ids
+
+def render_import_notification(importados):
+    linhas = [f"👤 {r.numero} {r.cliente}" for r in importados[:IMPORT_NOTIFICACAO_MAX]]
+    if len(importados) > IMPORT_NOTIFICACAO_MAX:
+        linhas.append(f"... e mais {len(importados) - IMPORT_NOTIFICACAO_MAX}")
+    return (
+        f"🆕 {len(importados)} Novo(s) Orçamento(s) Importado(s)!\n\n"
+        + "\n".join(linhas)
+        + "\n\n📁 Status: Orçamento Aprovado"
+    )
+
+def import_zip_bundles(arquivos, workers=IMPORT_WORKERS, lote=IMPORT_LOTE):
+    """
+    Importa vários .zip (o formato do /api/upload). 'arquivos' é uma lista de
+    (nome, caminho ou arquivo aberto). A validação e a extração rodam num pool de
+    threads, já adiantando os próximos pacotes enquanto um lote é gravado. Se um lote
+    falhar no banco, os pacotes dele são regravados um a um para isolar o culpado.
+    Devolve um ResultadoImportacao por arquivo, na ordem recebida.
+    """
+    pasta = app.config['UPLOAD_FOLDER']
+    resultados = [None] * len(arquivos)
+
+    def preparar(item):
+        nome, origem = item
+        staged = StagedFiles(pasta)
+        try:
+            if not nome.endswith('.zip'):
+                raise UploadRejeitado("Arquivo inválido, envie um .zip")
+            dados, pdfs = parse_upload_zip(origem, staged)
+            if not dados:
+                raise UploadRejeitado("Arquivo .json não encontrado no .zip")
+            validate_upload_data(dados)
+            return PacoteZip(nome, dados, pdfs, staged), None
+        except Exception as e:
+            # Um .zip com problema não interrompe os outros: vira uma linha do relatório
+            staged.discard()
+            return None, str(e)
+
+    def gravar(grupo):
+        try:
+            ids = insert_zip_bundles([pacote for _, pacote in grupo])
+            bump_board_version()
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            if len(grupo) > 1:
+                for item in grupo:
+                    gravar([item])
+                return
+            indice, pacote = grupo[0]
+            pacote.staged.discard()
+            resultados[indice] = ResultadoImportacao(pacote.arquivo, None, None, None, str(e))
+            return
+        for (indice, pacote), orcamento_id in zip(grupo, ids):
+            try:
+                pacote.staged.commit()
+                erro = None
+            except OSError as e:
+                # O orçamento já existe: o relatório traz o id junto com o erro
+                erro = str(e)
+            resultados[indice] = ResultadoImportacao(
+                pacote.arquivo, orcamento_id,
+                pacote.dados.get('numero_orcamento', 'N/A'), pacote.dados.get('nome_cliente', 'N/A'), erro
+            )
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix='importacao') as executor:
+        pendentes = []
+        for indice, (pacote, erro) in enumerate(executor.map(preparar, arquivos)):
+            if erro is not None:
+                resultados[indice] = ResultadoImportacao(arquivos[indice][0], None, None, None, erro)
+                continue
+            pendentes.append((indice, pacote))
+            if len(pendentes) >= lote:
+                gravar(pendentes)
+                pendentes = []
+        if pendentes:
+            gravar(pendentes)
+
+    # Inclui os gravados no banco mesmo que algum anexo não tenha chegado ao disco
+    importados = [resultado for resultado in resultados if resultado.orcamento_id is not None]
+    if importados:
+        send_whatsapp_notification(render_import_notification(importados), [PHONE_ADMIN])
+        db.session.commit()
+    return resultados
+
+
+# --- Entrega de Anexos ---
+
+# (NOVO) Quem envia os bytes dos anexos:
+#   ''           -> o próprio worker (gunicorn usa sendfile do kernel via wsgi.file_wrapper)
+#   'nginx'      -> X-Accel-Redirect; o nginx entrega o arquivo e o worker fica livre na hora
+#   'x-sendfile' -> cabeçalho X-Sendfile (Apache mod_xsendfile, lighttpd)
+# No modo nginx, SENDFILE_NGINX_PREFIX precisa ser uma location 'internal' apontando para UPLOAD_FOLDER:
+#   location /_uploads_internos/ { internal; alias /caminho/do/UPLOAD_FOLDER/; }
+SENDFILE_MODE = os.environ.get('SENDFILE_MODE', '').strip().lower()
+SENDFILE_NGINX_PREFIX = os.environ.get('SENDFILE_NGINX_PREFIX', '/_uploads_internos/')
+# Blobs são imutáveis (endereçados pelo hash): um ano de cache
+BLOB_CACHE_MAX_AGE = 365 * 24 * 3600
+# O send_file do Flask emite o X-Sendfile por conta própria quando esta opção está ligada
+app.config['USE_X_SENDFILE'] = (SENDFILE_MODE == 'x-sendfile')
+
+def serve_attachment(caminho, download_name, etag=True, imutavel=False):
+    """
+    Resposta de download de um anexo com validadores (ETag/Last-Modified, 304) e
+    requisições parciais (Range/If-Range, 206) para os visualizadores de PDF.
+    'etag' pode ser uma string (ETag forte) ou True para o ETag padrão do Werkzeug.
+    """
+    if SENDFILE_MODE == 'nginx':
+        resposta = Response(mimetype=mimetypes.guess_type(download_name)[0] or 'application/octet-stream')
+        if isinstance(etag, str):
+            resposta.set_etag(etag)
+        resposta.last_modified = os.path.getmtime(caminho)
+        resposta.make_conditional(request)
+        if resposta.status_code != 304:
+            # O nginx atende o Range e envia os bytes; aqui só vai o cabeçalho
+            relativo = os.path.relpath(caminho, app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+            resposta.headers['X-Accel-Redirect'] = SENDFILE_NGINX_PREFIX.rstrip('/') + '/' + quote(relativo)
+        resposta.headers.set('Content-Disposition', 'inline', filename=download_name)
+    else:
+        resposta = send_file(
+            caminho,
+            download_name=download_name,
+            conditional=True,
+            etag=etag,
+        )
+
+    if imutavel:
+        resposta.cache_control.no_cache = None # o send_file marca no-cache por padrão
+        resposta.cache_control.public = True
+        resposta.cache_control.max_age = BLOB_CACHE_MAX_AGE
+        resposta.cache_control.immutable = True
+    else:
+        resposta.cache_control.no_cache = True
+    return resposta
+
+
+# --- Prévias dos Anexos (NOVO) ---
+
+# A renderização (pypdfium2 e Pillow, do requirements.txt) roda em preview_renderer.py,
+# num processo à parte: um PDF que derruba o PDFium mata só esse processo, não o worker.
+PREVIA_RENDERIZADOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'preview_renderer.py')
+PREVIA_FOLDER = 'previas'
+PREVIA_LARGURA = int(os.environ.get('PREVIA_LARGURA', '240')) # px da miniatura (o quadro mostra em ~1/3 disso)
+PREVIA_QUALIDADE = int(os.environ.get('PREVIA_QUALIDADE', '70'))
+PREVIA_MAX_BYTES = int(os.environ.get('PREVIA_MAX_BYTES', 200 * 1024 * 1024)) # PDFs maiores ficam sem prévia
+PREVIA_TEXTO_PAGINAS = 20
+PREVIA_TEXTO_MAX = 50000 # caracteres
+PREVIA_POLL_INTERVAL = float(os.environ.get('PREVIA_POLL_INTERVAL', '30'))
+PREVIA_MAX_TENTATIVAS = 3
+PREVIA_BACKOFF_BASE = 60 # segundos
+# Tempo máximo de um processo de renderização (PDF que trava o PDFium)
+PREVIA_TIMEOUT = float(os.environ.get('PREVIA_TIMEOUT', '60'))
+# Gerações 'gerando' há mais que isso são de um worker que morreu no meio: voltam para a
+# fila ou, esgotadas as tentativas (contadas na reserva), vão para 'falhou'
+PREVIA_TRAVA_EXPIRA = 600
+
+class PreviaIgnorada(Exception):
+    """Conteúdo que não terá prévia (não é PDF, grande demais): não adianta tentar de novo."""
+
+def preview_path(sha256, formato=None):
+    """Mesma divisão em pastas dos blobs: previas/ab/cd/<sha256>.<formato> (sem formato: sem a extensão)."""
+    caminho = os.path.join(app.config['UPLOAD_FOLDER'], PREVIA_FOLDER, sha256[:2], sha256[2:4], sha256)
+    return f"{caminho}.{formato}" if formato else caminho
+
+def preview_url(sha256, formato):
+    # Sem formato ainda não existe miniatura (pendente, falhou ou não é PDF)
+    return f"/uploads/previa/{sha256}.{formato}" if sha256 and formato else None
+
+def generate_preview(sha256):
+    """
+    Renderiza a 1ª página do blob numa miniatura e extrai o número de páginas e o
+    texto, num processo separado (preview_renderer.py). Não usa o banco.
+    Retorna os campos da PreviaArquivo.
+    """
+    caminho = blob_path(sha256)
+    with open(caminho, 'rb') as f:
+        if f.read(5) != b'%PDF-':
+            raise PreviaIgnorada("O anexo não é um PDF")
+    if os.path.getsize(caminho) > PREVIA_MAX_BYTES:
+        raise PreviaIgnorada(f"PDF maior que {PREVIA_MAX_BYTES // (1024 * 1024)} MB")
+
+    resultado = subprocess.run(
+        [sys.executable, PREVIA_RENDERIZADOR, caminho, preview_path(sha256),
+         str(PREVIA_LARGURA), str(PREVIA_QUALIDADE), str(PREVIA_TEXTO_PAGINAS), str(PREVIA_TEXTO_MAX)],
+        capture_output=True,
+        timeout=PREVIA_TIMEOUT,
+    )
+    if resultado.returncode != 0:
+        # Última linha do traceback, ou o sinal que matou o processo (ex.: -11 = SIGSEGV)
+        detalhe = resultado.stderr.decode(errors='replace').strip().splitlines()
+        raise RuntimeError(detalhe[-1] if detalhe else f"Renderizador terminou com código {resultado.returncode}")
+    return json.loads(resultado.stdout)
+
+
+class PreviewWorker:
+    """
+    Thread de fundo (uma por worker) que consome a fila de prévias (tabela
+    'previa_arquivo'). A reserva de cada linha é atômica no banco, como na fila de
+    notificações, e já conta a tentativa: uma renderização que nunca termina esgota
+    as tentativas em vez de voltar para a fila para sempre. O upload só grava a linha
+    'pendente'; a renderização acontece depois do commit, num processo de prioridade baixa.
+    """
+
+    def __init__(self):
+        self._acordar = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='previas', daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        self._acordar.set()
+
+    def _run(self):
+        with app.app_context():
+            while True:
+                try:
+                    gerou = self.process_next()
+                except Exception as e:
+                    app.logger.error(f"Erro na fila de prévias: {e}")
+                    db.session.rollback()
+                    gerou = False
+                finally:
+                    db.session.remove()
+                if not gerou:
+                    self._acordar.wait(PREVIA_POLL_INTERVAL)
+                    self._acordar.clear()
+
+    def process_next(self):
+        """Reserva e gera uma prévia. Retorna False se não havia nada pronto para gerar."""
+        sha256 = self._claim_next()
+        if sha256 is None:
+            return False
+
+        inicio = time.perf_counter()
+        dados = None
+        try:
+            dados = generate_preview(sha256)
+            erro, resultado = None, 'pronta'
+        except PreviaIgnorada as e:
+            erro, resultado = str(e), 'ignorada'
+        except Exception as e:
+            # Inclui o blob ainda não movido para o lugar (commit do upload em andamento)
+            erro, resultado = str(e) or type(e).__name__, 'erro'
+        metricas.observe("workflow_preview_seconds", time.perf_counter() - inicio)
+
+        previa = db.session.get(PreviaArquivo, sha256)
+        previa.travado_em = None
+        if dados is not None:
+            for campo, valor in dados.items():
+                setattr(previa, campo, valor)
+            previa.status = 'pronta'
+            previa.gerado_em = datetime.utcnow()
+            previa.ultimo_erro = None
+            # Os cartões com este conteúdo ganham a miniatura pelo feed do quadro
+            pendentes = db.session.info.setdefault('board_changes', [])
+            for anexo in ArquivoAnexado.query.filter_by(blob_sha256=sha256):
+                pendentes.append((anexo, 'arquivo', 'updated'))
+            bump_board_version()
+        elif resultado == 'ignorada':
+            previa.status = 'ignorada'
+            previa.ultimo_erro = erro[:500]
+        elif previa.tentativas >= PREVIA_MAX_TENTATIVAS:
+            previa.status = resultado = 'falhou'
+            previa.ultimo_erro = erro[:500]
+            app.logger.error(f"Prévia de {sha256} desistiu após {previa.tentativas} tentativas: {erro}")
+        else:
+            espera = PREVIA_BACKOFF_BASE * (2 ** (previa.tentativas - 1))
+            previa.status = 'pendente'
+            previa.proxima_tentativa = datetime.utcnow() + timedelta(seconds=espera)
+            previa.ultimo_erro = erro[:500]
+            app.logger.warning(f"Falha ao gerar a prévia de {sha256} (nova tentativa em {espera}s): {erro}")
+        db.session.commit()
+        metricas.inc("workflow_previews_total", resultado=resultado)
+        return True
+
+    def _claim_next(self):
+        agora = datetime.utcnow()
+
+        # Gerações presas (worker reciclado ou morto no meio): desiste das que já esgotaram
+        # as tentativas e devolve as outras para a fila
+        presas = db.and_(
+            PreviaArquivo.status == 'gerando',
+            PreviaArquivo.travado_em < agora - timedelta(seconds=PREVIA_TRAVA_EXPIRA)
+        )
+        desistidas = db.session.execute(
+            db.update(PreviaArquivo)
+            .where(presas, PreviaArquivo.tentativas >= PREVIA_MAX_TENTATIVAS)
+            .values(status='falhou', travado_em=None, ultimo_erro="A geração foi interrompida em todas as tentativas")
+        )
+        if desistidas.rowcount:
+            app.logger.error(f"{desistidas.rowcount} prévia(s) desistida(s) após interromperem o worker {PREVIA_MAX_TENTATIVAS} vezes.")
+        db.session.execute(
+            db.update(PreviaArquivo)
+            .where(presas)
+            .values(status='pendente', travado_em=None)
+        )
+        db.session.commit()
+
+        # Mais novas primeiro: o upload de agora não espera o backfill dos anexos antigos
+        candidatas = db.session.scalars(
+            db.select(PreviaArquivo.sha256)
+            .where(PreviaArquivo.status == 'pendente', PreviaArquivo.proxima_tentativa <= agora)
+            .order_by(PreviaArquivo.criado_em.desc())
+            .limit(10)
+        ).all()
+        for sha256 in candidatas:
+            result = db.session.execute(
+                db.update(PreviaArquivo)
+                .where(PreviaArquivo.sha256 == sha256, PreviaArquivo.status == 'pendente')
+                .values(status='gerando', travado_em=agora, tentativas=PreviaArquivo.tentativas + 1)
+            )
+            if result.rowcount == 1:
+                db.session.commit()
+                return sha256
+            # Outro worker pegou primeiro
+            db.session.rollback()
+        return None
+
+preview_worker = PreviewWorker()
+
+
+# --- Busca de Orçamentos (NOVO) ---
+
+BUSCA_LIMITE = 20
+BUSCA_LIMITE_MAX = 100
+BUSCA_MAX_TERMOS = 8
+BUSCA_LOTE = 500 # orçamentos por lote ao reconstruir o índice
+
+# Colunas do orçamento que entram no texto de busca
+BUSCA_CAMPOS_ORCAMENTO = ('numero', 'cliente', 'etapa1_descricao', 'etapa2_descricao')
+
+def normalizar_busca(texto):
+    """
+    Minúsculas, sem acentos e só com letras/dígitos separados por espaço
+    ("Hélio Giratório" -> "helio giratorio", "Planta_2.pdf" -> "planta 2 pdf").
+    Aplicada no texto indexado e nos termos da consulta, então FTS5 e tsvector
+    veem as mesmas palavras.
+    """
+    decomposto = unicodedata.normalize('NFKD', texto or '')
+    sem_acentos = ''.join(c for c in decomposto if not unicodedata.combining(c))
+    return ' '.join(re.findall(r'[^\W_]+', sem_acentos.casefold()))
+
+def _textos_busca(conn, ids):
+    """Texto de busca de cada orçamento (três consultas por lote, sem passar pelo ORM)."""
+    partes = {}
+    for linha in conn.execute(
+        db.select(Orcamento.id, *(getattr(Orcamento, campo) for campo in BUSCA_CAMPOS_ORCAMENTO))
+        .where(Orcamento.id.in_(ids))
+    ):
+        partes[linha[0]] = list(linha[1:])
+    for orcamento_id, item in conn.execute(
+        db.select(TarefaProducao.orcamento_id, TarefaProducao.item_descricao)
+        .where(TarefaProducao.orcamento_id.in_(ids))
+    ):
+        if orcamento_id in partes:
+            partes[orcamento_id].append(item)
+    for orcamento_id, nome in conn.execute(
+        db.select(ArquivoAnexado.orcamento_id, ArquivoAnexado.nome_arquivo)
+        .where(ArquivoAnexado.orcamento_id.in_(ids))
+    ):
+        if orcamento_id in partes:
+            partes[orcamento_id].append(nome)
+    return {i: normalizar_busca(' '.join(filter(None, p))) for i, p in partes.items()}
+
+def refresh_search_rows(conn, ids):
+    """Regrava as linhas de busca dos orçamentos (apaga as de orçamentos que não existem mais)."""
+    ids = list(ids)
+    for inicio in range(0, len(ids), BUSCA_LOTE):
+        lote = ids[inicio:inicio + BUSCA_LOTE]
+        textos = _textos_busca(conn, lote)
+        conn.execute(db.delete(BuscaOrcamento).where(BuscaOrcamento.orcamento_id.in_(lote)))
+        if textos:
+            conn.execute(
+                db.insert(BuscaOrcamento),
+                [{"orcamento_id": i, "texto": texto} for i, texto in textos.items()]
+            )
+
+def rebuild_search_index(conn):
+    """Reconstrói o índice de busca inteiro. Retorna quantos orçamentos foram indexados."""
+    conn.execute(db.delete(BuscaOrcamento))
+    total = 0
+    ultimo = 0
+    while True:
+        ids = conn.execute(
+            db.select(Orcamento.id).where(Orcamento.id > ultimo)
+            .order_by(Orcamento.id).limit(BUSCA_LOTE)
+        ).scalars().all()
+        if not ids:
+            return total
+        refresh_search_rows(conn, ids)
+        total += len(ids)
+        ultimo = ids[-1]
+
+def _campos_alterados(obj, campos):
+    estado = inspect(obj)
+    return any(estado.attrs[campo].history.has_changes() for campo in campos)
+
+@event.listens_for(db.session, 'after_flush')
+def sync_search_index(session, flush_context):
+    """
+    Atualiza o índice de busca na mesma transação, só para os orçamentos cujo texto
+    pesquisável mudou (mudanças de status, datas e contadores não reindexam nada).
+    """
+    ids = set()
+    for obj in session.new:
+        if isinstance(obj, Orcamento):
+            ids.add(obj.id)
+        elif isinstance(obj, (TarefaProducao, ArquivoAnexado)):
+            ids.add(obj.orcamento_id)
+    for obj in session.deleted:
+        if isinstance(obj, Orcamento):
+            ids.add(obj.id)
+        elif isinstance(obj, (TarefaProducao, ArquivoAnexado)):
+            ids.add(obj.orcamento_id)
+    for obj in session.dirty:
+        if isinstance(obj, Orcamento):
+            if _campos_alterados(obj, BUSCA_CAMPOS_ORCAMENTO):
+                ids.add(obj.id)
+        elif isinstance(obj, TarefaProducao):
+            if _campos_alterados(obj, ('item_descricao', 'orcamento_id')):
+                ids.add(obj.orcamento_id)
+                ids.update(inspect(obj).attrs.orcamento_id.history.deleted)
+        elif isinstance(obj, ArquivoAnexado):
+            if _campos_alterados(obj, ('nome_arquivo', 'orcamento_id')):
+                ids.add(obj.orcamento_id)
+                ids.update(inspect(obj).attrs.orcamento_id.history.deleted)
+    ids.discard(None)
+    if ids:
+        refresh_search_rows(session.connection(), ids)
+
+def termos_busca(consulta):
+    return normalizar_busca(consulta).split()[:BUSCA_MAX_TERMOS]
+
+def search_statement(dialeto, termos, limite):
+    """
+    Orçamentos (inclusive arquivados) que contêm todos os termos, cada um como prefixo
+    de alguma palavra, mais recentes primeiro. SQLite: FTS5 (percorre o índice já na
+    ordem do rowid e para no limite); Postgres: tsvector com índice GIN.
+    """
+    colunas = db.select(
+        Orcamento.id, Orcamento.numero, Orcamento.cliente, Orcamento.grupo_id,
+        Orcamento.status_atual, Orcamento.arquivado,
+    )
+    if dialeto == 'sqlite':
+        fts = db.table('busca_orcamento_fts', db.column('rowid'))
+        consulta = (
+            colunas.join_from(fts, Orcamento, Orcamento.id == fts.c.rowid)
+            .where(db.literal_column('busca_orcamento_fts').op('MATCH')(
+                ' '.join(f'"{termo}"*' for termo in termos)))
+            .order_by(fts.c.rowid.desc())
+        )
+    elif dialeto == 'postgresql':
+        vetor = db.func.to_tsvector(db.literal_column("'simple'"), BuscaOrcamento.texto)
+        consulta = (
+            colunas.join_from(BuscaOrcamento, Orcamento, Orcamento.id == BuscaOrcamento.orcamento_id)
+            .where(vetor.op('@@')(db.func.to_tsquery(
+                db.literal_column("'simple'"), ' & '.join(f'{termo}:*' for termo in termos))))
+            .order_by(Orcamento.id.desc())
+        )
+    else:
+        # Outros bancos: sem índice textual, mas com a mesma normalização
+        consulta = (
+            colunas.join_from(BuscaOrcamento, Orcamento, Orcamento.id == BuscaOrcamento.orcamento_id)
+            .where(*(db.or_(BuscaOrcamento.texto.like(f'{termo}%'), BuscaOrcamento.texto.like(f'% {termo}%'))
+                     for termo in termos))
+            .order_by(Orcamento.id.desc())
+        )
+    return consulta.limit(limite)
+
+def search_orcamentos(conn, consulta, limite=BUSCA_LIMITE):
+    termos = termos_busca(consulta)
+    if not termos:
+        return []
+    return [
+        {
+            "id": linha.id,
+            "numero": linha.numero,
+            "cliente": linha.cliente,
+            "grupo_id": linha.grupo_id,
+            "grupo_nome": grupos_cache.nome(linha.grupo_id),
+            "status_atual": linha.status_atual,
+            "arquivado": linha.arquivado,
+        }
+        for linha in conn.execute(search_statement(conn.dialect.name, termos, limite))
+    ]
+
+
+# --- Histórico de Status e Análises (NOVO) ---
+
+# Histograma das durações: DURACAO_BALDES_POR_DOBRO baldes a cada vez que a duração dobra,
+# a partir de 1 minuto (balde 0 = até 1 min). Com 4, a mediana/p90 estimada erra no
+# máximo ~10% (a largura relativa de um balde), sem guardar as durações individuais.
+DURACAO_BALDES_POR_DOBRO = 4
+DURACAO_MINIMA_S = 60
+
+def balde_duracao(segundos):
+    return max(0, math.floor(DURACAO_BALDES_POR_DOBRO * math.log2(max(segundos, DURACAO_MINIMA_S) / DURACAO_MINIMA_S)))
+
+def limites_balde(balde):
+    """(início, fim) em segundos do intervalo coberto por um balde."""
+    if balde == 0:
+        return 0.0, DURACAO_MINIMA_S * 2 ** (1 / DURACAO_BALDES_POR_DOBRO)
+    return (DURACAO_MINIMA_S * 2 ** (balde / DURACAO_BALDES_POR_DOBRO),
+            DURACAO_MINIMA_S * 2 ** ((balde + 1) / DURACAO_BALDES_POR_DOBRO))
+
+def quantil_histograma(baldes, q):
+    """Quantil q (0-1) a partir de [(balde, quantidade)] ordenado, interpolando dentro do balde."""
+    total = sum(quantidade for _, quantidade in baldes)
+    if not total:
+        return None
+    alvo = q * total
+    acumulado = 0
+    for balde, quantidade in baldes:
+        if acumulado + quantidade >= alvo:
+            inicio, fim = limites_balde(balde)
+            return inicio + (fim - inicio) * (alvo - acumulado) / quantidade
+        acumulado += quantidade
+    return limites_balde(baldes[-1][0])[1]
+
+def add_duration_rollups(conn, agregados):
+    """
+    Soma {(metrica, chave, periodo, balde): [quantidade, soma_s]} no rollup, na transação
+    de 'conn'. UPDATE atômico; a linha é criada (num savepoint) só na primeira vez.
+    """
+    for (metrica, chave, periodo, balde), (quantidade, soma) in agregados.items():
+        incremento = (
+            db.update(EstatisticaDuracao)
+            .where(EstatisticaDuracao.metrica == metrica, EstatisticaDuracao.chave == chave,
+                   EstatisticaDuracao.periodo == periodo, EstatisticaDuracao.balde == balde)
+            .values(quantidade=EstatisticaDuracao.quantidade + quantidade,
+                    soma_s=EstatisticaDuracao.soma_s + soma)
+        )
+        if conn.execute(incremento).rowcount:
+            continue
+        try:
+            with conn.begin_nested():
+                conn.execute(db.insert(EstatisticaDuracao).values(
+                    metrica=metrica, chave=chave, periodo=periodo, balde=balde,
+                    quantidade=quantidade, soma_s=soma
+                ))
+        except IntegrityError:
+            # Outro worker criou a mesma linha ao mesmo tempo
+            conn.execute(incremento)
+
+def _acumular(agregados, metrica, chave, em, duracao):
+    atual = agregados.setdefault((metrica, chave, em.strftime('%Y-%m'), balde_duracao(duracao)), [0, 0.0])
+    atual[0] += 1
+    atual[1] += duracao
+
+def _inicio_etapas(conn, orcamento_ids):
+    """Quando cada orçamento entrou no grupo atual (criação ou última mudança de grupo)."""
+    return dict(conn.execute(
+        db.select(TransicaoStatus.entidade_id, db.func.max(TransicaoStatus.em))
+        .where(TransicaoStatus.entidade == 'orcamento',
+               TransicaoStatus.entidade_id.in_(orcamento_ids),
+               db.or_(TransicaoStatus.grupo_anterior_id.is_(None),
+                      TransicaoStatus.grupo_anterior_id != TransicaoStatus.grupo_id))
+        .group_by(TransicaoStatus.entidade_id)
+    ).all())
+
+def _inicio_ciclos(conn, tarefa_ids):
+    """
+    Início do ciclo de cada tarefa: a primeira vez que entrou num status de trabalho
+    (diferente de 'Não Iniciado'); se foi direto para finalizada, a criação.
+    """
+    eventos = {}
+    for tarefa_id, em, status in conn.execute(
+        db.select(TransicaoStatus.entidade_id, TransicaoStatus.em, TransicaoStatus.status)
+        .where(TransicaoStatus.entidade == 'tarefa', TransicaoStatus.entidade_id.in_(tarefa_ids))
+        .order_by(TransicaoStatus.em)
+    ):
+        eventos.setdefault(tarefa_id, []).append((em, status or TAREFA_STATUS_INICIAL))
+    inicios = {}
+    for tarefa_id, lista in eventos.items():
+        trabalho = [em for em, status in lista if status != TAREFA_STATUS_INICIAL]
+        inicios[tarefa_id] = trabalho[0] if trabalho else lista[0][0]
+    return inicios
+
+def _valor_anterior(estado, atributo, atual):
+    historico = estado.attrs[atributo].history
+    return historico.deleted[0] if historico.deleted else atual
+
+@event.listens_for(db.session, 'after_flush')
+def record_status_transitions(session, flush_context):
+    """
+    Grava as transições deste flush no histórico e soma as durações que terminaram
+    nelas (tempo no grupo anterior, ciclo da tarefa finalizada) no rollup. Tudo na
+    mesma transação da mudança; o início vem do próprio histórico (consulta indexada).
+    """
+    agora = datetime.utcnow()
+    eventos = []
+    movidos = {} # orcamento_id -> evento da mudança de grupo
+    finalizadas = {} # tarefa_id -> (evento, colaborador)
+
+    def evento(entidade, entidade_id, orcamento_id, status_anterior, status, grupo_anterior_id=None, grupo_id=None):
+        dados = {
+            "entidade": entidade, "entidade_id": entidade_id, "orcamento_id": orcamento_id,
+            "grupo_anterior_id": grupo_anterior_id, "grupo_id": grupo_id,
+            "status_anterior": status_anterior, "status": status, "em": agora, "duracao_s": None,
+        }
+        eventos.append(dados)
+        return dados
+
+    for obj in session.new:
+        if isinstance(obj, Orcamento):
+            evento('orcamento', obj.id, obj.id, None, obj.status_atual, grupo_id=obj.grupo_id)
+        elif isinstance(obj, TarefaProducao):
+            evento('tarefa', obj.id, obj.orcamento_id, None, obj.status or TAREFA_STATUS_INICIAL)
+
+    for obj in session.dirty:
+        if isinstance(obj, Orcamento):
+            estado = inspect(obj)
+            grupo_anterior = _valor_anterior(estado, 'grupo_id', obj.grupo_id)
+            status_anterior = _valor_anterior(estado, 'status_atual', obj.status_atual)
+            if grupo_anterior == obj.grupo_id and status_anterior == obj.status_atual:
+                continue
+            dados = evento('orcamento', obj.id, obj.id, status_anterior, obj.status_atual,
+                           grupo_anterior, obj.grupo_id)
+            if grupo_anterior != obj.grupo_id:
+                movidos[obj.id] = dados
+        elif isinstance(obj, TarefaProducao):
+            status_anterior = _valor_anterior(inspect(obj), 'status', obj.status)
+            if status_anterior == obj.status:
+                continue
+            dados = evento('tarefa', obj.id, obj.orcamento_id, status_anterior, obj.status)
+            if obj.status == TAREFA_STATUS_FINAL:
+                finalizadas[obj.id] = (dados, obj.colaborador)
+
+    if not eventos:
+        return
+    conn = session.connection()
+    agregados = {}
+    if movidos:
+        for orcamento_id, inicio in _inicio_etapas(conn, list(movidos)).items():
+            dados = movidos[orcamento_id]
+            dados["duracao_s"] = max(int((agora - inicio).total_seconds()), 0)
+            _acumular(agregados, 'grupo', str(dados["grupo_anterior_id"]), agora, dados["duracao_s"])
+    if finalizadas:
+        for tarefa_id, inicio in _inicio_ciclos(conn, list(finalizadas)).items():
+            dados, colaborador = finalizadas[tarefa_id]
+            dados["duracao_s"] = max(int((agora - inicio).total_seconds()), 0)
+            _acumular(agregados, 'ciclo_tarefa', colaborador, agora, dados["duracao_s"])
+
+    conn.execute(db.insert(TransicaoStatus), eventos)
+    add_duration_rollups(conn, agregados)
+
+def duration_stats(metrica, de=None, ate=None, chaves=None):
+    """
+    {chave: {quantidade, media/mediana/p90 em horas}} lendo só o rollup (tamanho
+    limitado a chaves x meses x baldes, independente do tamanho do histórico).
+    """
+    consulta = (
+        db.select(EstatisticaDuracao.chave, EstatisticaDuracao.balde,
+                  db.func.sum(EstatisticaDuracao.quantidade), db.func.sum(EstatisticaDuracao.soma_s))
+        .where(EstatisticaDuracao.metrica == metrica)
+        .group_by(EstatisticaDuracao.chave, EstatisticaDuracao.balde)
+        .order_by(EstatisticaDuracao.chave, EstatisticaDuracao.balde)
+    )
+    if de:
+        consulta = consulta.where(EstatisticaDuracao.periodo >= de)
+    if ate:
+        consulta = consulta.where(EstatisticaDuracao.periodo <= ate)
+    if chaves is not None:
+        consulta = consulta.where(EstatisticaDuracao.chave.in_(chaves))
+
+    por_chave = {}
+    for chave, balde, quantidade, soma in db.session.execute(consulta):
+        por_chave.setdefault(chave, []).append((balde, quantidade, soma))
+
+    horas = lambda segundos: round(segundos / 3600, 1) if segundos is not None else None
+    resultado = {}
+    for chave, linhas in por_chave.items():
+        baldes = [(balde, quantidade) for balde, quantidade, _ in linhas]
+        total = sum(quantidade for _, quantidade, _ in linhas)
+        resultado[chave] = {
+            "quantidade": total,
+            "media_horas": horas(sum(soma for _, _, soma in linhas) / total),
+            "mediana_horas": horas(quantil_histograma(baldes, 0.5)),
+            "p90_horas": horas(quantil_histograma(baldes, 0.9)),
+        }
+    return resultado
+
+def parse_periodos(args):
+    """(de, ate) no formato 'AAAA-MM' a partir da query string. ValueError se inválidos."""
+    periodos = []
+    for nome in ('de', 'ate'):
+        valor = args.get(nome)
+        if valor and not re.fullmatch(r'\d{4}-(0[1-9]|1[0-2])', valor):
+            raise ValueError(f"'{nome}' deve estar no formato AAAA-MM")
+        periodos.append(valor or None)
+    return tuple(periodos)
+
+
+# --- Agenda de Produção (Carga por Colaborador) ---
+
+# (NOVO) Esforço de um item sem linha em EstimativaItem e capacidade de quem não tem CapacidadeColaborador
+AGENDA_HORAS_PADRAO = float(os.environ.get('AGENDA_HORAS_PADRAO', '8'))
+AGENDA_CAPACIDADE_PADRAO = float(os.environ.get('AGENDA_CAPACIDADE_PADRAO', '8'))
+# Folga (em dias úteis) abaixo da qual o prazo fica em 'atencao'
+AGENDA_MARGEM_DIAS = int(os.environ.get('AGENDA_MARGEM_DIAS', '1'))
+# Fração do esforço que ainda falta em cada status da tarefa (os demais contam inteiros)
+AGENDA_RESTANTE_POR_STATUS = {
+    'Iniciou a Produção': 0.6,
+    'Reforma em Andamento': 0.5,
+    'Fase de Acabamento': 0.2,
+}
+# Tarefas fora da fila: concluídas ou pausadas
+AGENDA_STATUS_FORA = (TAREFA_STATUS_FINAL, 'StandBy')
+
+TarefaAgenda = namedtuple('TarefaAgenda', 'id orcamento_id colaborador item status numero cliente limite entrada')
+
+def proximo_dia_util(dia):
+    while dia.weekday() >= 5:
+        dia += timedelta(days=1)
+    return dia
+
+def somar_dias_uteis(inicio, dias):
+    """'dias' dias úteis depois de 'inicio' (que já deve ser dia útil), sem iterar dia a dia."""
+    semanas, resto = divmod(dias, 5)
+    dia = inicio + timedelta(weeks=semanas)
+    while resto:
+        dia += timedelta(days=1)
+        if dia.weekday() < 5:
+            resto -= 1
+    return dia
+
+def dias_uteis_entre(inicio, fim):
+    """Dias úteis de 'inicio' (exclusive) até 'fim' (inclusive); negativo se 'fim' vem antes. Sem iterar dia a dia."""
+    def ate(dia):
+        # Dias úteis de 01/01/0001 (uma segunda-feira, ordinal 1) até 'dia'
+        semanas, resto = divmod(dia.toordinal(), 7)
+        return semanas * 5 + min(resto, 5)
+    return ate(fim) - ate(inicio)
+
+def prioridade_agenda(tarefa):
+    # Prazo mais próximo primeiro (EDF); sem prazo vai para o fim, depois por entrada na produção
+    return (
+        tarefa.limite or date.max,
+        tarefa.entrada or datetime.max,
+        tarefa.orcamento_id,
+        tarefa.id,
+    )
+
+def schedule_colaborador(tarefas, capacidade, estimativas, hoje):
+    """
+    Fila de um colaborador: executa as tarefas em ordem de prioridade, uma após a
+    outra, 'capacidade' horas por dia útil a partir de 'hoje'.
+    Retorna ({tarefa_id: (orcamento_id, data_prevista)}, horas_pendentes).
+    """
+    capacidade = capacidade if capacidade and capacidade > 0 else AGENDA_CAPACIDADE_PADRAO
+    acumulado = 0.0
+    fins = {}
+    datas = {} # várias tarefas terminam no mesmo dia
+    for tarefa in sorted(tarefas, key=prioridade_agenda):
+        horas = estimativas.get(tarefa.item, AGENDA_HORAS_PADRAO)
+        acumulado += horas * AGENDA_RESTANTE_POR_STATUS.get(tarefa.status, 1.0)
+        # Termina no dia útil em que o acumulado cabe na capacidade (dia 0 = hoje)
+        dias = max(math.ceil(acumulado / capacidade - 1e-9), 1) - 1
+        if dias not in datas:
+            datas[dias] = somar_dias_uteis(hoje, dias)
+        fins[tarefa.id] = (tarefa.orcamento_id, datas[dias])
+    return fins, acumulado
+
+def risco_prazo(conclusao, limite):
+    if limite is None:
+        return 'sem_prazo', None
+    # Folga em dias úteis, a mesma unidade da agenda e do AGENDA_MARGEM_DIAS
+    folga = dias_uteis_entre(conclusao, limite)
+    if folga < 0:
+        return 'atrasado', folga
+    if folga <= AGENDA_MARGEM_DIAS:
+        return 'atencao', folga
+    return 'ok', folga
+
+class WorkloadScheduler:
+    """
+    Agenda de produção deste worker, mantida em memória.
+    Cada colaborador tem uma fila independente, então uma mudança só recalcula
+    as filas dos colaboradores envolvidos: as linhas alteradas vêm do feed
+    BoardChange desde a última versão calculada. Recalcula tudo apenas na virada
+    do dia, quando estimativas/capacidades mudam ou quando o feed não cobre o intervalo.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versao = None
+        self._hoje = None
+        self._config = None
+        self._estimativas = {}
+        self._capacidades = {}
+        self._filas = {} # colaborador -> {"fins", "horas", "orcamentos", "tarefas"}
+        self._resultado = None
+        self.ultimo_calculo = None
+
+    def snapshot(self):
+        with self._lock:
+            inicio = time.perf_counter()
+            versao = get_board_version()
+            hoje = proximo_dia_util(datetime.utcnow().date())
+            config = self._config_signature()
+
+            if (self._versao is None or hoje != self._hoje or config != self._config
+                    or versao < self._versao or versao - self._versao > BOARD_CHANGES_RETENCAO):
+                self._recalcular_tudo(hoje, config)
+                tipo, recalculados = 'completo', len(self._filas)
+            elif versao != self._versao:
+                recalculados = self._recalcular_alterados(self._versao, versao)
+                tipo = 'incremental'
+            else:
+                tipo, recalculados = 'cache', 0
+
+            if tipo != 'cache' or self._resultado is None:
+                self._resultado = self._montar()
+            self._versao = versao
+            self.ultimo_calculo = {
+                "tipo": tipo,
+                "colaboradores_recalculados": recalculados,
+                "ms": round((time.perf_counter() - inicio) * 1000, 2),
+            }
+            return dict(self._resultado, versao=versao, calculo=self.ultimo_calculo)
+
+    def _config_signature(self):
+        return tuple(db.session.execute(db.select(
+            db.select(db.func.count()).select_from(EstimativaItem).scalar_subquery(),
+            db.select(db.func.max(EstimativaItem.atualizado_em)).scalar_subquery(),
+            db.select(db.func.count()).select_from(CapacidadeColaborador).scalar_subquery(),
+            db.select(db.func.max(CapacidadeColaborador.atualizado_em)).scalar_subquery(),
+        )).one())
+
+    def _carregar_tarefas(self, colaboradores=None):
+        """Tarefas abertas dos orçamentos ativos da Linha de Produção (só as colunas usadas)."""
+        consulta = (
+            db.select(
+                TarefaProducao.id, TarefaProducao.orcamento_id, TarefaProducao.colaborador,
+                TarefaProducao.item_descricao, TarefaProducao.status,
+                Orcamento.numero, Orcamento.cliente,
+                Orcamento.data_limite_producao, Orcamento.data_entrada_producao,
+            )
+            .join(Orcamento, TarefaProducao.orcamento_id == Orcamento.id)
+            .where(
+                Orcamento.grupo_id == grupos_cache.id('Linha de Produção'),
+                Orcamento.arquivado.is_(False),
+                db.or_(TarefaProducao.status.is_(None), TarefaProducao.status.notin_(AGENDA_STATUS_FORA)),
+            )
+        )
+        if colaboradores is not None:
+            consulta = consulta.where(TarefaProducao.colaborador.in_(colaboradores))
+        por_colaborador = {c: [] for c in (colaboradores or ())}
+        for linha in db.session.execute(consulta):
+            limite = linha.data_limite_producao.date() if linha.data_limite_producao else None
+            por_colaborador.setdefault(linha.colaborador, []).append(TarefaAgenda(
+                linha.id, linha.orcamento_id, linha.colaborador, linha.item_descricao, linha.status,
+                linha.numero, linha.cliente, limite, linha.data_entrada_producao
+            ))
+        return por_colaborador
+
+    def _calcular_fila(self, tarefas, colaborador):
+        fins, horas = schedule_colaborador(
+            tarefas, self._capacidades.get(colaborador), self._estimativas, self._hoje
+        )
+        return {
+            "fins": fins,
+            "horas": horas,
+            "orcamentos": {t.orcamento_id: (t.numero, t.cliente, t.limite) for t in tarefas},
+        }
+
+    def _recalcular_tudo(self, hoje, config):
+        self._hoje = hoje
+        self._config = config
+        self._estimativas = dict(db.session.execute(db.select(EstimativaItem.item_descricao, EstimativaItem.horas)).all())
+        self._capacidades = dict(db.session.execute(
+            db.select(CapacidadeColaborador.colaborador, CapacidadeColaborador.horas_por_dia)
+        ).all())
+        self._filas = {
+            colaborador: self._calcular_fila(tarefas, colaborador)
+            for colaborador, tarefas in self._carregar_tarefas().items()
+        }
+
+    def _recalcular_alterados(self, desde, ate):
+        mudancas = db.session.execute(
+            db.select(BoardChange.entidade, BoardChange.entidade_id)
+            .where(BoardChange.versao > desde, BoardChange.versao <= ate,
+                   BoardChange.entidade.in_(('tarefa', 'orcamento')))
+        ).all()
+        tarefa_ids = {i for entidade, i in mudancas if entidade == 'tarefa'}
+        orcamento_ids = {i for entidade, i in mudancas if entidade == 'orcamento'}
+        if not tarefa_ids and not orcamento_ids:
+            return 0
+
+        # Quem tinha a tarefa/orçamento na fila calculada (cobre removidas e saídas da Linha)...
+        afetados = {
+            colaborador for colaborador, fila in self._filas.items()
+            if tarefa_ids & fila["fins"].keys() or orcamento_ids & fila["orcamentos"].keys()
+        }
+        # ...e quem tem agora (cobre tarefas novas e orçamentos que entraram na Linha)
+        condicoes = []
+        if tarefa_ids:
+            condicoes.append(TarefaProducao.id.in_(tarefa_ids))
+        if orcamento_ids:
+            condicoes.append(TarefaProducao.orcamento_id.in_(orcamento_ids))
+        afetados.update(db.session.scalars(
+            db.select(TarefaProducao.colaborador).where(db.or_(*condicoes)).distinct()
+        ))
+
+        for colaborador, tarefas in self._carregar_tarefas(afetados).items():
+            if tarefas:
+                self._filas[colaborador] = self._calcular_fila(tarefas, colaborador)
+            else:
+                self._filas.pop(colaborador, None)
+        return len(afetados)
+
+    def _montar(self):
+        conclusao = {}
+        info = {}
+        for fila in self._filas.values():
+            info.update(fila["orcamentos"])
+            for orcamento_id, fim in fila["fins"].values():
+                if orcamento_id not in conclusao or fim > conclusao[orcamento_id]:
+                    conclusao[orcamento_id] = fim
+
+        orcamentos = []
+        for orcamento_id, fim in conclusao.items():
+            numero, cliente, limite = info[orcamento_id]
+            risco, folga = risco_prazo(fim, limite)
+            orcamentos.append({
+                "id": orcamento_id,
+                "numero": numero,
+                "cliente": cliente,
+                "data_limite_producao": limite.isoformat() if limite else None,
+                "conclusao_prevista": fim.isoformat(),
+                "folga_dias": folga,
+                "risco": risco,
+            })
+        orcamentos.sort(key=lambda o: (o["conclusao_prevista"], o["id"]))
+
+        colaboradores = []
+        for colaborador, fila in sorted(self._filas.items()):
+            capacidade = self._capacidades.get(colaborador) or AGENDA_CAPACIDADE_PADRAO
+            atrasadas = sum(
+                1 for orcamento_id, fim in fila["fins"].values()
+                if fila["orcamentos"][orcamento_id][2] and fim > fila["orcamentos"][orcamento_id][2]
+            )
+            colaboradores.append({
+                "colaborador": colaborador,
+                "capacidade_dia": capacidade,
+                "tarefas": len(fila["fins"]),
+                "horas_pendentes": round(fila["horas"], 1),
+                "dias_de_fila": math.ceil(fila["horas"] / capacidade) if fila["horas"] else 0,
+                "livre_em": max(fim for _, fim in fila["fins"].values()).isoformat() if fila["fins"] else None,
+                "tarefas_atrasadas": atrasadas,
+                "sobrecarregado": atrasadas > 0,
+            })
+
+        return {
+            "hoje": self._hoje.isoformat(),
+            "colaboradores": colaboradores,
+            "orcamentos": orcamentos,
+        }
+
+workload_scheduler = WorkloadScheduler()
+
+
+# --- Relatórios e Exportação (NOVO) ---
+
+EXPORT_LOTE = 1000 # linhas por fetch do cursor e por pedaço da resposta
+# Postgres: quanto tempo um download lento pode deixar a transação do cursor parada
+EXPORT_IDLE_TIMEOUT_MS = int(os.environ.get('EXPORT_IDLE_TIMEOUT_MS', 600000))
+
+EXPORT_FORMATOS = {
+    'csv': 'text/csv; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+# Datas do orçamento pelas quais os relatórios podem ser filtrados (?data=)
+RELATORIO_CAMPOS_DATA = ('data_entrada_producao', 'data_pronto', 'data_instalacao', 'data_visita')
+
+FiltroRelatorio = namedtuple('FiltroRelatorio', 'de ate grupo_id campo_data')
+
+def _dias_entre(inicio, fim, dialeto):
+    """Dias (fracionários) entre duas colunas DateTime, em SQL."""
+    if dialeto == 'postgresql':
+        return db.extract('epoch', fim - inicio) / 86400.0
+    return db.func.julianday(fim) - db.func.julianday(inicio)
+
+def _inicio_semana(coluna, dialeto):
+    """Segunda-feira da semana de uma coluna DateTime, em SQL."""
+    if dialeto == 'postgresql':
+        return db.cast(db.func.date_trunc('week', coluna), db.Date)
+    # SQLite: avança até o próximo domingo (ou fica nele) e volta 6 dias
+    return db.func.date(coluna, 'weekday 0', '-6 days')
+
+def _filtro_periodo(coluna, filtros):
+    condicoes = []
+    if filtros.de:
+        condicoes.append(coluna >= datetime.combine(filtros.de, datetime.min.time()))
+    if filtros.ate:
+        # 'ate' inclusivo: até o fim do dia
+        condicoes.append(coluna < datetime.combine(filtros.ate + timedelta(days=1), datetime.min.time()))
+    return condicoes
+
+def _data_iso(valor):
+    return valor.strftime('%Y-%m-%d') if valor else None
+
+def relatorio_orcamentos(filtros, dialeto):
+    """Uma linha por orçamento, com o lead time da produção (entrada -> pronto) e o progresso."""
+    cabecalho = [
+        'id', 'numero', 'cliente', 'grupo', 'status', 'arquivado',
+        'data_entrada_producao', 'data_limite_producao', 'data_pronto', 'data_instalacao',
+        'dias_entrada_ate_pronto', 'tarefas_total', 'tarefas_finalizadas',
+    ]
+    consulta = (
+        db.select(
+            Orcamento.id, Orcamento.numero, Orcamento.cliente, Grupo.nome, Orcamento.status_atual,
+            Orcamento.arquivado, Orcamento.data_entrada_producao, Orcamento.data_limite_producao,
+            Orcamento.data_pronto, Orcamento.data_instalacao,
+            Orcamento.tarefas_total, Orcamento.tarefas_finalizadas,
+        )
+        .join(Grupo, Grupo.id == Orcamento.grupo_id)
+        .where(*_filtro_periodo(getattr(Orcamento, filtros.campo_data), filtros))
+        .order_by(Orcamento.id)
+    )
+    if filtros.grupo_id:
+        consulta = consulta.where(Orcamento.grupo_id == filtros.grupo_id)
+
+    def linha(r):
+        dias = None
+        if r.data_entrada_producao and r.data_pronto:
+            dias = round((r.data_pronto - r.data_entrada_producao).total_seconds() / 86400, 1)
+        return [
+            r.id, r.numero, r.cliente, r.nome, r.status_atual, 'sim' if r.arquivado else 'não',
+            _data_iso(r.data_entrada_producao), _data_iso(r.data_limite_producao),
+            _data_iso(r.data_pronto), _data_iso(r.data_instalacao),
+            dias, r.tarefas_total, r.tarefas_finalizadas,
+        ]
+    return cabecalho, consulta, linha
+
+def relatorio_grupos(filtros, dialeto):
+    """Orçamentos por grupo e o lead time médio da produção dos que já ficaram prontos."""
+    cabecalho = ['grupo', 'orcamentos', 'arquivados', 'com_data_pronto', 'media_dias_entrada_ate_pronto']
+    # Os filtros ficam no JOIN para os grupos vazios também aparecerem (com zero)
+    juncao = db.and_(
+        Orcamento.grupo_id == Grupo.id,
+        *_filtro_periodo(getattr(Orcamento, filtros.campo_data), filtros)
+    )
+    dias = _dias_entre(Orcamento.data_entrada_producao, Orcamento.data_pronto, dialeto)
+    consulta = (
+        db.select(
+            Grupo.nome,
+            db.func.count(Orcamento.id),
+            db.func.coalesce(db.func.sum(db.case((Orcamento.arquivado.is_(True), 1), else_=0)), 0),
+            db.func.count(Orcamento.data_pronto),
+            db.func.avg(db.case(
+                (db.and_(Orcamento.data_entrada_producao.isnot(None), Orcamento.data_pronto.isnot(None)), dias)
+            )),
+        )
+        .select_from(Grupo)
+        .outerjoin(Orcamento, juncao)
+        .group_by(Grupo.id, Grupo.nome, Grupo.ordem)
+        .order_by(Grupo.ordem)
+    )
+    if filtros.grupo_id:
+        consulta = consulta.where(Grupo.id == filtros.grupo_id)
+
+    def linha(r):
+        return [r[0], r[1], r[2], r[3], round(r[4], 1) if r[4] is not None else None]
+    return cabecalho, consulta, linha
+
+def relatorio_producao_semanal(filtros, dialeto):
+    """Tarefas finalizadas por colaborador por semana (segunda-feira), pela finalizada_em."""
+    cabecalho = ['semana', 'colaborador', 'tarefas_finalizadas']
+    semana = _inicio_semana(TarefaProducao.finalizada_em, dialeto).label('semana')
+    consulta = (
+        db.select(semana, TarefaProducao.colaborador, db.func.count(TarefaProducao.id))
+        .where(TarefaProducao.finalizada_em.isnot(None),
+               *_filtro_periodo(TarefaProducao.finalizada_em, filtros))
+        .group_by(semana, TarefaProducao.colaborador)
+        .order_by(semana, TarefaProducao.colaborador)
+    )
+    if filtros.grupo_id:
+        consulta = consulta.join(Orcamento, Orcamento.id == TarefaProducao.orcamento_id) \
+            .where(Orcamento.grupo_id == filtros.grupo_id)
+
+    def linha(r):
+        return [str(r[0]) if r[0] is not None else None, r[1], r[2]]
+    return cabecalho, consulta, linha
+
+RELATORIOS = {
+    'orcamentos': relatorio_orcamentos,
+    'grupos': relatorio_grupos,
+    'producao-semanal': relatorio_producao_semanal,
+}
+
+def stream_rows(engine, consulta, transformar):
+    """
+    Lotes de linhas já transformadas, lidos de um cursor do lado do servidor (Postgres:
+    cursor nomeado; SQLite: o cursor já é preguiçoso). Sem ORM e sem sessão: a memória
+    não cresce com o tamanho do relatório.
+    """
+    with engine.connect() as conn:
+        if conn.dialect.name == 'postgresql':
+            conn.exec_driver_sql(f"SET LOCAL idle_in_transaction_session_timeout = {EXPORT_IDLE_TIMEOUT_MS}")
+        resultado = conn.execution_options(stream_results=True, yield_per=EXPORT_LOTE).execute(consulta)
+        for lote in resultado.partitions():
+            yield [transformar(linha) for linha in lote]
+
+def csv_chunks(cabecalho, lotes):
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    buffer.write('\ufeff') # BOM: o Excel abre o CSV em UTF-8 (acentos corretos)
+    escritor.writerow(cabecalho)
+    for lote in lotes:
+        escritor.writerows(lote)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate(0)
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+class _SaidaStream:
+    # Destino (não pesquisável) do zipfile: acumula os bytes até o gerador repassá-los
+    def __init__(self):
+        self._partes = []
+
+    def write(self, dados):
+        self._partes.append(bytes(dados))
+        return len(dados)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        dados = b''.join(self._partes)
+        self._partes.clear()
+        return dados
+
+# Caracteres que o XML 1.0 não aceita (controle, exceto tab/quebras de linha)
+_XML_INVALIDOS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+def _xlsx_celula(valor):
+    if valor is None:
+        return '<c/>'
+    if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+        return f'<c t="n"><v>{valor}</v></c>'
+    texto = xml_escape(_XML_INVALIDOS.sub('', str(valor)))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{texto}</t></is></c>'
+
+def _xlsx_linha(valores):
+    return '<row>' + ''.join(_xlsx_celula(v) for v in valores) + '</row>'
+
+_XLSX_PARTES = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    ),
+}
+
+def xlsx_chunks(cabecalho, lotes, nome_planilha):
+    """
+    Planilha .xlsx mínima (uma aba, textos inline) escrita em streaming: o zip é gerado
+    com data descriptors, então cada lote de linhas sai comprimido sem voltar no arquivo.
+    """
+    saida = _SaidaStream()
+    with zipfile.ZipFile(saida, 'w', compression=zipfile.ZIP_DEFLATED) as pacote:
+        for nome, conteudo in _XLSX_PARTES.items():
+            pacote.writestr(nome, conteudo)
+        pacote.writestr('xl/workbook.xml', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f'<sheets><sheet name="{xml_escape(nome_planilha[:31])}" sheetId="1" r:id="rId1"/></sheets>'
+            '</workbook>'
+        ))
+        with pacote.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as planilha:
+            planilha.write((
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+                + _xlsx_linha(cabecalho)
+            ).encode('utf-8'))
+            for lote in lotes:
+                planilha.write(''.join(_xlsx_linha(linha) for linha in lote).encode('utf-8'))
+                yield saida.drain()
+            planilha.write(b'</sheetData></worksheet>')
+    yield saida.drain()
+
+def parse_report_filters(args):
+    """FiltroRelatorio a partir da query string (?de=&ate=&grupo_id=&data=). ValueError se inválida."""
+    def data(nome):
+        valor = args.get(nome)
+        if not valor:
+            return None
+        try:
+            return datetime.strptime(valor, '%Y-%m-%d').date()
+        except ValueError:
+            raise ValueError(f"'{nome}' deve estar no formato AAAA-MM-DD")
+
+    campo_data = args.get('data', 'data_entrada_producao')
+    if campo_data not in RELATORIO_CAMPOS_DATA:
+        raise ValueError(f"'data' deve ser um de: {', '.join(RELATORIO_CAMPOS_DATA)}")
+    filtros = FiltroRelatorio(data('de'), data('ate'), args.get('grupo_id', type=int), campo_data)
+    if filtros.de and filtros.ate and filtros.de > filtros.ate:
+        raise ValueError("'de' deve ser anterior a 'ate'")
+    return filtros
+
+
+# --- Inicialização do Worker (NOVO) ---
+
+# Preparação feita UMA vez por worker, antes de atender: no post_worker_init do gunicorn
+# (gunicorn.conf.py), no 'python app.py' e, como garantia em outros servidores, na primeira
+# requisição. As migrações rodam antes, uma vez por deploy ('flask migrate' no on_starting
+# do gunicorn); o worker só confere se o banco está na versão de esquema do código.
+# Com STARTUP_AQUECER_QUADRO=1 o worker já monta o snapshot do quadro (primeiro /api/workflow rápido).
+STARTUP_AQUECER_QUADRO = os.environ.get('STARTUP_AQUECER_QUADRO', '0') == '1'
+STARTUP_NOVA_TENTATIVA = 5 # s entre tentativas enquanto o worker não fica pronto (ex.: banco fora do ar)
+
+class WorkerStartup:
+    """
+    Etapas da inicialização do worker, cada uma cronometrada. Uma falha (banco fora,
+    esquema desatualizado, grupos faltando) deixa o worker "não pronto": o /healthz e as
+    rotas respondem 503 e a inicialização é tentada de novo a cada STARTUP_NOVA_TENTATIVA.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ultima_tentativa = None
+        self.pronto = False
+        self.etapas = {}
+        self.esquema = None
+        self.erro = None
+        self.total_ms = None
+
+    def ensure_ready(self):
+        """Em toda requisição: depois que o worker fica pronto é só o teste do booleano. Retorna se está pronto."""
+        if self.pronto:
+            return True
+        if self._ultima_tentativa is None or time.monotonic() - self._ultima_tentativa >= STARTUP_NOVA_TENTATIVA:
+            return self.run(intervalo=STARTUP_NOVA_TENTATIVA)
+        return False
+
+    def run(self, intervalo=0):
+        with self._lock:
+            if self.pronto:
+                return True
+            # Quem esperava o lock enquanto outra requisição tentava não tenta de novo logo em seguida
+            if self._ultima_tentativa is not None and time.monotonic() - self._ultima_tentativa < intervalo:
+                return False
+            self._ultima_tentativa = time.monotonic()
+            self.etapas, self.erro = {}, None
+            inicio = time.perf_counter()
+            try:
+                with app.app_context():
+                    for nome, etapa in (
+                        ("armazenamento", self._preparar_armazenamento),
+                        ("esquema", self._verificar_esquema),
+                        ("caches", self._aquecer_caches),
+                        ("threads", self._iniciar_threads),
+                    ):
+                        inicio_etapa = time.perf_counter()
+                        etapa()
+                        self.etapas[nome] = round((time.perf_counter() - inicio_etapa) * 1000, 1)
+            except Exception as e:
+                self.erro = str(e)
+                app.logger.error(f"Worker {os.getpid()} não está pronto: {e}")
+                return False
+            self.total_ms = round((time.perf_counter() - inicio) * 1000, 1)
+            self.pronto = True
+            app.logger.info(
+                f"Worker {os.getpid()} pronto: importação {TEMPO_IMPORTACAO_MS:.0f} ms, "
+                f"inicialização {self.total_ms:.0f} ms {self.etapas}"
+            )
+            return True
+
+    def _preparar_armazenamento(self):
+        pasta = app.config['UPLOAD_FOLDER']
+        os.makedirs(os.path.join(pasta, BLOB_FOLDER), exist_ok=True)
+        os.makedirs(os.path.join(pasta, PREVIA_FOLDER), exist_ok=True)
+        if not os.access(pasta, os.W_OK):
+            raise RuntimeError(f"Sem permissão de escrita em {pasta}")
+
+    def _verificar_esquema(self):
+        versao = db.session.scalar(db.select(SchemaVersion.versao).where(SchemaVersion.id == SCHEMA_VERSION_ID))
+        if versao is None or versao < SCHEMA_VERSION:
+            raise RuntimeError(
+                f"Banco na versão de esquema {versao or 0}, o código precisa da {SCHEMA_VERSION}: execute 'flask migrate'"
+            )
+        if versao > SCHEMA_VERSION:
+            # Código anterior sobre um banco já migrado (rollback do deploy): as migrações só acrescentam
+            app.logger.warning(f"Banco na versão de esquema {versao}, mais nova que a do código ({SCHEMA_VERSION}).")
+        self.esquema = versao
+
+    def _aquecer_caches(self):
+        grupos_cache.invalidate()
+        usados = set(MOVE_DEFAULTS) | {regra['grupo'] for regra in WORKFLOW_TRANSITIONS}
+        faltando = sorted(nome for nome in usados if grupos_cache.id(nome) is None)
+        if faltando:
+            raise RuntimeError(f"Grupos não encontrados ({', '.join(faltando)}): execute 'flask init-db'")
+        if STARTUP_AQUECER_QUADRO:
+            board_bodies(get_board_version())
+
+    def _iniciar_threads(self):
+        notification_dispatcher.ensure_started()
+        preview_worker.ensure_started()
+        metricas.ensure_started()
+
+worker_startup = WorkerStartup()
+
+@app.before_request
+def ensure_worker_ready():
+    pronto = worker_startup.ensure_ready()
+    # O /healthz mostra o próprio 503 com os detalhes; os estáticos não dependem do banco
+    if pronto or request.endpoint in ('healthz', 'static'):
+        return None
+    return jsonify({"error": "Servidor inicializando, tente novamente em instantes"}), 503, \
+        {'Retry-After': str(STARTUP_NOVA_TENTATIVA)}
+
+@app.route('/healthz')
+def healthz():
+    """Prontidão do worker (health check do Render): inicialização, banco e threads de fundo."""
+    corpo = {
+        "worker": os.getpid(),
+        "pronto": worker_startup.pronto,
+        "esquema": worker_startup.esquema,
+        "importacao_ms": TEMPO_IMPORTACAO_MS,
+        "inicializacao_ms": worker_startup.total_ms,
+        "etapas": worker_startup.etapas,
+    }
+    if not worker_startup.pronto:
+        corpo["erro"] = worker_startup.erro
+        return jsonify(corpo), 503
+    try:
+        inicio = time.perf_counter()
+        db.session.execute(db.select(1))
+        corpo["banco_ms"] = round((time.perf_counter() - inicio) * 1000, 1)
+    except Exception as e:
+        db.session.rollback()
+        corpo.update(pronto=False, erro=f"Banco indisponível: {e}")
+        return jsonify(corpo), 503
+    # Recria threads do dispatcher e das prévias que tenham morrido (antes isso era verificado a cada requisição)
+    notification_dispatcher.ensure_started()
+    preview_worker.ensure_started()
+    return jsonify(corpo)
+
+
+# --- Rota Principal (Frontend) ---
+
+@app.route('/')
+def index():
+    return render_template('index.html')
+
+# --- Rotas da API ---
+
+# (NOVO) Arquivo de Instalados: depois de tantos dias instalado, o orçamento sai do quadro
+ARQUIVO_DIAS = int(os.environ.get('ARQUIVO_DIAS', '30'))
+ARQUIVO_PAGINA = 50
+ARQUIVO_PAGINA_MAX = 200
+
+def load_board(compacto=False):
+    """
+    Carrega o quadro inteiro em um número fixo de consultas (grupos, orçamentos,
+    tarefas e arquivos), independente da quantidade de orçamentos.
+    Com compacto=True os cartões vão como listas de valores e os nomes dos campos
+    uma vez só, em "campos".
+    """
+    grupos = db.session.execute(db.select(Grupo.id, Grupo.nome).order_by(Grupo.ordem)).all()
+
+    # Orçamentos arquivados ficam de fora: o tamanho do quadro acompanha o trabalho ativo, não o histórico
+    cartoes = serialize_orcamentos(Orcamento.arquivado.is_(False), compacto=compacto)
+
+    # Grupos com arquivados (uma sondagem no índice por grupo) para o frontend oferecer "Ver arquivados"
+    com_arquivados = set(db.session.scalars(
+        db.select(Grupo.id).where(
+            db.select(Orcamento.id)
+            .where(Orcamento.arquivado.is_(True), Orcamento.grupo_id == Grupo.id)
+            .exists()
+        )
+    ))
+
+    por_grupo = {grupo_id: [] for grupo_id, _ in grupos}
+    indice_grupo = ORCAMENTO_CAMPOS.index("grupo_id")
+    for cartao in cartoes:
+        grupo_id = cartao[indice_grupo] if compacto else cartao["grupo_id"]
+        if grupo_id in por_grupo:
+            por_grupo[grupo_id].append(cartao)
+
+    quadro = [
+        {
+            "id": grupo_id,
+            "nome": nome,
+            "orcamentos": por_grupo[grupo_id],
+            "tem_arquivados": grupo_id in com_arquivados
+        }
+        for grupo_id, nome in grupos
+    ]
+    if not compacto:
+        return quadro
+    return {
+        "campos": {
+            "orcamento": ORCAMENTO_CAMPOS,
+            "tarefa": TAREFA_CAMPOS,
+            "arquivo": ARQUIVO_CAMPOS,
+            "progresso": PROGRESSO_CAMPOS,
+        },
+        "grupos": quadro,
+    }
+
+def load_archived_page(grupo_id, antes=None, limite=ARQUIVO_PAGINA):
+    """
+    Uma página de orçamentos arquivados do grupo, do mais novo para o mais antigo.
+    Paginação por chave (id < antes) no índice ix_orcamento_quadro: o custo de cada
+    página não depende de quantas páginas vieram antes.
+    """
+    condicao = db.and_(Orcamento.arquivado.is_(True), Orcamento.grupo_id == grupo_id)
+    if antes is not None:
+        condicao = db.and_(condicao, Orcamento.id < antes)
+    # Busca um a mais só para saber se existe próxima página
+    cartoes = serialize_orcamentos(condicao, ordem=(Orcamento.id.desc(),), limite=limite + 1)
+    proximo = cartoes[limite - 1]["id"] if len(cartoes) > limite else None
+    return {
+        "orcamentos": cartoes[:limite],
+        "proximo": proximo
+    }
+
+def load_board_changes(since, versao):
+    """
+    Monta o delta entre a versão 'since' e a versão atual: apenas as linhas que
+    mudaram, já no formato do /api/workflow. Listas vazias são omitidas.
+    """
+    mudancas = (
+        BoardChange.query
+        .filter(BoardChange.versao > since, BoardChange.versao <= versao)
+        .order_by(BoardChange.versao, BoardChange.id)
+        .all()
+    )
+
+    # Estado final de cada linha no intervalo (apenas 'existe' ou 'removida' importa)
+    ultimas = {}
+    for m in mudancas:
+        ultimas[(m.entidade, m.entidade_id)] = (m.orcamento_id, m.acao)
+
+    orcamento_ids = set()
+    orcamentos_removidos = []
+    tarefa_ids, tarefas_removidas = set(), []
+    arquivo_ids, arquivos_removidos = set(), []
+    for (entidade, entidade_id), (orcamento_id, acao) in ultimas.items():
+        if entidade == 'orcamento':
+            if acao == 'deleted':
+                orcamentos_removidos.append(entidade_id)
+            else:
+                orcamento_ids.add(entidade_id)
+        elif entidade == 'tarefa':
+            if acao == 'deleted':
+                tarefas_removidas.append({"id": entidade_id, "orcamento_id": orcamento_id})
+            else:
+                tarefa_ids.add(entidade_id)
+        elif entidade == 'arquivo':
+            if acao == 'deleted':
+                arquivos_removidos.append({"id": entidade_id, "orcamento_id": orcamento_id})
+            else:
+                arquivo_ids.add(entidade_id)
+
+    orcamentos = []
+    if orcamento_ids:
+        # Arquivar tira o orçamento do quadro: para o cliente é uma remoção
+        orcamentos_removidos += sorted(db.session.scalars(
+            db.select(Orcamento.id).where(Orcamento.id.in_(orcamento_ids), Orcamento.arquivado.is_(True))
+        ))
+        orcamentos = serialize_orcamentos(
+            db.and_(Orcamento.id.in_(orcamento_ids), Orcamento.arquivado.is_(False))
+        )
+
+    # Tarefas/arquivos de orçamentos que já vão inteiros no delta não precisam ir separados
+    tarefas = []
+    if tarefa_ids:
+        tarefas = TarefaProducao.query.filter(
+            TarefaProducao.id.in_(tarefa_ids),
+            TarefaProducao.orcamento_id.notin_(orcamento_ids)
+        ).all()
+    arquivos = []
+    if arquivo_ids:
+        arquivos = ArquivoAnexado.query.filter(
+            ArquivoAnexado.id.in_(arquivo_ids),
+            ArquivoAnexado.orcamento_id.notin_(orcamento_ids)
+        ).all()
+
+    delta = {
+        "versao": versao,
+        "orcamentos": orcamentos,
+        "orcamentos_removidos": orcamentos_removidos,
+        "tarefas": [dict(t.to_dict(), orcamento_id=t.orcamento_id) for t in tarefas],
+        "tarefas_removidas": tarefas_removidas,
+        "arquivos": [dict(a.to_dict(), orcamento_id=a.orcamento_id) for a in arquivos],
+        "arquivos_removidos": arquivos_removidos,
+    }
+    return {chave: valor for chave, valor in delta.items() if valor or chave == "versao"}
+
+@app.route('/api/workflow/changes', methods=['GET'])
+def get_workflow_changes():
+    since = request.args.get('since', type=int)
+    if since is None:
+        return jsonify({"error": "Parâmetro 'since' é obrigatório"}), 400
+
+    versao = get_board_version()
+    # Versão desconhecida (banco reiniciado) ou mais antiga que o feed guardado: recarregar tudo
+    if since > versao or since < versao - BOARD_CHANGES_RETENCAO:
+        return jsonify({"versao": versao, "full": True})
+    if since == versao:
+        return jsonify({"versao": versao})
+
+    return jsonify(load_board_changes(since, versao))
+
+@app.route('/api/grupo/<int:grupo_id>/arquivados', methods=['GET'])
+def get_grupo_arquivados(grupo_id):
+    if grupos_cache.nome(grupo_id) is None:
+        return jsonify({"error": "Grupo não encontrado"}), 404
+    antes = request.args.get('antes', type=int)
+    limite = min(max(request.args.get('limite', ARQUIVO_PAGINA, type=int), 1), ARQUIVO_PAGINA_MAX)
+    return jsonify(load_archived_page(grupo_id, antes, limite))
+
+@app.route('/api/search', methods=['GET'])
+def search():
+    consulta = request.args.get('q', '')
+    limite = min(max(request.args.get('limite', BUSCA_LIMITE, type=int), 1), BUSCA_LIMITE_MAX)
+    return jsonify({"resultados": search_orcamentos(db.session.connection(), consulta, limite)})
+
+@app.route('/api/orcamento/<int:orc_id>', methods=['GET'])
+def get_orcamento(orc_id):
+    # Usado pela busca para abrir orçamentos que não estão no quadro (ex.: arquivados)
+    orcamento = db.session.get(Orcamento, orc_id)
+    if not orcamento:
+        return jsonify({"error": "Orçamento não encontrado"}), 404
+    dados = orcamento.to_dict()
+    dados["arquivado"] = orcamento.arquivado
+    return jsonify(dados)
+
+@app.route('/api/db/pool', methods=['GET'])
+def get_db_pool_stats():
+    return jsonify(db_pool_stats())
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Formato de exposição do Prometheus, somando todos os workers (ver render_metrics)
+    if METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+        return jsonify({"error": "Não autorizado"}), 401
+    return Response(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/workflow', methods=['GET'])
+def get_workflow():
+    # ?formato=compacto: nomes dos campos uma vez só e cartões como listas (ver load_board)
+    compacto = request.args.get('formato') == 'compacto'
+    versao = get_board_version()
+    # Negociada antes do corpo existir: o ETag depende dela e o 304 não monta nada. Um quadro
+    # abaixo de COMPRESS_MIN_BYTES vai sem compressão, mas sempre igual para a mesma tag
+    negociada = negotiate_encoding()
+    etag = board_etag(versao, compacto, negociada)
+
+    # O cliente já tem esta versão nesta codificação: responde 304 sem montar nada
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        corpos = board_bodies(versao, compacto)
+        codificacao = negociada if len(corpos[None]) >= COMPRESS_MIN_BYTES else None
+        # A compressão também fica no snapshot: cada versão é comprimida uma vez por codificação
+        if codificacao not in corpos:
+            corpos[codificacao] = compress_body(corpos[None], codificacao)
+        response = app.response_class(corpos[codificacao], mimetype='application/json')
+        if codificacao:
+            response.headers['Content-Encoding'] = codificacao
+
+    response.vary.add('Accept-Encoding')
+    response.set_etag(etag)
+    response.headers['X-Board-Version'] = str(versao)
+    # Obriga o navegador a revalidar (If-None-Match) a cada carregamento
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+# --- Canal de Eventos (SSE) ---
+
+# Intervalo com que cada worker consulta a versão do quadro no banco
+SSE_POLL_INTERVAL = float(os.environ.get('SSE_POLL_INTERVAL', '1.0'))
+# Comentário enviado quando não há eventos, para manter a conexão viva em proxies
+SSE_HEARTBEAT = 15
+# Depois disso a conexão é encerrada e o EventSource reconecta (com Last-Event-ID),
+# liberando a thread do worker periodicamente
+SSE_MAX_DURACAO = 300
+
+def format_sse(data, event=None, event_id=None):
+    linhas = []
+    if event_id is not None:
+        linhas.append(f"id: {event_id}")
+    if event:
+        linhas.append(f"event: {event}")
+    linhas.append(f"data: {data}")
+    return "\n".join(linhas) + "\n\n"
+
+def board_event_payload(desde, versao):
+    """Evento 'board': o delta entre duas versões ou {"full": true} quando não há como montar o delta."""
+    if desde is None or desde > versao or desde < versao - BOARD_CHANGES_RETENCAO:
+        evento = {"versao": versao, "full": True}
+    else:
+        evento = load_board_changes(desde, versao)
+    evento["desde"] = desde
+    return json.dumps(evento, ensure_ascii=False)
+
+class BoardEventBroker:
+    """
+    Distribui as mudanças do quadro para as conexões SSE deste worker.
+    Uma única thread por worker observa a versão no banco (funciona com vários
+    workers do gunicorn sem broker externo) e monta o delta UMA vez por versão.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._versao = None
+        self._evento = None
+        self._thread = None
 
-    def to_dict(self):
-        return {
-            "id": self.id,
-            "nome_arquivo": self.nome_arquivo,
-            # (MODIFICADO) A URL é gerada dinamicamente
-            "url": f"/uploads/{self.nome_arquivo}"
-        }
+    def ensure_started(self):
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='board-events', daemon=True)
+                self._thread.start()
 
-# --- Rota Principal (Frontend) ---
+    def _run(self):
+        with app.app_context():
+            while True:
+                try:
+                    versao = get_board_version()
+                    if versao != self._versao:
+                        evento = board_event_payload(self._versao, versao) if self._versao is not None else None
+                        with self._cond:
+                            self._versao = versao
+                            self._evento = evento
+                            self._cond.notify_all()
+                except Exception as e:
+                    app.logger.error(f"Erro ao observar versão do quadro: {e}")
+                finally:
+                    # Não segura transação/snapshot aberto entre as consultas
+                    db.session.remove()
+                time.sleep(SSE_POLL_INTERVAL)
 
-@app.route('/')
-def index():
-    return render_template('index.html')
+    def wait(self, ultima_versao, timeout):
+        """Retorna (versao, payload) do próximo evento depois de 'ultima_versao', ou None no timeout."""
+        with self._cond:
+            if self._evento is None or self._versao == ultima_versao:
+                self._cond.wait(timeout)
+            if self._evento is None or self._versao == ultima_versao:
+                return None
+            return self._versao, self._evento
 
-# --- Rotas da API ---
+board_events = BoardEventBroker()
 
-@app.route('/api/workflow', methods=['GET'])
-def get_workflow():
-    grupos = Grupo.query.order_by(Grupo.ordem).all()
-    workflow_data = []
-    for grupo in grupos:
-        orcamentos_data = [o.to_dict() for o in grupo.orcamentos]
-        # Ordenar orçamentos dentro do grupo (opcional, mas bom para consistência)
-        # ... (lógica de ordenação se necessário) ...
-        workflow_data.append({
-            "id": grupo.id,
-            "nome": grupo.nome,
-            "orcamentos": orcamentos_data
-        })
-    return jsonify(workflow_data)
+@app.route('/api/stream')
+def stream_board_events():
+    board_events.ensure_started()
+
+    versao_atual = get_board_version()
+    ultima_versao = request.headers.get('Last-Event-ID', type=int)
+    if ultima_versao is None:
+        ultima_versao = request.args.get('lastEventId', type=int)
+
+    # Reconexão: o cliente perdeu eventos, manda o delta desde a última versão que ele viu
+    evento_inicial = None
+    if ultima_versao is not None and ultima_versao != versao_atual:
+        evento_inicial = format_sse(board_event_payload(ultima_versao, versao_atual), 'board', versao_atual)
+    ultima_versao = versao_atual
+    db.session.remove()
+
+    def gerar(ultima_versao):
+        yield "retry: 3000\n\n"
+        if evento_inicial:
+            yield evento_inicial
+        limite = time.monotonic() + SSE_MAX_DURACAO
+        while time.monotonic() < limite:
+            evento = board_events.wait(ultima_versao, SSE_HEARTBEAT)
+            if evento is None:
+                yield ": heartbeat\n\n"
+                continue
+            ultima_versao, payload = evento
+            yield format_sse(payload, 'board', ultima_versao)
+
+    response = Response(gerar(ultima_versao), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # Desliga o buffer do proxy (nginx/Render)
+    return response
 
 # ATUALIZADO: Rota de criação manual
 @app.route('/api/orcamento/create_manual', methods=['POST'])
 def create_orcamento_manual():
+    staged = StagedFiles(app.config['UPLOAD_FOLDER'])
     try:
         # Pega dados do formulário (request.form)
         numero = request.form.get('numero_orcamento')
@@ -296,23 +3829,16 @@ def create_orcamento_manual():
             status_atual='Orçamento Aprovado'
         )
         db.session.add(novo_orcamento)
-        db.session.commit() # Salva para obter o ID
+        db.session.flush() # Obtém o ID sem commit: orçamento, anexo e tarefas entram juntos
 
         # Processa o arquivo (se houver)
         if 'arquivo' in request.files:
             file = request.files['arquivo']
             if file and file.filename != '':
                 safe_filename = secure_filename(file.filename)
-                # (MODIFICADO) Salva no UPLOAD_FOLDER configurado
-                target_path = os.path.join(app.config['UPLOAD_FOLDER'], safe_filename)
-                file.save(target_path)
-                
-                anexo = ArquivoAnexado(
-                    orcamento_id=novo_orcamento.id,
-                    nome_arquivo=safe_filename
-                    # (MODIFICADO) Não salva mais o caminho
-                )
-                db.session.add(anexo)
+                # (MODIFICADO) Conteúdo vai para o armazenamento por hash
+                sha256, tamanho = staged.stage(file.stream, UPLOAD_MAX_BYTES)
+                attach_blob(novo_orcamento.id, safe_filename, sha256, tamanho)
 
         # Processa os ITENS DE PRODUÇÃO
         if production_items_json:
@@ -330,9 +3856,7 @@ def create_orcamento_manual():
                 )
                 db.session.add(tarefa)
 
-        db.session.commit() # Salva o anexo e as tarefas
-        
-        # --- (NOVO) Notificação ---
+        # --- (NOVO) Notificação (entra na mesma transação) ---
         itens_str = ", ".join(items_list) if items_list else "Nenhum"
         # (NOVO) ATUALIZAÇÃO DE TEMPLATE
         message = (
@@ -343,11 +3867,20 @@ def create_orcamento_manual():
         )
         send_whatsapp_notification(message, [PHONE_ADMIN])
         # --- Fim Notificação ---
+
+        bump_board_version()
+        db.session.commit() # Salva o orçamento, o anexo, as tarefas e a notificação
+        staged.commit()
         
         return jsonify(novo_orcamento.to_dict()), 201
 
+    except UploadRejeitado as e:
+        db.session.rollback()
+        staged.discard()
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         db.session.rollback()
+        staged.discard()
         return jsonify({"error": str(e)}), 500
 
 
@@ -360,29 +3893,19 @@ def upload_orcamento():
     if file.filename == '' or not file.filename.endswith('.zip'):
         return jsonify({"error": "Arquivo inválido, envie um .zip"}), 400
 
-    json_data = None
-    pdf_files = []
-    
     # (NOVO) Para notificação
     itens_producao_desc = []
+    
+    # PDFs vão para temporários e só ganham o nome final depois do commit
+    staged = StagedFiles(app.config['UPLOAD_FOLDER'])
 
     try:
-        with zipfile.ZipFile(file, 'r') as zf:
-            for filename in zf.namelist():
-                if filename.endswith('.json'):
-                    with zf.open(filename) as f:
-                        json_data = json.load(f)
-                elif filename.endswith('.pdf'):
-                    safe_filename = secure_filename(os.path.basename(filename))
-                    # (MODIFICADO) Salva no UPLOAD_FOLDER configurado
-                    target_path = os.path.join(app.config['UPLOAD_FOLDER'], safe_filename)
-                    with open(target_path, 'wb') as f:
-                        f.write(zf.read(filename))
-                    # (MODIFICADO) Salva apenas o nome do arquivo
-                    pdf_files.append({"nome": safe_filename})
+        json_data, pdf_files = parse_upload_zip(file, staged)
 
         if not json_data:
+            staged.discard()
             return jsonify({"error": "Arquivo .json não encontrado no .zip"}), 400
+        validate_upload_data(json_data)
 
         novo_orcamento = Orcamento(
             numero=json_data.get('numero_orcamento', 'N/A'),
@@ -393,15 +3916,10 @@ def upload_orcamento():
             etapa2_descricao=json_data.get('itens_etapa_2', '')
         )
         db.session.add(novo_orcamento)
-        db.session.commit()
+        db.session.flush() # Obtém o ID sem commit: orçamento, anexos e tarefas entram juntos
         
         for pdf in pdf_files:
-            anexo = ArquivoAnexado(
-                orcamento_id=novo_orcamento.id,
-                nome_arquivo=pdf['nome']
-                # (MODIFICADO) Não salva mais o caminho
-            )
-            db.session.add(anexo)
+            attach_blob(novo_orcamento.id, pdf['nome'], pdf['sha256'], pdf['tamanho'])
 
         # Lógica de Tarefas (Upload ZIP usa o mapa antigo e detalhado)
         if 'tarefas_producao' in json_data:
@@ -419,9 +3937,7 @@ def upload_orcamento():
                 )
                 db.session.add(tarefa)
         
-        db.session.commit()
-        
-        # --- (NOVO) Notificação ---
+        # --- (NOVO) Notificação (entra na mesma transação) ---
         itens_str = ", ".join(itens_producao_desc) if itens_producao_desc else "Nenhum"
         # (NOVO) ATUALIZAÇÃO DE TEMPLATE
         message = (
@@ -433,12 +3949,34 @@ def upload_orcamento():
         send_whatsapp_notification(message, [PHONE_ADMIN])
         # --- Fim Notificação ---
         
+        bump_board_version()
+        db.session.commit()
+        staged.commit()
+        
         return jsonify(novo_orcamento.to_dict()), 201
 
+    except (UploadRejeitado, zipfile.BadZipFile, json.JSONDecodeError) as e:
+        db.session.rollback()
+        staged.discard()
+        return jsonify({"error": f"Arquivo .zip inválido: {e}"}), 400
     except Exception as e:
         db.session.rollback()
+        staged.discard()
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/upload/lote', methods=['POST'])
+def upload_orcamentos_lote():
+    """(NOVO) Vários .zip de uma vez (campo 'files'); um resultado por arquivo."""
+    arquivos = [(f.filename or '', f) for f in request.files.getlist('files')]
+    if not arquivos:
+        return jsonify({"error": "Nenhum arquivo enviado"}), 400
+    resultados = import_zip_bundles(arquivos)
+    return jsonify({
+        "importados": sum(1 for r in resultados if r.erro is None),
+        "falhas": sum(1 for r in resultados if r.erro is not None),
+        "resultados": [r._asdict() for r in resultados],
+    })
+
 @app.route('/api/orcamento/<int:orc_id>/add_file', methods=['POST'])
 def add_file_to_orcamento(orc_id):
     orcamento = Orcamento.query.get(orc_id)
@@ -452,32 +3990,77 @@ def add_file_to_orcamento(orc_id):
     if file.filename == '':
         return jsonify({"error": "Nome de arquivo inválido"}), 400
         
+    staged = StagedFiles(app.config['UPLOAD_FOLDER'])
     try:
         safe_filename = secure_filename(file.filename)
-        # (MODIFICADO) Salva no UPLOAD_FOLDER configurado
-        target_path = os.path.join(app.config['UPLOAD_FOLDER'], safe_filename)
-        file.save(target_path)
-        
-        anexo = ArquivoAnexado(
-            orcamento_id=orcamento.id,
-            nome_arquivo=safe_filename
-            # (MODIFICADO) Não salva mais o caminho
-        )
-        db.session.add(anexo)
+        # (MODIFICADO) Conteúdo vai para o armazenamento por hash (repetidos não ocupam disco de novo)
+        sha256, tamanho = staged.stage(file.stream, UPLOAD_MAX_BYTES)
+        anexo = attach_blob(orcamento.id, safe_filename, sha256, tamanho)
+        bump_board_version()
         db.session.commit()
+        staged.commit()
         
         return jsonify(anexo.to_dict()), 201
 
+    except UploadRejeitado as e:
+        db.session.rollback()
+        staged.discard()
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         db.session.rollback()
+        staged.discard()
         return jsonify({"error": str(e)}), 500
 
 
+# (NOVO) Anexos do armazenamento por hash; o nome no fim da URL é só o nome do download
+@app.route('/uploads/blob/<sha256>/<path:nome>')
+def get_blob_file(sha256, nome):
+    if len(sha256) != 64 or not all(c in '0123456789abcdef' for c in sha256):
+        return jsonify({"error": "Arquivo não encontrado"}), 404
+    caminho = blob_path(sha256)
+    if not os.path.isfile(caminho):
+        return jsonify({"error": "Arquivo não encontrado"}), 404
+    # O conteúdo de um hash nunca muda: o próprio hash é o ETag forte e o cache pode ser eterno
+    return serve_attachment(caminho, secure_filename(nome) or sha256, etag=sha256, imutavel=True)
+
+# (NOVO) Miniatura da 1ª página; assim como o blob, nunca muda para o mesmo hash
+@app.route('/uploads/previa/<sha256>.<formato>')
+def get_preview_image(sha256, formato):
+    if len(sha256) != 64 or not all(c in '0123456789abcdef' for c in sha256) or formato not in ('webp', 'png'):
+        return jsonify({"error": "Prévia não encontrada"}), 404
+    caminho = preview_path(sha256, formato)
+    if not os.path.isfile(caminho):
+        return jsonify({"error": "Prévia não encontrada"}), 404
+    return serve_attachment(caminho, f"previa.{formato}", etag=f"previa-{sha256}", imutavel=True)
+
+@app.route('/api/arquivo/<int:arquivo_id>/previa', methods=['GET'])
+def get_arquivo_previa(arquivo_id):
+    """(NOVO) Situação da prévia do anexo, com número de páginas e o texto extraído."""
+    anexo = db.session.get(ArquivoAnexado, arquivo_id)
+    if anexo is None:
+        return jsonify({"error": "Arquivo não encontrado"}), 404
+    previa = anexo.previa if anexo.blob_sha256 else None
+    if previa is None:
+        # Anexo antigo, ainda fora do armazenamento por hash ('flask migrate-uploads')
+        return jsonify({"status": "indisponivel"})
+    return jsonify({
+        "status": previa.status,
+        "previa": preview_url(previa.sha256, previa.formato),
+        "largura": previa.largura,
+        "altura": previa.altura,
+        "paginas": previa.paginas,
+        "texto": previa.texto,
+    })
+
 # (MODIFICADO) Esta rota agora serve arquivos da pasta de upload persistente
 @app.route('/uploads/<path:filename>')
 def get_uploaded_file(filename):
     # Serve arquivos diretamente do UPLOAD_FOLDER configurado (que será o disco persistente)
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    # Anexos antigos podem ser sobrescritos pelo nome: o navegador revalida sempre (ETag/304)
+    caminho = safe_join(app.config['UPLOAD_FOLDER'], filename)
+    if caminho is None or not os.path.isfile(caminho):
+        return jsonify({"error": "Arquivo não encontrado"}), 404
+    return serve_attachment(caminho, os.path.basename(caminho))
 
 
 def parse_datetime(date_str):
@@ -502,159 +4085,16 @@ def update_orcamento_status(orc_id):
     novo_status = data.get('novo_status')
     dados_adicionais = data.get('dados_adicionais', {})
     
-    # --- (NOVO) Captura dados antigos para notificação ---
-    status_antigo = orcamento.status_atual
-    grupo_atual_id = orcamento.grupo_id
-    grupo_antigo_nome = orcamento.grupo.nome
-    # --- Fim Captura ---
-    
-    orcamento.status_atual = novo_status
-    
-    grupos = {g.nome: g.id for g in Grupo.query.all()}
-    g_entrada = grupos.get('Entrada de Orçamento')
-    g_visitas = grupos.get('Visitas e Medidas')
-    g_projetar = grupos.get('Projetar')
-    g_producao = grupos.get('Linha de Produção')
-    g_prontos = grupos.get('Prontos')
-    g_standby = grupos.get('StandBy')
-    g_instalados = grupos.get('Instalados')
-    
-    moveu_para_producao = False
-    
-    # (NOVO) Variáveis de notificação
-    notification_message = None
-    notification_recipients = []
-
-    if grupo_atual_id == g_entrada:
-        # (NOVO) Trigger 2: Mudança no grupo "Entrada"
-        notification_recipients = LISTA_GERAL
-        # (NOVO) ATUALIZAÇÃO DE TEMPLATE
-        notification_message = f"📋 Atualização de Orçamento\n\n👤 Cliente: {orcamento.numero} {orcamento.cliente}\n\n🔄 Mudou o status de: {status_antigo}\n\n➡️ Para: {novo_status}"
-
-        if novo_status == 'Visita Agendada':
-            orcamento.grupo_id = g_visitas
-            orcamento.data_visita = parse_datetime(dados_adicionais.get('data_visita'))
-            orcamento.responsavel_visita = dados_adicionais.get('responsavel_visita')
-        elif novo_status in ['Desenhar', 'Produzir']:
-            orcamento.grupo_id = g_projetar
-        elif novo_status == 'Em Produção':
-            orcamento.grupo_id = g_producao
-            moveu_para_producao = True
-        elif novo_status in ['Aguardando Cliente', 'Aguardando Arq/Eng', 'Aguardando Obra', 'Parado']:
-            orcamento.grupo_id = g_standby
-            orcamento.grupo_origem_standby = grupo_atual_id
-
-    elif grupo_atual_id == g_visitas:
-        if novo_status == 'Mandar para Produção':
-            orcamento.grupo_id = g_projetar
-        elif novo_status == 'Em Produção':
-            orcamento.grupo_id = g_producao
-            moveu_para_producao = True
-        elif novo_status == 'Instalado':
-            etapa = dados_adicionais.get('etapa_instalada')
-            if etapa == 'Etapa 1':
-                orcamento.grupo_id = g_visitas
-                orcamento.status_atual = 'Agendar Visita'
-            elif etapa == 'Etapa 2':
-                orcamento.grupo_id = g_instalados
-                orcamento.status_atual = 'Instalado'
-
-    elif grupo_atual_id == g_projetar:
-        if novo_status == 'Aprovado para Produção':
-            orcamento.grupo_id = g_producao
-            moveu_para_producao = True
-        elif novo_status == 'StandBy':
-            orcamento.grupo_id = g_standby
-            orcamento.grupo_origem_standby = grupo_atual_id
-
-    elif grupo_atual_id == g_producao:
-        if novo_status == 'StandBy':
-            orcamento.grupo_id = g_standby
-            orcamento.grupo_origem_standby = grupo_atual_id
-
-    elif grupo_atual_id == g_prontos:
-        if novo_status == 'Instalação Agendada':
-            orcamento.data_instalacao = parse_datetime(dados_adicionais.get('data_instalacao'))
-            orcamento.responsavel_instalacao = dados_adicionais.get('responsavel_instalacao')
-        elif novo_status == 'StandBy':
-            orcamento.grupo_id = g_standby
-            orcamento.grupo_origem_standby = grupo_atual_id
-        elif novo_status == 'Instalado':
-            etapa = dados_adicionais.get('etapa_instalada')
-            if etapa == 'Etapa 1':
-                orcamento.grupo_id = g_visitas
-                orcamento.status_atual = 'Agendar Visita'
-            elif etapa == 'Etapa 2':
-                orcamento.grupo_id = g_instalados
-                orcamento.status_atual = 'Instalado'
-
-    elif grupo_atual_id == g_standby:
-        # (NOVO) Trigger 7: Mudança no grupo "Standby"
-        notification_recipients = LISTA_GERAL
-        # (NOVO) ATUALIZAÇÃO DE TEMPLATE
-        notification_message = f"🔄 Atualização de Status\n\n👤 Cliente: {orcamento.numero} {orcamento.cliente}\n\n📍 Mudou o status de: {status_antigo}\n\n➡️ Para: {novo_status}"
-
-        if novo_status == 'Liberado':
-            if orcamento.grupo_origem_standby:
-                orcamento.grupo_id = orcamento.grupo_origem_standby
-            else:
-                orcamento.grupo_id = g_entrada
-            orcamento.grupo_origem_standby = None
-    
-    elif grupo_atual_id == g_instalados:
-        # (NOVO) Trigger 7: Mudança no grupo "Instalados"
-        notification_recipients = LISTA_GERAL
-        # (NOVO) ATUALIZAÇÃO DE TEMPLATE
-        notification_message = f"🔄 Atualização de Status\n\n👤 Cliente: {orcamento.numero} {orcamento.cliente}\n\n📍 Mudou o status de: {status_antigo}\n\n➡️ Para: {novo_status}"
-            
-    if moveu_para_producao:
-        orcamento.data_entrada_producao = parse_datetime(dados_adicionais.get('data_entrada'))
-        orcamento.data_limite_producao = parse_datetime(dados_adicionais.get('data_limite'))
-        for tarefa in orcamento.tarefas:
-            tarefa.status = 'Não Iniciado'
+    # Transição de grupo, campos e notificação vêm da tabela WORKFLOW_TRANSITIONS
+    notification_message = apply_status_transition(orcamento, novo_status, dados_adicionais)
     
     try:
-        db.session.commit()
-        
-        # --- (NOVO) Lógica de Notificação Pós-Commit ---
+        # Notificação gravada na mesma transação da mudança
+        if notification_message:
+            send_whatsapp_notification(notification_message, LISTA_GERAL)
         
-        # (Trigger 2) Complemento - Checa se moveu de grupo
-        if notification_message and grupo_atual_id == g_entrada and orcamento.grupo_id != grupo_atual_id:
-            grupo_novo_nome = orcamento.grupo.nome
-            # (NOVO) ATUALIZAÇÃO DE TEMPLATE (MOVIMENTO)
-            notification_message = f"📋 Atualização de Orçamento\n\n👤 Cliente: {orcamento.numero} {orcamento.cliente}\n\n🔄 Mudou o status de: {status_antigo}\n\n➡️ Para: {novo_status}\n\n📁 E foi movido para o grupo: {grupo_novo_nome}"
-
-        # (Trigger 3) Agendamento de Visita
-        if novo_status == 'Visita Agendada':
-            data_visita_fmt = orcamento.data_visita.strftime('%d/%m %H:%M') if orcamento.data_visita else 'N/A'
-            # (NOVO) ATUALIZAÇÃO DE TEMPLATE
-            notification_message = f"📆 Visita Agendada!\n\n👤 Cliente: {orcamento.numero} {orcamento.cliente}\n\n📍 Data: {data_visita_fmt}\n\n👷 Responsável: {orcamento.responsavel_visita}"
-            notification_recipients = LISTA_GERAL
-
-        # (Trigger 4) Agendamento de Instalação
-        elif novo_status == 'Instalação Agendada':
-            data_inst_fmt = orcamento.data_instalacao.strftime('%d/%m %H:%M') if orcamento.data_instalacao else 'N/A'
-            # (NOVO) ATUALIZAÇÃO DE TEMPLATE
-            notification_message = f"🔧 Instalação Agendada!\n\n👤 Cliente: {orcamento.numero} {orcamento.cliente}\n\n📍 Data: {data_inst_fmt}\n\n👷 Responsável: {orcamento.responsavel_instalacao}"
-            notification_recipients = LISTA_GERAL
-        
-        # (Trigger 6) Instalação Concluída
-        elif novo_status == 'Instalado' and (grupo_atual_id == g_visitas or grupo_atual_id == g_prontos):
-            etapa = dados_adicionais.get('etapa_instalada', 'N/A')
-            etapa_num = "1ª" if etapa == 'Etapa 1' else "2ª"
-            resp_inst = orcamento.responsavel_instalacao or 'N/A'
-            # (NOVO) ATUALIZAÇÃO DE TEMPLATE
-            notification_message = f"🎉 Instalação Concluída!\n\n👤 Cliente: {orcamento.numero} {orcamento.cliente}\n\n🔧 Etapa: {etapa_num} Etapa\n\n👷 Responsável: {resp_inst}"
-            
-            if etapa == 'Etapa 1':
-                 notification_message += "\n\n📁 Movido para Visitas e Medidas — agendar a visita para medidas da segunda etapa."
-                 
-            notification_recipients = LISTA_GERAL
-        
-        # Envia a notificação se houver
-        if notification_message and notification_recipients:
-            send_whatsapp_notification(notification_message, notification_recipients)
-        # --- Fim Notificação ---
+        bump_board_version()
+        db.session.commit()
         
         return jsonify(orcamento.to_dict())
     except Exception as e:
@@ -662,6 +4102,62 @@ def update_orcamento_status(orc_id):
         return jsonify({"error": str(e)}), 500
 
 
+def apply_tarefa_status_changes(novos_status):
+    """
+    Aplica {tarefa_id: novo_status} na sessão atual (sem commit) e devolve os
+    orçamentos afetados. A promoção para Prontos (todas as tarefas finalizadas)
+    é decidida pelos contadores do orçamento, sem percorrer as tarefas, e sai UMA
+    notificação por orçamento com todas as tarefas alteradas.
+    Tarefas que não existem são ignoradas.
+    """
+    tarefas = TarefaProducao.query.filter(TarefaProducao.id.in_(novos_status)).all()
+
+    eventos_por_orcamento = {}
+    for tarefa in tarefas:
+        novo_status = novos_status[tarefa.id]
+        eventos = eventos_por_orcamento.setdefault(tarefa.orcamento_id, [])
+        if tarefa.status == novo_status:
+            continue # Nada muda: não gera notificação repetida
+        tarefa.status = novo_status
+        if novo_status in TAREFA_NOTIFICATION_TEMPLATES:
+            eventos.append({
+                "tarefa_id": tarefa.id,
+                "status": novo_status,
+                "colaborador": tarefa.colaborador,
+                "item": tarefa.item_descricao,
+                "movido_prontos": False
+            })
+    if not eventos_por_orcamento:
+        return []
+
+    # Carrega os orçamentos antes do flush (os contadores são atualizados nele) e,
+    # depois do flush, uma consulta relê os contadores de todos de uma vez
+    consulta = (
+        Orcamento.query
+        .options(db.selectinload(Orcamento.tarefas), db.selectinload(Orcamento.arquivos))
+        .filter(Orcamento.id.in_(eventos_por_orcamento))
+        .order_by(Orcamento.id)
+    )
+    consulta.all()
+    db.session.flush()
+    orcamentos = consulta.all()
+
+    grupo_prontos_id = grupos_cache.id('Prontos')
+    for orcamento in orcamentos:
+        if orcamento.producao_concluida():
+            if grupo_prontos_id and orcamento.grupo_id != grupo_prontos_id:
+                orcamento.grupo_id = grupo_prontos_id
+                orcamento.data_pronto = datetime.utcnow()
+                orcamento.status_atual = 'Agendar Instalação/Entrega'
+            for evento in eventos_por_orcamento[orcamento.id]:
+                evento["movido_prontos"] = True
+
+        # --- (NOVO) Notificação de Tarefa (Trigger 5) ---
+        # Várias tarefas (e cliques em sequência, ver NOTIFY_JANELA_AGRUPAMENTO) viram uma única mensagem
+        send_tarefa_notification(orcamento, eventos_por_orcamento[orcamento.id], LISTA_GERAL)
+        # --- Fim Notificação ---
+    return orcamentos
+
 @app.route('/api/tarefa/<int:tarefa_id>/status', methods=['PUT'])
 def update_tarefa_status(tarefa_id):
     tarefa = TarefaProducao.query.get(tarefa_id)
@@ -669,57 +4165,160 @@ def update_tarefa_status(tarefa_id):
         return jsonify({"error": "Tarefa não encontrada"}), 404
         
     novo_status = request.json.get('status')
-    
-    # (NOVO) Captura dados para notificação
     orcamento = tarefa.orcamento
-    numero = orcamento.numero
-    cliente = orcamento.cliente
-    colaborador = tarefa.colaborador
-    item = tarefa.item_descricao
-    notification_message = None
-    
-    tarefa.status = novo_status
+
+    # Status da tarefa, promoção para Prontos e notificação em uma única transação
+    apply_tarefa_status_changes({tarefa.id: novo_status})
+    bump_board_version()
     db.session.commit()
-    
-    todas_prontas = True
-    if not orcamento.tarefas:
-        todas_prontas = False
-        
-    for t in orcamento.tarefas:
-        if t.status != 'Produção Finalizada':
-            todas_prontas = False
-            break
-            
-    if todas_prontas:
-        grupo_prontos = Grupo.query.filter_by(nome='Prontos').first()
-        if grupo_prontos and orcamento.grupo_id != grupo_prontos.id:
-            orcamento.grupo_id = grupo_prontos.id
-            orcamento.data_pronto = datetime.utcnow()
-            orcamento.status_atual = 'Agendar Instalação/Entrega'
-            db.session.commit()
-            
-    # --- (NOVO) Notificação de Tarefa (Trigger 5) ---
-    if novo_status == 'Iniciou a Produção':
-        notification_message = f"⚙️ Início de Produção\n\n👤 Cliente: {numero} {cliente}\n\n🧑‍🏭 Responsável: {colaborador}\n\n🚀 Itens iniciados: {item}"
-    elif novo_status == 'Fase de Acabamento':
-        notification_message = f"🛠️ Atualização de Produção\n\n👤 Cliente: {numero} {cliente}\n\n🧑‍🏭 Responsável: {colaborador}\n\n🎨 Itens em fase de acabamento: {item}"
-    elif novo_status == 'Produção Finalizada':
-        notification_message = f"✅ Produção Concluída!\n\n👤 Cliente: {numero} {cliente}\n\n🧑‍🏭 Responsável: {colaborador}\n\n📦 Itens finalizados: {item}"
-        if todas_prontas:
-             notification_message += "\n\n📁 Movido para o grupo: Prontos\n\n📅 Agende uma data de instalação ou entrega."
-    elif novo_status == 'Aguardando Vidro / Pedra':
-        notification_message = f"📦 Aguardando Materiais\n\n👤 Cliente: {numero} {cliente}\n\n🧑‍🏭 Responsável: {colaborador}\n\n🪟 Situação: Aguardando vidro/pedra para iniciar a produção."
-    elif novo_status == 'Reforma em Andamento':
-        notification_message = f"🔨 Reforma em Andamento\n\n👤 Cliente: {numero} {cliente}\n\n🧑‍🏭 Responsável: {colaborador}\n\n🔁 Situação: Reforma em andamento na linha de produção."
-    elif novo_status == 'StandBy':
-        notification_message = f"⏸️ Produção em StandBy\n\n👤 Cliente: {numero} {cliente}\n\n🧑‍🏭 Responsável: {colaborador}\n\n📦 Situação: Projeto pausado temporariamente."
-
-    if notification_message:
-        send_whatsapp_notification(notification_message, LISTA_GERAL)
-    # --- Fim Notificação ---
 
     return jsonify(orcamento.to_dict())
 
+# (NOVO) Várias tarefas de uma vez (ex.: marcar todos os itens como finalizados)
+@app.route('/api/tarefas/status', methods=['PUT'])
+def update_tarefas_status():
+    """Body: {"tarefas": [{"id": 1, "status": "Produção Finalizada"}, ...]}"""
+    itens = (request.json or {}).get('tarefas')
+    if not isinstance(itens, list) or not itens:
+        return jsonify({"error": "Envie a lista 'tarefas' com {id, status}"}), 400
+
+    novos_status = {}
+    for item in itens:
+        if not isinstance(item, dict) or not isinstance(item.get('id'), int) or not item.get('status'):
+            return jsonify({"error": "Cada tarefa precisa de 'id' (inteiro) e 'status'"}), 400
+        novos_status[item['id']] = item['status'] # Repetido: vale o último
+
+    existentes = set(db.session.scalars(
+        db.select(TarefaProducao.id).where(TarefaProducao.id.in_(novos_status))
+    ))
+    faltando = sorted(set(novos_status) - existentes)
+    if faltando:
+        return jsonify({"error": "Tarefas não encontradas", "ids": faltando}), 404
+
+    try:
+        orcamentos = apply_tarefa_status_changes(novos_status)
+        bump_board_version()
+        db.session.commit()
+        return jsonify({"orcamentos": [o.to_dict() for o in orcamentos]})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+
+# (NOVO) Agenda de produção: carga por colaborador e previsão de conclusão da Linha de Produção
+@app.route('/api/schedule', methods=['GET'])
+def get_schedule():
+    agenda = workload_scheduler.snapshot()
+    colaborador = request.args.get('colaborador')
+    risco = request.args.get('risco')
+    if colaborador:
+        agenda["colaboradores"] = [c for c in agenda["colaboradores"] if c["colaborador"] == colaborador]
+    if risco:
+        agenda["orcamentos"] = [o for o in agenda["orcamentos"] if o["risco"] == risco]
+    return jsonify(agenda)
+
+def _parse_horas(valores, campo):
+    """Valida {nome: horas} do corpo da requisição; retorna o dict ou uma mensagem de erro."""
+    if not isinstance(valores, dict) or not valores:
+        return None, f"Envie '{campo}' como {{nome: horas}}"
+    for nome, horas in valores.items():
+        if not nome or isinstance(horas, bool) or not isinstance(horas, (int, float)) or horas <= 0:
+            return None, f"Valor inválido para '{nome}': informe horas maiores que zero"
+    return valores, None
+
+@app.route('/api/schedule/estimativas', methods=['PUT'])
+def update_schedule_estimativas():
+    estimativas, erro = _parse_horas((request.json or {}).get('estimativas'), 'estimativas')
+    if erro:
+        return jsonify({"error": erro}), 400
+    for item, horas in estimativas.items():
+        registro = db.session.get(EstimativaItem, item)
+        if registro:
+            registro.horas = float(horas)
+        else:
+            db.session.add(EstimativaItem(item_descricao=item, horas=float(horas)))
+    db.session.commit()
+    return jsonify({"atualizadas": len(estimativas)})
+
+@app.route('/api/schedule/capacidades', methods=['PUT'])
+def update_schedule_capacidades():
+    capacidades, erro = _parse_horas((request.json or {}).get('capacidades'), 'capacidades')
+    if erro:
+        return jsonify({"error": erro}), 400
+    for colaborador, horas in capacidades.items():
+        registro = db.session.get(CapacidadeColaborador, colaborador)
+        if registro:
+            registro.horas_por_dia = float(horas)
+        else:
+            db.session.add(CapacidadeColaborador(colaborador=colaborador, horas_por_dia=float(horas)))
+    db.session.commit()
+    return jsonify({"atualizadas": len(capacidades)})
+
+@app.route('/api/orcamento/<int:orc_id>/historico', methods=['GET'])
+def get_orcamento_historico(orc_id):
+    if not db.session.get(Orcamento, orc_id):
+        return jsonify({"error": "Orçamento não encontrado"}), 404
+    transicoes = db.session.execute(
+        db.select(TransicaoStatus).where(TransicaoStatus.orcamento_id == orc_id).order_by(TransicaoStatus.id)
+    ).scalars()
+    return jsonify({"transicoes": [t.to_dict() for t in transicoes]})
+
+@app.route('/api/analytics/grupos', methods=['GET'])
+def get_analytics_grupos():
+    """Tempo no grupo (média, mediana, p90) de quem saiu dele no período ?de=AAAA-MM&ate=AAAA-MM."""
+    try:
+        de, ate = parse_periodos(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    estatisticas = duration_stats('grupo', de, ate)
+    grupos = []
+    for chave, dados in sorted(estatisticas.items(), key=lambda item: int(item[0])):
+        grupos.append({"grupo_id": int(chave), "grupo": grupos_cache.nome(int(chave)), **dados})
+    return jsonify({"grupos": grupos})
+
+@app.route('/api/analytics/colaboradores', methods=['GET'])
+def get_analytics_colaboradores():
+    """Tempo de ciclo das tarefas (início do trabalho até finalizada) por colaborador."""
+    try:
+        de, ate = parse_periodos(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    colaborador = request.args.get('colaborador')
+    estatisticas = duration_stats('ciclo_tarefa', de, ate, [colaborador] if colaborador else None)
+    return jsonify({"colaboradores": [
+        {"colaborador": chave, **dados} for chave, dados in sorted(estatisticas.items())
+    ]})
+
+@app.route('/api/export/<relatorio>.<formato>', methods=['GET'])
+def export_report(relatorio, formato):
+    """
+    Relatório em CSV ou XLSX, gerado em streaming direto do cursor do banco.
+    Filtros: ?de=AAAA-MM-DD&ate=AAAA-MM-DD (inclusivos), ?grupo_id=, ?data= (qual data do orçamento).
+    """
+    if relatorio not in RELATORIOS or formato not in EXPORT_FORMATOS:
+        return jsonify({"error": "Relatório ou formato desconhecido",
+                        "relatorios": sorted(RELATORIOS), "formatos": sorted(EXPORT_FORMATOS)}), 404
+    try:
+        filtros = parse_report_filters(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if filtros.grupo_id and grupos_cache.nome(filtros.grupo_id) is None:
+        return jsonify({"error": "Grupo não encontrado"}), 404
+
+    # O gerador roda depois do fim da requisição: pega o engine (e o dialeto) agora
+    engine = db.engine
+    cabecalho, consulta, transformar = RELATORIOS[relatorio](filtros, engine.dialect.name)
+    lotes = stream_rows(engine, consulta, transformar)
+    if formato == 'csv':
+        corpo = csv_chunks(cabecalho, lotes)
+    else:
+        corpo = xlsx_chunks(cabecalho, lotes, relatorio)
+
+    nome_arquivo = f"{relatorio}-{datetime.utcnow().strftime('%Y%m%d')}.{formato}"
+    response = Response(corpo, content_type=EXPORT_FORMATOS[formato])
+    response.headers['Content-Disposition'] = f'attachment; filename="{nome_arquivo}"'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
 @app.route('/api/orcamento/<int:orc_id>/move', methods=['PUT'])
 def move_orcamento(orc_id):
     orcamento = Orcamento.query.get(orc_id)
@@ -731,52 +4330,19 @@ def move_orcamento(orc_id):
     if orcamento.grupo_id == novo_grupo_id:
         return jsonify(orcamento.to_dict())
 
-    # (NOVO) Captura dados para notificação
-    grupo_antigo_nome = orcamento.grupo.nome
-    
-    grupo_destino = Grupo.query.get(novo_grupo_id)
-    if not grupo_destino:
+    if grupos_cache.nome(novo_grupo_id) is None:
         return jsonify({"error": "Grupo de destino não encontrado"}), 404
 
-    # (NOVO) Captura nome do novo grupo
-    grupo_novo_nome = grupo_destino.nome
-    
-    orcamento.grupo_id = novo_grupo_id
-    
-    if grupo_destino.nome == 'Entrada de Orçamento':
-        orcamento.status_atual = 'Orçamento Aprovado'
-    elif grupo_destino.nome == 'Visitas e Medidas':
-        orcamento.status_atual = 'Agendar Visita'
-    elif grupo_destino.nome == 'Projetar':
-        orcamento.status_atual = 'Em Desenho'
-    elif grupo_destino.nome == 'Linha de Produção':
-        orcamento.status_atual = 'Não Iniciado' # (Mudança) O status padrão é "Não Iniciado"
-        orcamento.data_entrada_producao = parse_datetime(data.get('data_entrada'))
-        orcamento.data_limite_producao = parse_datetime(data.get('data_limite'))
-        for tarefa in orcamento.tarefas:
-            tarefa.status = 'Não Iniciado'
-    elif grupo_destino.nome == 'Prontos':
-        orcamento.status_atual = 'Agendar Instalação/Entrega'
-        if not orcamento.data_pronto:
-             orcamento.data_pronto = datetime.utcnow()
-    elif grupo_destino.nome == 'StandBy':
-        orcamento.status_atual = 'Parado' # (Mudança) Status padrão de Standby
-        # Bug fix: Nao setar grupo origem se ja estiver em standby
-        if orcamento.grupo_origem_standby is None:
-            # (Correção) Deve pegar o ID do grupo antigo, não o ID do grupo atual (que já é standby)
-            grupo_antigo_id = Grupo.query.filter_by(nome=grupo_antigo_nome).first().id
-            orcamento.grupo_origem_standby = grupo_antigo_id
-    elif grupo_destino.nome == 'Instalados':
-        orcamento.status_atual = 'Instalado'
-        
-    db.session.commit()
+    # Status padrão e campos do grupo de destino vêm de MOVE_DEFAULTS
+    message = apply_manual_move(orcamento, novo_grupo_id, data)
     
     # --- (NOVO) Notificação de Arrastar (Trigger 8) ---
-    # (NOVO) ATUALIZAÇÃO DE TEMPLATE
-    message = f"↔️ Item Movido Manualmente\n\n👤 Cliente: {orcamento.numero} {orcamento.cliente}\n\n📁 Movido de: {grupo_antigo_nome}\n\n➡️ Para: {grupo_novo_nome}"
     send_whatsapp_notification(message, LISTA_GERAL)
     # --- Fim Notificação ---
     
+    bump_board_version()
+    db.session.commit()
+    
     return jsonify(orcamento.to_dict())
 
 # --- NOVO: Rota para adicionar tarefa de produção ---
@@ -801,6 +4367,7 @@ def add_tarefa_to_orcamento(orc_id):
             status='Não Iniciado' # Padrão
         )
         db.session.add(nova_tarefa)
+        bump_board_version()
         db.session.commit()
         return jsonify(nova_tarefa.to_dict()), 201
         
@@ -808,6 +4375,122 @@ def add_tarefa_to_orcamento(orc_id):
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
 
+# --- Dados Sintéticos (NOVO) ---
+
+# Distribuição dos orçamentos sintéticos pelos grupos do init-db (pesos relativos) e os
+# status em que cada grupo costuma ter cartões
+SINTETICO_GRUPOS = {
+    'Entrada de Orçamento': (10, ('Orçamento Aprovado',)),
+    'Visitas e Medidas': (8, ('Agendar Visita', 'Visita Agendada')),
+    'Projetar': (10, ('Em Desenho', 'Desenhar', 'Produzir')),
+    'Linha de Produção': (25, ('Não Iniciado', 'Em Produção')),
+    'Prontos': (8, ('Agendar Instalação/Entrega', 'Instalação Agendada')),
+    'StandBy': (4, ('Parado', 'Aguardando Cliente', 'Aguardando Obra')),
+    'Instalados': (35, ('Instalado',)),
+}
+# Quantidade de tarefas e de PDFs por orçamento -> peso
+SINTETICO_TAREFAS = {1: 10, 2: 20, 3: 25, 4: 20, 5: 12, 6: 8, 8: 5}
+SINTETICO_ANEXOS = {0: 10, 1: 35, 2: 30, 3: 15, 4: 10}
+SINTETICO_TAREFA_STATUS = ('Não Iniciado', 'Iniciou a Produção', 'Fase de Acabamento', 'Aguardando Vidro / Pedra')
+SINTETICO_LOTE = 1000
+
+def generate_synthetic_board(conn, quantidade, semente=42):
+    """
+    Insere 'quantidade' orçamentos sintéticos pelos grupos do init-db, com tarefas dos
+    itens de ITEM_DEFINITIONS_PRODUCAO e anexos em PDF. Inserções em lote pelo Core, sem
+    os hooks do ORM: contadores, arquivamento, finalizada_em e índice de busca são
+    preenchidos aqui. A mesma semente gera os mesmos dados. Devolve os ids criados.
+    """
+    aleatorio = random.Random(semente)
+    grupo_ids = dict(conn.execute(db.select(Grupo.nome, Grupo.id)).all())
+    faltando = [nome for nome in SINTETICO_GRUPOS if nome not in grupo_ids]
+    if faltando:
+        raise ValueError(f"Grupos não encontrados ({', '.join(faltando)}): execute 'flask init-db'")
+
+    nomes_grupos = list(SINTETICO_GRUPOS)
+    pesos_grupos = [peso for peso, _ in SINTETICO_GRUPOS.values()]
+    itens = list(ITEM_DEFINITIONS_PRODUCAO)
+    clientes = ['Hélio', 'José', 'João', 'Antônio', 'Márcia', 'Luíza', 'Conceição', 'André', 'Fábio', 'Ângela']
+    sobrenomes = ['Araújo', 'Simões', 'Gonçalves', 'Silva', 'Pereira', 'Brandão', 'Lima', 'Souza']
+    etapas = ['Churrasqueira', 'Lareira', 'Área gourmet', 'Coifa da cozinha', 'Forno e cooktop']
+    agora = datetime.utcnow()
+    limite_arquivo = agora - timedelta(days=ARQUIVO_DIAS)
+
+    primeiro = (conn.execute(db.select(db.func.max(Orcamento.id))).scalar() or 0) + 1
+    ids = range(primeiro, primeiro + quantidade)
+    for inicio_lote in range(0, quantidade, SINTETICO_LOTE):
+        orcamentos, tarefas, anexos = [], [], []
+        for orcamento_id in ids[inicio_lote:inicio_lote + SINTETICO_LOTE]:
+            grupo = aleatorio.choices(nomes_grupos, pesos_grupos)[0]
+            status_atual = aleatorio.choice(SINTETICO_GRUPOS[grupo][1])
+            entrada = agora - timedelta(days=aleatorio.randrange(1, 720), minutes=aleatorio.randrange(1440))
+            em_producao = grupo in ('Linha de Produção', 'Prontos', 'Instalados')
+            pronto = entrada + timedelta(days=aleatorio.randrange(5, 40)) if grupo in ('Prontos', 'Instalados') else None
+            instalacao = pronto + timedelta(days=aleatorio.randrange(1, 20)) if grupo == 'Instalados' else None
+
+            quantidade_tarefas = aleatorio.choices(list(SINTETICO_TAREFAS), list(SINTETICO_TAREFAS.values()))[0]
+            finalizadas = nao_iniciadas = 0
+            for _ in range(quantidade_tarefas):
+                item = aleatorio.choice(itens)
+                if pronto:
+                    status = TAREFA_STATUS_FINAL
+                elif grupo == 'Linha de Produção':
+                    status = aleatorio.choice(SINTETICO_TAREFA_STATUS + (TAREFA_STATUS_FINAL,))
+                else:
+                    status = TAREFA_STATUS_INICIAL
+                finalizadas += status == TAREFA_STATUS_FINAL
+                nao_iniciadas += status == TAREFA_STATUS_INICIAL
+                tarefas.append({
+                    "orcamento_id": orcamento_id, "item_descricao": item,
+                    "colaborador": ITEM_DEFINITIONS_PRODUCAO[item], "status": status,
+                    "finalizada_em": (pronto or agora) if status == TAREFA_STATUS_FINAL else None,
+                })
+            # Na Linha de Produção sempre falta pelo menos uma (senão estaria em Prontos)
+            if grupo == 'Linha de Produção' and finalizadas == quantidade_tarefas:
+                tarefas[-1].update(status='Fase de Acabamento', finalizada_em=None)
+                finalizadas -= 1
+
+            numero = f"{entrada.year}/{orcamento_id:05d}"
+            for indice in range(aleatorio.choices(list(SINTETICO_ANEXOS), list(SINTETICO_ANEXOS.values()))[0]):
+                anexos.append({"orcamento_id": orcamento_id, "nome_arquivo": f"Projeto_{numero.replace('/', '_')}_{indice + 1}.pdf"})
+
+            orcamentos.append({
+                "id": orcamento_id, "numero": numero, "grupo_id": grupo_ids[grupo], "status_atual": status_atual,
+                "cliente": f"{aleatorio.choice(clientes)} {aleatorio.choice(sobrenomes)}",
+                "etapa1_descricao": aleatorio.choice(etapas),
+                "etapa2_descricao": aleatorio.choice(etapas) if aleatorio.random() < 0.3 else None,
+                "data_visita": entrada - timedelta(days=aleatorio.randrange(1, 15)) if grupo != 'Entrada de Orçamento' else None,
+                "responsavel_visita": aleatorio.choice(clientes) if grupo != 'Entrada de Orçamento' else None,
+                "data_entrada_producao": entrada if em_producao else None,
+                "data_limite_producao": entrada + timedelta(days=aleatorio.randrange(15, 45)) if em_producao else None,
+                "data_pronto": pronto, "data_instalacao": instalacao,
+                "responsavel_instalacao": aleatorio.choice(clientes) if instalacao else None,
+                "grupo_origem_standby": grupo_ids[aleatorio.choice(('Projetar', 'Linha de Produção', 'Prontos'))] if grupo == 'StandBy' else None,
+                "arquivado": bool(instalacao and instalacao < limite_arquivo),
+                "tarefas_total": quantidade_tarefas, "tarefas_finalizadas": finalizadas, "tarefas_nao_iniciadas": nao_iniciadas,
+            })
+
+        conn.execute(db.insert(Orcamento), orcamentos)
+        conn.execute(db.insert(TarefaProducao), tarefas)
+        if anexos:
+            conn.execute(db.insert(ArquivoAnexado), anexos)
+        refresh_search_rows(conn, [orcamento["id"] for orcamento in orcamentos])
+
+    # Nova versão com os orçamentos no feed, como no import_zip_bundles: quem tem o quadro
+    # em cache recebe os cartões novos pelo /api/workflow/changes (tarefas e anexos vêm junto)
+    result = conn.execute(db.update(BoardVersion).where(BoardVersion.id == BOARD_VERSION_ID).values(versao=BoardVersion.versao + 1))
+    if result.rowcount == 0:
+        conn.execute(db.insert(BoardVersion).values(id=BOARD_VERSION_ID, versao=1))
+    versao = conn.execute(db.select(BoardVersion.versao).where(BoardVersion.id == BOARD_VERSION_ID)).scalar()
+    for inicio_lote in range(0, quantidade, SINTETICO_LOTE):
+        conn.execute(db.insert(BoardChange), [
+            {"versao": versao, "entidade": 'orcamento', "entidade_id": orcamento_id,
+             "orcamento_id": orcamento_id, "acao": 'created'}
+            for orcamento_id in ids[inicio_lote:inicio_lote + SINTETICO_LOTE]
+        ])
+    return list(ids)
+
+
 # --- Comandos de CLI para setup ---
 @app.cli.command('init-db')
 def init_db_command():
@@ -824,16 +4507,927 @@ def init_db_command():
     g7 = Grupo(nome='Instalados', ordem=7)
     
     db.session.add_all([g1, g2, g3, g4, g5, g6, g7])
+    db.session.add(BoardVersion(id=BOARD_VERSION_ID, versao=0))
+    # Banco recém-criado já tem o esquema completo
+    db.session.add(SchemaVersion(id=SCHEMA_VERSION_ID, versao=SCHEMA_VERSION))
     db.session.commit()
+    grupos_cache.invalidate()
     print('Banco de dados inicializado e grupos (7) criados.')
 
+@app.cli.command('retry-notifications')
+def retry_notifications_command():
+    """Devolve para a fila as notificações que esgotaram as tentativas (status 'falhou')."""
+    result = db.session.execute(
+        db.update(Notificacao)
+        .where(Notificacao.status == 'falhou')
+        .values(status='pendente', tentativas=0, proxima_tentativa=datetime.utcnow())
+    )
+    db.session.commit()
+    print(f'{result.rowcount} notificações devolvidas para a fila.')
+
+@app.cli.command('generate-previews')
+@click.option('--refazer', is_flag=True, help="Gera de novo as prévias prontas (ex.: mudou PREVIA_LARGURA).")
+def generate_previews_command(refazer):
+    """Gera neste processo as prévias pendentes (anexos antigos, falhas devolvidas para a fila)."""
+    situacoes = ['falhou', 'pronta'] if refazer else ['falhou']
+    db.session.execute(
+        db.update(PreviaArquivo)
+        .where(PreviaArquivo.status.in_(situacoes))
+        .values(status='pendente', tentativas=0, proxima_tentativa=datetime.utcnow())
+    )
+    db.session.commit()
+
+    inicio = time.perf_counter()
+    processadas = 0
+    while preview_worker.process_next():
+        processadas += 1
+        if processadas % 100 == 0:
+            print(f"  {processadas} prévia(s) processada(s)...")
+    por_status = dict(db.session.execute(
+        db.select(PreviaArquivo.status, db.func.count()).group_by(PreviaArquivo.status)
+    ).all())
+    print(f"{processadas} prévia(s) processada(s) em {time.perf_counter() - inicio:.1f}s. "
+          + ", ".join(f"{status}: {quantidade}" for status, quantidade in sorted(por_status.items())))
+
+@app.cli.command('migrate-uploads')
+@click.option('--pasta', 'pastas', multiple=True, help="Pasta extra onde procurar os arquivos antigos.")
+@click.option('--remover-originais', is_flag=True, help="Apaga os arquivos antigos depois de migrados.")
+def migrate_uploads_command(pastas, remover_originais):
+    """Move os anexos antigos (UPLOAD_FOLDER/nome_arquivo, uploads/) para o armazenamento por hash."""
+    run_migrations()
+    pastas_busca = [app.config['UPLOAD_FOLDER'], os.path.join(app.root_path, 'uploads'), *pastas]
+
+    pendentes = {}
+    for anexo in ArquivoAnexado.query.filter(ArquivoAnexado.blob_sha256.is_(None)):
+        pendentes.setdefault(anexo.nome_arquivo, []).append(anexo)
+
+    migrados = anexos_migrados = ausentes = 0
+    blobs_vistos = set()
+    bytes_originais = bytes_armazenados = 0
+    for nome, anexos in pendentes.items():
+        origem = next((os.path.join(p, nome) for p in pastas_busca
+                       if nome and os.path.isfile(os.path.join(p, nome))), None)
+        if origem is None:
+            ausentes += len(anexos)
+            print(f"  Arquivo não encontrado: {nome} ({len(anexos)} anexo(s))")
+            continue
+
+        staged = StagedFiles(app.config['UPLOAD_FOLDER'])
+        try:
+            with open(origem, 'rb') as f:
+                sha256, tamanho = staged.stage(f, os.path.getsize(origem))
+            incref_blob(sha256, tamanho, quantidade=len(anexos))
+            for anexo in anexos:
+                anexo.blob_sha256 = sha256
+            bump_board_version() # As URLs dos anexos mudam
+            db.session.commit()
+            staged.commit()
+        except Exception as e:
+            db.session.rollback()
+            staged.discard()
+            print(f"  Erro ao migrar {nome}: {e}")
+            continue
+
+        migrados += 1
+        anexos_migrados += len(anexos)
+        bytes_originais += tamanho
+        if sha256 not in blobs_vistos:
+            blobs_vistos.add(sha256)
+            bytes_armazenados += tamanho
+        if remover_originais:
+            try:
+                os.remove(origem)
+            except OSError as e:
+                print(f"  Não foi possível apagar {origem}: {e}")
+
+    print(f'{migrados} arquivo(s) migrados ({anexos_migrados} anexo(s)), {ausentes} anexo(s) sem arquivo.')
+    print(f'Conteúdo distinto: {len(blobs_vistos)} blob(s), '
+          f'{bytes_armazenados} de {bytes_originais} bytes após deduplicação.')
+
+@app.cli.command('check-blobs')
+@click.option('--pasta', 'pastas', multiple=True, help="Pasta onde procurar cópias (pelo nome do anexo) dos blobs que faltam.")
+def check_blobs_command(pastas):
+    """Lista os blobs do banco que não estão no disco e restaura os que tiverem cópia idêntica em --pasta."""
+    nomes_por_blob = {}
+    for sha256, nome in db.session.execute(
+        db.select(ArquivoAnexado.blob_sha256, ArquivoAnexado.nome_arquivo).where(ArquivoAnexado.blob_sha256.isnot(None))
+    ):
+        nomes_por_blob.setdefault(sha256, set()).add(nome)
+    ausentes = sorted(sha256 for sha256 in nomes_por_blob if not os.path.isfile(blob_path(sha256)))
+
+    restaurados = 0
+    for sha256 in ausentes:
+        nomes = sorted(nomes_por_blob[sha256])
+        candidatos = [os.path.join(p, nome) for p in pastas for nome in nomes if os.path.isfile(os.path.join(p, nome))]
+        for origem in candidatos:
+            staged = StagedFiles(app.config['UPLOAD_FOLDER'])
+            try:
+                with open(origem, 'rb') as f:
+                    encontrado, _ = staged.stage(f, os.path.getsize(origem))
+                if encontrado != sha256:
+                    # Mesmo nome, outro conteúdo
+                    staged.discard()
+                    continue
+                staged.commit()
+            except OSError as e:
+                staged.discard()
+                print(f"  Erro ao restaurar {sha256} de {origem}: {e}")
+                continue
+            restaurados += 1
+            print(f"  Restaurado {sha256} de {origem}")
+            break
+        else:
+            print(f"  Faltando {sha256} ({', '.join(nomes)})")
+
+    print(f'{len(nomes_por_blob)} blob(s) referenciado(s), {len(ausentes)} ausente(s) no disco, {restaurados} restaurado(s).')
+    if len(ausentes) > restaurados:
+        raise SystemExit(1)
+
+@app.cli.command('import-zips')
+@click.argument('pasta', type=click.Path(exists=True, file_okay=False))
+@click.option('--workers', default=IMPORT_WORKERS, show_default=True, help="Threads de leitura dos .zip.")
+@click.option('--lote', default=IMPORT_LOTE, show_default=True, help="Orçamentos gravados por transação.")
+@click.option('--recursivo', is_flag=True, help="Inclui os .zip das subpastas.")
+def import_zips_command(pasta, workers, lote, recursivo):
+    """Importa todos os .zip de uma pasta (mesmo formato do upload), com um relatório por arquivo."""
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    if recursivo:
+        caminhos = [os.path.join(raiz, nome) for raiz, _, nomes in os.walk(pasta) for nome in nomes]
+    else:
+        caminhos = [os.path.join(pasta, nome) for nome in os.listdir(pasta)]
+    caminhos = sorted(c for c in caminhos if c.endswith('.zip') and os.path.isfile(c))
+    if not caminhos:
+        print(f"Nenhum .zip em {pasta}.")
+        return
+
+    inicio = time.perf_counter()
+    resultados = import_zip_bundles([(c, c) for c in caminhos], workers, lote)
+    duracao = time.perf_counter() - inicio
+
+    falhas = 0
+    for resultado in resultados:
+        nome = os.path.relpath(resultado.arquivo, pasta)
+        if resultado.erro is None:
+            print(f"  OK    {nome}: orçamento #{resultado.orcamento_id} ({resultado.numero} {resultado.cliente})")
+        else:
+            falhas += 1
+            gravado = f" (orçamento #{resultado.orcamento_id} gravado)" if resultado.orcamento_id else ""
+            print(f"  ERRO  {nome}: {resultado.erro}{gravado}")
+    print(f"{len(resultados) - falhas} importado(s), {falhas} com erro, em {duracao:.1f}s.")
+    if falhas:
+        raise SystemExit(1)
+
+@app.cli.command('archive-installed')
+@click.option('--dias', default=ARQUIVO_DIAS, show_default=True, help="Arquiva os instalados há mais de N dias.")
+def archive_installed_command(dias):
+    """Tira do quadro os orçamentos instalados há mais de N dias (sem data de instalação também)."""
+    grupo_instalados_id = grupos_cache.id('Instalados')
+    if grupo_instalados_id is None:
+        print("Grupo 'Instalados' não encontrado.")
+        return
+    limite = datetime.utcnow() - timedelta(days=dias)
+
+    total = 0
+    while True:
+        # Lotes pequenos: cada um é uma versão do quadro e uma transação curta
+        lote = (
+            Orcamento.query
+            .filter(
+                Orcamento.arquivado.is_(False),
+                Orcamento.grupo_id == grupo_instalados_id,
+                db.or_(Orcamento.data_instalacao.is_(None), Orcamento.data_instalacao < limite)
+            )
+            .order_by(Orcamento.id)
+            .limit(500)
+            .all()
+        )
+        if not lote:
+            break
+        for orcamento in lote:
+            orcamento.arquivado = True
+        bump_board_version()
+        db.session.commit()
+        total += len(lote)
+    print(f'{total} orçamento(s) arquivado(s).')
+
+def _contagem_tarefas(condicao=None):
+    # Subconsulta correlacionada: quantas tarefas do orçamento (opcionalmente só as que atendem 'condicao')
+    consulta = db.select(db.func.count(TarefaProducao.id)).where(TarefaProducao.orcamento_id == Orcamento.id)
+    if condicao is not None:
+        consulta = consulta.where(condicao)
+    return consulta.scalar_subquery()
+
+def rebuild_progress_statement():
+    """UPDATE que recalcula os contadores de produção de todos os orçamentos a partir das tarefas."""
+    return db.update(Orcamento).values(
+        tarefas_total=_contagem_tarefas(),
+        tarefas_nao_iniciadas=_contagem_tarefas(db.func.coalesce(TarefaProducao.status, TAREFA_STATUS_INICIAL) == TAREFA_STATUS_INICIAL),
+        tarefas_finalizadas=_contagem_tarefas(TarefaProducao.status == TAREFA_STATUS_FINAL),
+    )
+
+@app.cli.command('reconcile-progress')
+def reconcile_progress_command():
+    """Reconstrói os contadores de produção dos orçamentos e informa onde havia divergência."""
+    esperado = {
+        orcamento_id: (total, nao_iniciadas or 0, finalizadas or 0)
+        for orcamento_id, total, nao_iniciadas, finalizadas in db.session.execute(
+            db.select(
+                TarefaProducao.orcamento_id,
+                db.func.count(TarefaProducao.id),
+                db.func.sum(db.case((db.func.coalesce(TarefaProducao.status, TAREFA_STATUS_INICIAL) == TAREFA_STATUS_INICIAL, 1), else_=0)),
+                db.func.sum(db.case((TarefaProducao.status == TAREFA_STATUS_FINAL, 1), else_=0)),
+            ).group_by(TarefaProducao.orcamento_id)
+        )
+    }
+    divergentes = []
+    for orcamento_id, numero, total, nao_iniciadas, finalizadas in db.session.execute(
+        db.select(Orcamento.id, Orcamento.numero, Orcamento.tarefas_total,
+                  Orcamento.tarefas_nao_iniciadas, Orcamento.tarefas_finalizadas)
+    ):
+        correto = esperado.get(orcamento_id, (0, 0, 0))
+        if (total, nao_iniciadas, finalizadas) != correto:
+            divergentes.append((orcamento_id, numero, (total, nao_iniciadas, finalizadas), correto))
+
+    for orcamento_id, numero, gravado, correto in divergentes:
+        print(f"  Orçamento {orcamento_id} ({numero}): total/não iniciadas/finalizadas {gravado} -> {correto}")
+        # Pelo ORM (e não um UPDATE direto) para o feed do quadro levar o progresso corrigido
+        orcamento = db.session.get(Orcamento, orcamento_id)
+        orcamento.tarefas_total, orcamento.tarefas_nao_iniciadas, orcamento.tarefas_finalizadas = correto
+    if divergentes:
+        bump_board_version()
+        db.session.commit()
+    print(f'{len(divergentes)} orçamento(s) com contadores divergentes corrigido(s).')
+
+@app.cli.command('benchmark-schedule')
+@click.option('--tarefas', default=5000, show_default=True, help="Quantidade de tarefas abertas sintéticas.")
+@click.option('--colaboradores', default=12, show_default=True)
+@click.option('--repeticoes', default=20, show_default=True)
+def benchmark_schedule_command(tarefas, colaboradores, repeticoes):
+    """Mede o cálculo da agenda (completo x uma fila) com dados sintéticos em memória (não usa o banco)."""
+    aleatorio = random.Random(42)
+    hoje = proximo_dia_util(datetime.utcnow().date())
+    itens = list(ITEM_DEFINITIONS_PRODUCAO) or ['Item']
+    estimativas = {item: aleatorio.choice([2, 4, 6, 8, 12, 16]) for item in itens}
+    status = ['Não Iniciado', 'Iniciou a Produção', 'Fase de Acabamento', 'Aguardando Vidro / Pedra']
+
+    por_colaborador = {}
+    for i in range(tarefas):
+        orcamento_id = i // 4 + 1
+        colaborador = f"Colaborador {aleatorio.randrange(colaboradores)}"
+        por_colaborador.setdefault(colaborador, []).append(TarefaAgenda(
+            i + 1, orcamento_id, colaborador, aleatorio.choice(itens), aleatorio.choice(status),
+            str(orcamento_id), f"Cliente {orcamento_id}",
+            hoje + timedelta(days=aleatorio.randrange(1, 90)), None
+        ))
+
+    def medir(funcao):
+        inicio = time.perf_counter()
+        for _ in range(repeticoes):
+            funcao()
+        return (time.perf_counter() - inicio) / repeticoes * 1000
+
+    completo = medir(lambda: [
+        schedule_colaborador(lista, AGENDA_CAPACIDADE_PADRAO, estimativas, hoje)
+        for lista in por_colaborador.values()
+    ])
+    maior = max(por_colaborador.values(), key=len)
+    uma_fila = medir(lambda: schedule_colaborador(maior, AGENDA_CAPACIDADE_PADRAO, estimativas, hoje))
+    print(json.dumps({
+        "tarefas": tarefas,
+        "colaboradores": len(por_colaborador),
+        "maior_fila": len(maior),
+        "recalculo_completo_ms": round(completo, 3),
+        "recalculo_incremental_ms": round(uma_fila, 3),
+    }, indent=2))
+
+@app.cli.command('reindex-search')
+def reindex_search_command():
+    """Reconstrói o índice de busca textual a partir dos orçamentos, tarefas e anexos."""
+    with db.engine.begin() as conn:
+        total = rebuild_search_index(conn)
+    print(f'{total} orçamento(s) indexado(s).')
+
+@app.cli.command('benchmark-search')
+@click.option('--orcamentos', default=50000, show_default=True, help="Quantidade de orçamentos sintéticos.")
+@click.option('--repeticoes', default=50, show_default=True)
+@click.option('--limite-ms', default=20.0, show_default=True, help="Falha se o p95 de alguma consulta passar disso.")
+def benchmark_search_command(orcamentos, repeticoes, limite_ms):
+    """Mede o /api/search (índice FTS5) com dados sintéticos num SQLite em memória (não usa o banco)."""
+    aleatorio = random.Random(42)
+    nomes = ['Hélio', 'José', 'João', 'Antônio', 'Márcia', 'Luíza', 'Conceição', 'André', 'Fábio', 'Ângela', 'Marcos', 'Ana']
+    sobrenomes = ['Araújo', 'Simões', 'Gonçalves', 'Conceição', 'Silva', 'Müller', 'Pereira', 'Brandão', 'Lima', 'Souza']
+    etapas = ['Cozinha', 'Churrasqueira', 'Área gourmet', 'Banheiro suíte', 'Lavanderia', 'Varanda', 'Escritório']
+    itens = list(ITEM_DEFINITIONS_PRODUCAO) or ['Item']
+
+    engine = create_engine('sqlite://')
+    db.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(db.insert(Orcamento), [
+            {"id": i, "numero": f"{2020 + i % 6}-{i:05d}", "grupo_id": 1 + i % 7,
+             "cliente": f"{aleatorio.choice(nomes)} {aleatorio.choice(sobrenomes)}",
+             "etapa1_descricao": aleatorio.choice(etapas), "etapa2_descricao": aleatorio.choice(etapas)}
+            for i in range(1, orcamentos + 1)
+        ])
+        conn.execute(db.insert(TarefaProducao), [
+            {"orcamento_id": i, "colaborador": "Bench", "item_descricao": aleatorio.choice(itens)}
+            for i in range(1, orcamentos + 1) for _ in range(3)
+        ])
+        conn.execute(db.insert(ArquivoAnexado), [
+            {"orcamento_id": i, "nome_arquivo": f"Projeto_{i}_{aleatorio.choice(etapas)}.pdf"}
+            for i in range(1, orcamentos + 1)
+        ])
+        inicio = time.perf_counter()
+        rebuild_search_index(conn)
+        indexacao = time.perf_counter() - inicio
+
+    consultas = ['Hélio', 'helio araujo', 'Giratório', 'girat 2l', 'conceicao', '2024-01234', 'churrasq', 'projeto_777', 'a', 'zzz']
+    resultados = {}
+    with engine.connect() as conn:
+        for consulta in consultas:
+            declaracao = search_statement('sqlite', termos_busca(consulta), BUSCA_LIMITE)
+            tempos = []
+            for _ in range(repeticoes):
+                inicio = time.perf_counter()
+                encontrados = len(conn.execute(declaracao).all())
+                tempos.append((time.perf_counter() - inicio) * 1000)
+            tempos.sort()
+            resultados[consulta] = {
+                "resultados": encontrados,
+                "mediana_ms": round(tempos[len(tempos) // 2], 3),
+                "p95_ms": round(tempos[min(int(len(tempos) * 0.95), len(tempos) - 1)], 3),
+            }
+    engine.dispose()
+    print(json.dumps({
+        "orcamentos": orcamentos,
+        "indexacao_s": round(indexacao, 2),
+        "consultas": resultados,
+    }, indent=2, ensure_ascii=False))
+    lentas = [consulta for consulta, medida in resultados.items() if medida["p95_ms"] > limite_ms]
+    if lentas:
+        print(f"Consultas acima de {limite_ms} ms (p95): {', '.join(lentas)}")
+        raise SystemExit(1)
+
+@app.cli.command('rebuild-analytics')
+def rebuild_analytics_command():
+    """Reconstrói o rollup das análises a partir do histórico de transições (uma leitura do log)."""
+    agregados = {}
+    with db.engine.begin() as conn:
+        resultado = conn.execution_options(stream_results=True, yield_per=EXPORT_LOTE).execute(
+            db.select(TransicaoStatus.entidade, TransicaoStatus.grupo_anterior_id, TransicaoStatus.em,
+                      TransicaoStatus.duracao_s, TarefaProducao.colaborador)
+            .outerjoin(TarefaProducao, db.and_(TransicaoStatus.entidade == 'tarefa',
+                                               TarefaProducao.id == TransicaoStatus.entidade_id))
+            .where(TransicaoStatus.duracao_s.isnot(None))
+        )
+        for entidade, grupo_anterior_id, em, duracao, colaborador in resultado:
+            if entidade == 'orcamento':
+                _acumular(agregados, 'grupo', str(grupo_anterior_id), em, duracao)
+            elif colaborador is not None:
+                _acumular(agregados, 'ciclo_tarefa', colaborador, em, duracao)
+        conn.execute(db.delete(EstatisticaDuracao))
+        add_duration_rollups(conn, agregados)
+    print(f'{len(agregados)} linha(s) de rollup reconstruída(s).')
+
+@app.cli.command('benchmark-serializer')
+@click.option('--cartoes', multiple=True, type=int, default=(1000, 10000), show_default=True,
+              help="Tamanhos do quadro (repita a opção para vários).")
+@click.option('--repeticoes', default=5, show_default=True)
+def benchmark_serializer_command(cartoes, repeticoes):
+    """
+    Compara a montagem do /api/workflow pelo to_dict (ORM) com o serializador por tuplas
+    (completo e compacto). Os cartões sintéticos são inseridos numa transação desfeita
+    no final; use um banco vazio para números limpos.
+    """
+    aleatorio = random.Random(42)
+    itens = list(ITEM_DEFINITIONS_PRODUCAO) or ['Item']
+    status_tarefa = ['Não Iniciado', 'Iniciou a Produção', 'Fase de Acabamento', 'Produção Finalizada']
+
+    def to_dict_path():
+        # O caminho anterior: objetos do ORM + to_dict + json.dumps
+        orcamentos = (
+            Orcamento.query
+            .options(db.selectinload(Orcamento.tarefas), db.selectinload(Orcamento.arquivos))
+            .filter(Orcamento.arquivado.is_(False))
+            .order_by(Orcamento.id)
+            .all()
+        )
+        return json.dumps([o.to_dict() for o in orcamentos], ensure_ascii=False).encode('utf-8')
+
+    def medir(funcao):
+        tempos = []
+        for _ in range(repeticoes):
+            db.session.expunge_all() # cada requisição começa com a sessão vazia
+            inicio = time.perf_counter()
+            corpo = funcao()
+            tempos.append((time.perf_counter() - inicio) * 1000)
+        tempos.sort()
+        return round(tempos[len(tempos) // 2], 1), corpo
+
+    def tamanhos(corpo):
+        medidas = {"bytes": len(corpo), "gzip": len(compress_body(corpo, 'gzip'))}
+        if brotli is not None:
+            medidas["br"] = len(compress_body(corpo, 'br'))
+        return medidas
+
+    resultado = {
+        "json": "orjson" if orjson is not None else "json",
+        "brotli": brotli is not None,
+        "orcamentos_existentes": db.session.scalar(db.select(db.func.count(Orcamento.id))),
+        "medicoes": [],
+    }
+    try:
+        grupo_ids = list(db.session.scalars(db.select(Grupo.id)))
+        if not grupo_ids:
+            db.session.execute(db.insert(Grupo), [{"nome": f"Benchmark {i}", "ordem": i} for i in range(1, 8)])
+            grupo_ids = list(db.session.scalars(db.select(Grupo.id)))
+        inseridos = 0
+        proximo_id = (db.session.scalar(db.select(db.func.max(Orcamento.id))) or 0) + 1
+        agora = datetime.utcnow()
+        for alvo in sorted(cartoes):
+            novos = range(proximo_id + inseridos, proximo_id + alvo)
+            if novos:
+                # Inserções em massa pelo Core: não passam pelos hooks do ORM (busca, histórico...)
+                db.session.execute(db.insert(Orcamento), [
+                    {"id": i, "numero": f"B{i}", "cliente": f"Cliente Benchmark {i}",
+                     "grupo_id": grupo_ids[i % len(grupo_ids)], "status_atual": "Em Produção",
+                     "data_entrada_producao": agora, "data_limite_producao": agora + timedelta(days=i % 60),
+                     "data_visita": agora, "responsavel_visita": "Equipe", "etapa1_descricao": "Cozinha",
+                     "tarefas_total": 4}
+                    for i in novos
+                ])
+                db.session.execute(db.insert(TarefaProducao), [
+                    {"orcamento_id": i, "colaborador": f"Colaborador {aleatorio.randrange(10)}",
+                     "item_descricao": aleatorio.choice(itens), "status": aleatorio.choice(status_tarefa)}
+                    for i in novos for _ in range(4)
+                ])
+                db.session.execute(db.insert(ArquivoAnexado), [
+                    {"orcamento_id": i, "nome_arquivo": f"projeto_{i}_{j}.pdf"} for i in novos for j in range(2)
+                ])
+                inseridos = alvo
+
+            tempo_to_dict, corpo_to_dict = medir(to_dict_path)
+            tempo_completo, corpo_completo = medir(lambda: dumps_json(load_board()))
+            tempo_compacto, corpo_compacto = medir(lambda: dumps_json(load_board(compacto=True)))
+            resultado["medicoes"].append({
+                "cartoes": alvo,
+                "to_dict_ms": tempo_to_dict,
+                "serializador_ms": tempo_completo,
+                "compacto_ms": tempo_compacto,
+                "tamanho_to_dict": tamanhos(corpo_to_dict),
+                "tamanho_serializador": tamanhos(corpo_completo),
+                "tamanho_compacto": tamanhos(corpo_compacto),
+            })
+    finally:
+        db.session.rollback()
+        grupos_cache.invalidate()
+    print(json.dumps(resultado, indent=2))
+
+@app.cli.command('profile-report')
+@click.argument('arquivo')
+@click.option('--linhas', default=30, show_default=True)
+@click.option('--ordem', default='cumulative', show_default=True, type=click.Choice(['cumulative', 'tottime', 'ncalls']))
+def profile_report_command(arquivo, linhas, ordem):
+    """Resumo de um .prof gravado pelo profiler por requisição (nome relativo ao PROFILE_DIR)."""
+    if PROFILE_DIR and not os.path.exists(arquivo):
+        arquivo = os.path.join(PROFILE_DIR, arquivo)
+    pstats.Stats(arquivo).strip_dirs().sort_stats(ordem).print_stats(linhas)
+
+@app.cli.command('seed-synthetic')
+@click.option('--orcamentos', default=1000, show_default=True)
+@click.option('--semente', default=42, show_default=True)
+@click.option('--sim', is_flag=True, help="Não pergunta nada se o banco já tiver orçamentos.")
+def seed_synthetic_command(orcamentos, semente, sim):
+    """Popula o banco com orçamentos sintéticos (desenvolvimento e benchmark, nunca em produção)."""
+    existentes = db.session.scalar(db.select(db.func.count(Orcamento.id)))
+    if existentes and not sim:
+        click.confirm(f"O banco já tem {existentes} orçamento(s). Acrescentar {orcamentos} sintéticos?", abort=True)
+    inicio = time.perf_counter()
+    try:
+        ids = generate_synthetic_board(db.session.connection(), orcamentos, semente)
+    except ValueError as e:
+        db.session.rollback()
+        print(e)
+        raise SystemExit(1)
+    db.session.commit()
+    print(f"{len(ids)} orçamento(s) sintético(s) criado(s) em {time.perf_counter() - inicio:.1f}s.")
+
+def _resumo_tempos(tempos):
+    tempos = sorted(tempos)
+    return {
+        "p50_ms": round(tempos[len(tempos) // 2], 2),
+        "p95_ms": round(tempos[min(int(len(tempos) * 0.95), len(tempos) - 1)], 2),
+        "max_ms": round(tempos[-1], 2),
+    }
+
+def _medidas_numericas(dados, prefixo=''):
+    # {"a": {"b": 1}} -> {"a.b": 1}, para comparar dois resultados do benchmark
+    medidas = {}
+    for chave, valor in dados.items():
+        if isinstance(valor, dict):
+            medidas.update(_medidas_numericas(valor, f"{prefixo}{chave}."))
+        elif isinstance(valor, (int, float)) and not isinstance(valor, bool):
+            medidas[f"{prefixo}{chave}"] = valor
+    return medidas
+
+@app.cli.command('benchmark-api')
+@click.option('--orcamentos', default=1000, show_default=True, help="Orçamentos sintéticos gerados antes das medições.")
+@click.option('--repeticoes', default=20, show_default=True, help="Requisições por medida do /api/workflow.")
+@click.option('--transicoes', default=200, show_default=True, help="Mudanças de status por tipo.")
+@click.option('--uploads', default=30, show_default=True)
+@click.option('--pdf-kb', default=256, show_default=True, help="Tamanho de cada um dos 2 PDFs do .zip.")
+@click.option('--semente', default=42, show_default=True)
+@click.option('--saida', type=click.Path(dir_okay=False), help="Também grava o JSON neste arquivo.")
+@click.option('--comparar', type=click.Path(exists=True, dir_okay=False), help="JSON de uma execução anterior.")
+def benchmark_api_command(orcamentos, repeticoes, transicoes, uploads, pdf_kb, semente, saida, comparar):
+    """
+    Benchmark reprodutível da API pelo test client, com notificações enfileiradas mas
+    não enviadas. Mede o /api/workflow (montagem, snapshot, gzip e 304), a vazão das
+    mudanças de status, a do upload de .zip e o pico de memória. Escreve no banco:
+    rode num banco descartável, inicializado e vazio, por exemplo
+        DATABASE_URL=sqlite:////tmp/bench.db flask init-db
+        DATABASE_URL=sqlite:////tmp/bench.db flask benchmark-api --saida bench.json
+    (ou com o DATABASE_URL de um Postgres local). Os anexos vão para uma pasta temporária.
+    """
+    if db.session.scalar(db.select(db.func.count(Orcamento.id))):
+        print("O benchmark precisa de um banco vazio: execute 'flask init-db' num DATABASE_URL descartável.")
+        raise SystemExit(1)
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=app.root_path,
+            capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+
+    aleatorio = random.Random(semente)
+    pasta_uploads = app.config['UPLOAD_FOLDER']
+    app.config['UPLOAD_FOLDER'] = tempfile.mkdtemp(prefix='benchmark-uploads-')
+    # Notificações e prévias entram na fila (faz parte do custo da escrita), mas as threads não sobem
+    notification_dispatcher.ensure_started = lambda: None
+    preview_worker.ensure_started = lambda: None
+    cliente = app.test_client()
+
+    def requisicao(metodo, url, esperado=200, **kwargs):
+        inicio = time.perf_counter()
+        resposta = cliente.open(url, method=metodo, **kwargs)
+        duracao = (time.perf_counter() - inicio) * 1000
+        if resposta.status_code != esperado:
+            raise click.ClickException(f"{metodo} {url}: {resposta.status_code} {resposta.get_data(as_text=True)[:200]}")
+        return duracao, resposta
+
+    def invalidar_quadro():
+        # Como uma escrita faria: a próxima leitura monta o quadro do zero
+        bump_board_version()
+        db.session.commit()
+
+    def quadro(url, invalidar=False, headers=None, esperado=200):
+        if not invalidar:
+            requisicao('GET', url, esperado, headers=headers) # monta/comprime o snapshot fora da medida
+        tempos = []
+        for _ in range(repeticoes):
+            if invalidar:
+                invalidar_quadro()
+            duracao, resposta = requisicao('GET', url, esperado, headers=headers)
+            tempos.append(duracao)
+        return dict(_resumo_tempos(tempos), bytes=len(resposta.data))
+
+    def vazao(operacoes):
+        tempos = [requisicao(*operacao[:2], json=operacao[2])[0] for operacao in operacoes]
+        return dict(_resumo_tempos(tempos), operacoes=len(tempos), por_s=round(len(tempos) / (sum(tempos) / 1000), 1))
+
+    resultado = {
+        "commit": commit,
+        "python": platform.python_version(),
+        "sqlalchemy": sqlalchemy.__version__,
+        "banco": db.engine.dialect.name,
+        "json": "orjson" if orjson is not None else "json",
+        "parametros": {"orcamentos": orcamentos, "repeticoes": repeticoes, "transicoes": transicoes,
+                       "uploads": uploads, "pdf_kb": pdf_kb, "semente": semente},
+    }
+    try:
+        inicio = time.perf_counter()
+        generate_synthetic_board(db.session.connection(), orcamentos, semente)
+        db.session.commit()
+        resultado["geracao_s"] = round(time.perf_counter() - inicio, 2)
+
+        _, resposta = requisicao('GET', '/api/workflow')
+        workflow = {
+            "cartoes_no_quadro": sum(len(grupo["orcamentos"]) for grupo in resposta.get_json()),
+            "montagem": quadro('/api/workflow', invalidar=True),
+            "montagem_compacto": quadro('/api/workflow?formato=compacto', invalidar=True),
+            "snapshot": quadro('/api/workflow'),
+            "snapshot_gzip": quadro('/api/workflow', headers={'Accept-Encoding': 'gzip'}),
+        }
+        # O ETag muda a cada invalidação: o 304 usa o da versão atual
+        etag = requisicao('GET', '/api/workflow')[1].headers['ETag']
+        workflow["nao_modificado"] = quadro('/api/workflow', headers={'If-None-Match': etag}, esperado=304)
+        resultado["workflow"] = workflow
+
+        # Ida e volta pelo StandBy (o orçamento volta ao grupo de origem) e tarefas em andamento
+        em_producao = list(db.session.scalars(
+            db.select(Orcamento.id)
+            .where(Orcamento.grupo_id == grupos_cache.id('Linha de Produção'), Orcamento.arquivado.is_(False))
+            .order_by(Orcamento.id).limit(max(transicoes // 2, 1))
+        ))
+        tarefas = list(db.session.scalars(
+            db.select(TarefaProducao.id)
+            .where(TarefaProducao.orcamento_id.in_(em_producao), TarefaProducao.status != TAREFA_STATUS_FINAL)
+            .order_by(TarefaProducao.id)
+        ))
+        if not em_producao or not tarefas:
+            raise click.ClickException("Poucos orçamentos na Linha de Produção: aumente --orcamentos.")
+        andamento = ('Iniciou a Produção', 'Fase de Acabamento')
+        resultado["transicoes"] = {
+            "orcamento": vazao([
+                ('PUT', f'/api/orcamento/{em_producao[(i // 2) % len(em_producao)]}/status',
+                 {"novo_status": 'StandBy' if i % 2 == 0 else 'Liberado', "dados_adicionais": {}})
+                for i in range(transicoes)
+            ]),
+            "tarefa": vazao([
+                ('PUT', f'/api/tarefa/{tarefas[i % len(tarefas)]}/status', {"status": andamento[(i // len(tarefas)) % 2]})
+                for i in range(transicoes)
+            ]),
+            "tarefas_em_lote_10": vazao([
+                ('PUT', '/api/tarefas/status', {"tarefas": [
+                    {"id": tarefas[(i * 10 + j) % len(tarefas)], "status": andamento[i % 2]} for j in range(10)
+                ]})
+                for i in range(max(transicoes // 10, 1))
+            ]),
+        }
+
+        def montar_zip(indice):
+            dados = {
+                "numero_orcamento": f"BENCH/{indice:05d}", "nome_cliente": f"Cliente Benchmark {indice}",
+                "itens_etapa_1": "Churrasqueira",
+                "tarefas_producao": [{"item": item} for item in aleatorio.sample(list(ITEM_DEFINITIONS_PRODUCAO), 4)],
+            }
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as zf:
+                zf.writestr('orcamento.json', json.dumps(dados))
+                for pdf in range(2):
+                    zf.writestr(f'projeto_{pdf}.pdf', aleatorio.randbytes(pdf_kb * 1024))
+            return buffer.getvalue()
+
+        pacotes = [montar_zip(i) for i in range(uploads)]
+        tempos = [
+            requisicao('POST', '/api/upload', esperado=201, data={'file': (io.BytesIO(pacote), 'orcamento.zip')})[0]
+            for pacote in pacotes
+        ]
+        total_s = sum(tempos) / 1000
+        resultado["upload"] = dict(
+            _resumo_tempos(tempos),
+            uploads=len(tempos),
+            por_s=round(len(tempos) / total_s, 1),
+            mb_por_s=round(sum(map(len, pacotes)) / 1024 / 1024 / total_s, 1),
+        )
+
+        # Pico de memória (alocações Python) de uma montagem do quadro e de um upload
+        memoria = {}
+        tracemalloc.start()
+        invalidar_quadro()
+        tracemalloc.reset_peak()
+        requisicao('GET', '/api/workflow')
+        memoria["montagem_quadro_mb"] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+        pacote = montar_zip(uploads)
+        tracemalloc.reset_peak()
+        requisicao('POST', '/api/upload', esperado=201, data={'file': (io.BytesIO(pacote), 'orcamento.zip')})
+        memoria["upload_mb"] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+        tracemalloc.stop()
+        try:
+            import resource
+            # ru_maxrss: KB no Linux
+            memoria["processo_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        except ImportError:
+            pass
+        resultado["memoria"] = memoria
+    finally:
+        db.session.rollback()
+        del notification_dispatcher.ensure_started
+        del preview_worker.ensure_started
+        shutil.rmtree(app.config['UPLOAD_FOLDER'], ignore_errors=True)
+        app.config['UPLOAD_FOLDER'] = pasta_uploads
+
+    if comparar:
+        with open(comparar) as f:
+            base = _medidas_numericas(json.load(f))
+        atual = _medidas_numericas(resultado)
+        # Razão atual/base: nos tempos (_ms) acima de 1 é regressão; em por_s, abaixo de 1
+        resultado["comparacao"] = {
+            chave: round(valor / base[chave], 3)
+            for chave, valor in atual.items()
+            if chave in base and base[chave] and not chave.startswith("parametros.")
+        }
+    saida_json = json.dumps(resultado, indent=2, ensure_ascii=False)
+    if saida:
+        with open(saida, 'w') as f:
+            f.write(saida_json + "\n")
+    print(saida_json)
+
+# --- Migrações de Esquema ---
+
+# O create_all só cria tabelas que não existem; colunas e índices novos em tabelas
+# existentes chegam por estas migrações. Cada uma roda uma única vez por banco
+# (SchemaVersion guarda a última aplicada) e é idempotente: verifica antes de alterar.
+SCHEMA_VERSION_ID = 1
+
+def _adicionar_coluna(conn, tabela, coluna, ddl):
+    if coluna not in {c['name'] for c in inspect(conn).get_columns(tabela)}:
+        conn.execute(db.text(f"ALTER TABLE {tabela} ADD COLUMN {coluna} {ddl}"))
+
+def _criar_indices(conn, *nomes):
+    """Cria os índices declarados nos modelos (pelo nome), se ainda não existirem."""
+    for tabela in db.metadata.sorted_tables:
+        for indice in tabela.indexes:
+            if indice.name in nomes:
+                indice.create(conn, checkfirst=True)
+
+def _migracao_anexos_por_hash(conn):
+    _adicionar_coluna(conn, 'arquivo_anexado', 'blob_sha256', "VARCHAR(64) REFERENCES arquivo_blob(sha256)")
+    _criar_indices(conn, 'ix_arquivo_anexado_blob_sha256')
+
+def _migracao_arquivo_instalados(conn):
+    _adicionar_coluna(conn, 'orcamento', 'arquivado', "BOOLEAN NOT NULL DEFAULT FALSE")
+    _criar_indices(conn, 'ix_orcamento_quadro')
+
+def _migracao_indices_caminhos_quentes(conn):
+    _criar_indices(
+        conn,
+        'ix_orcamento_grupo', 'ix_orcamento_numero',
+        'ix_tarefa_orcamento', 'ix_tarefa_colaborador',
+        'ix_arquivo_orcamento',
+    )
+
+def _migracao_contadores_producao(conn):
+    for coluna in ('tarefas_total', 'tarefas_nao_iniciadas', 'tarefas_finalizadas'):
+        _adicionar_coluna(conn, 'orcamento', coluna, "INTEGER NOT NULL DEFAULT 0")
+    conn.execute(rebuild_progress_statement())
+
+def _migracao_indice_busca(conn):
+    BuscaOrcamento.__table__.create(conn, checkfirst=True)
+    rebuild_search_index(conn)
+
+def _migracao_finalizacao_tarefas(conn):
+    _adicionar_coluna(conn, 'tarefa_producao', 'finalizada_em', "TIMESTAMP")
+    _criar_indices(conn, 'ix_tarefa_finalizada')
+    # Tarefas finalizadas antes desta coluna: a melhor data disponível é a do orçamento pronto
+    conn.execute(
+        db.update(TarefaProducao)
+        .where(TarefaProducao.status == TAREFA_STATUS_FINAL, TarefaProducao.finalizada_em.is_(None))
+        .values(finalizada_em=db.select(Orcamento.data_pronto)
+                .where(Orcamento.id == TarefaProducao.orcamento_id)
+                .scalar_subquery())
+    )
+
+def _migracao_previas_anexos(conn):
+    PreviaArquivo.__table__.create(conn, checkfirst=True)
+    # Conteúdo já armazenado entra na fila; 'flask generate-previews' adianta o backfill
+    agora = datetime.utcnow()
+    conn.execute(
+        db.insert(PreviaArquivo).from_select(
+            ['sha256', 'status', 'tentativas', 'proxima_tentativa', 'criado_em'],
+            db.select(ArquivoBlob.sha256, db.literal('pendente'), db.literal(0), db.literal(agora), ArquivoBlob.criado_em)
+            .where(~db.select(PreviaArquivo.sha256).where(PreviaArquivo.sha256 == ArquivoBlob.sha256).exists())
+        )
+    )
+
+# (versão, descrição, função) em ordem; nunca altere uma migração já publicada, crie outra
+MIGRATIONS = [
+    (1, "Anexos no armazenamento por hash", _migracao_anexos_por_hash),
+    (2, "Arquivo de orçamentos instalados", _migracao_arquivo_instalados),
+    (3, "Índices dos caminhos quentes (quadro, tarefas, anexos)", _migracao_indices_caminhos_quentes),
+    (4, "Contadores de produção no orçamento", _migracao_contadores_producao),
+    (5, "Índice de busca textual dos orçamentos", _migracao_indice_busca),
+    (6, "Data de finalização das tarefas de produção", _migracao_finalizacao_tarefas),
+    (7, "Prévias (miniatura, páginas e texto) dos anexos", _migracao_previas_anexos),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def run_migrations():
+    """Cria as tabelas novas e aplica as migrações pendentes. Retorna as versões aplicadas."""
+    db.create_all()
+    registro = db.session.get(SchemaVersion, SCHEMA_VERSION_ID)
+    if registro is None:
+        # Banco anterior ao controle de versão: as migrações verificam o que já existe
+        registro = SchemaVersion(id=SCHEMA_VERSION_ID, versao=0)
+        db.session.add(registro)
+        db.session.commit()
+    atual = registro.versao
+    # Linha do contador de versão do quadro (bancos criados antes dele)
+    if db.session.get(BoardVersion, BOARD_VERSION_ID) is None:
+        db.session.add(BoardVersion(id=BOARD_VERSION_ID, versao=0))
+        db.session.commit()
+    db.session.remove()
+
+    aplicadas = []
+    for versao, descricao, migracao in MIGRATIONS:
+        if versao <= atual:
+            continue
+        # Cada migração e o registro da versão entram na mesma transação
+        with db.engine.begin() as conn:
+            migracao(conn)
+            conn.execute(
+                db.update(SchemaVersion)
+                .where(SchemaVersion.id == SCHEMA_VERSION_ID)
+                .values(versao=versao)
+            )
+        app.logger.info(f"Migração {versao} aplicada: {descricao}")
+        aplicadas.append((versao, descricao))
+    return aplicadas
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Aplica as migrações de esquema pendentes."""
+    aplicadas = run_migrations()
+    for versao, descricao in aplicadas:
+        print(f'  {versao}: {descricao}')
+    print(f'{len(aplicadas)} migração(ões) aplicada(s). Esquema na versão {SCHEMA_VERSION}.')
+
+# Tabelas que crescem com o uso: consultas com filtro nelas não podem varrer a tabela inteira
+TABELAS_GRANDES = ('orcamento', 'tarefa_producao', 'arquivo_anexado', 'notificacao', 'board_change', 'transicao_status')
+
+# Caminhos quentes conferidos pelo 'flask check-indexes' (executados de verdade, com o SQL capturado)
+INDEX_CHECKS = [
+    ("Quadro (/api/workflow)", lambda: load_board()),
+    ("Arquivados de um grupo", lambda: load_archived_page(grupos_cache.id('Instalados') or 0, antes=10**9)),
+    ("Tarefas de um orçamento", lambda: TarefaProducao.query.filter_by(orcamento_id=1).all()),
+    ("Tarefas pendentes de um colaborador", lambda: TarefaProducao.query.filter(
+        TarefaProducao.colaborador == 'Luiz', TarefaProducao.status != 'Produção Finalizada').all()),
+    ("Busca por número", lambda: Orcamento.query.filter_by(numero='1').all()),
+    ("Busca textual (/api/search)", lambda: search_orcamentos(db.session.connection(), 'helio gir')),
+    ("Histórico de um orçamento", lambda: TransicaoStatus.query.filter_by(orcamento_id=1).order_by(TransicaoStatus.id).all()),
+    ("Início da etapa/ciclo (a cada transição)", lambda: (
+        _inicio_etapas(db.session.connection(), [1]), _inicio_ciclos(db.session.connection(), [1]))),
+]
+
+def explain(conn, statement, parameters):
+    """Plano de execução de um SQL já compilado, em texto, para SQLite e Postgres."""
+    if conn.dialect.name == 'sqlite':
+        linhas = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).all()
+        return "\n".join(linha[-1] for linha in linhas)
+    if conn.dialect.name == 'postgresql':
+        # Com tabelas pequenas o Postgres prefere Seq Scan mesmo com índice; desligado,
+        # ele só faz Seq Scan quando nenhum índice serve para a consulta
+        conn.exec_driver_sql("SET LOCAL enable_seqscan = off")
+        linhas = conn.exec_driver_sql(f"EXPLAIN {statement}", parameters).all()
+        return "\n".join(linha[0] for linha in linhas)
+    raise RuntimeError(f"EXPLAIN não suportado para {conn.dialect.name}")
+
+def full_scans(plano):
+    """Tabelas grandes varridas por inteiro segundo o plano."""
+    varridas = []
+    for linha in plano.splitlines():
+        for tabela in TABELAS_GRANDES:
+            # SQLite: "SCAN tabela" sem índice; Postgres: "Seq Scan on tabela"
+            if (f"SCAN {tabela}" in linha and "INDEX" not in linha and "SEARCH" not in linha) \
+                    or f"Seq Scan on {tabela}" in linha:
+                varridas.append(tabela)
+    return varridas
+
+@app.cli.command('check-indexes')
+def check_indexes_command():
+    """Roda EXPLAIN nas consultas dos caminhos quentes e falha se alguma varre uma tabela grande."""
+    capturadas = []
+    def capturar(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            capturadas.append((statement, parameters))
+
+    falhas = 0
+    for nome, executar in INDEX_CHECKS:
+        capturadas.clear()
+        event.listen(db.engine, 'before_cursor_execute', capturar)
+        try:
+            executar()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capturar)
+            db.session.rollback()
+
+        print(f"== {nome}")
+        with db.engine.connect() as conn:
+            for statement, parameters in capturadas:
+                trans = conn.begin()
+                try:
+                    plano = explain(conn, statement, parameters)
+                finally:
+                    trans.rollback()
+                varridas = full_scans(plano)
+                sql = " ".join(statement.split())
+                print(f"  [{'FALHA' if varridas else 'ok'}] {sql[:110]}{'...' if len(sql) > 110 else ''}")
+                for linha in plano.splitlines():
+                    print(f"      {linha}")
+                falhas += bool(varridas)
+
+    if falhas:
+        print(f"{falhas} consulta(s) varrendo tabela inteira.")
+        raise SystemExit(1)
+    print("Todas as consultas dos caminhos quentes usam índice.")
+
 def setup_database(app):
     with app.app_context():
         # (MODIFICADO) Não verifica mais o 'workflow.db' pois usará o Postgres
         # if not os.path.exists('workflow.db'):
         
-        # Apenas cria as tabelas se não existirem (o init-db fará a criação dos grupos)
-        db.create_all()
+        # Cria as tabelas que faltam e aplica as migrações pendentes (o init-db fará a criação dos grupos)
+        run_migrations()
         
         # Lógica de criação de grupo movida para 'init-db' para ser executada manualmente no deploy
         if not Grupo.query.first():
@@ -843,11 +5437,15 @@ def setup_database(app):
             # db.session.commit()
             # print("DB e Grupos criados.")
 
+# Até aqui: tempo de importação do módulo (o cold start do worker antes da WorkerStartup)
+TEMPO_IMPORTACAO_MS = round((time.perf_counter() - _inicio_importacao) * 1000, 1)
+
 if __name__ == '__main__':
-    # (MODIFICADO) Não cria mais a pasta 'uploads' aqui, é feito pelo @app.before_request
+    # (MODIFICADO) Pastas, esquema e caches são preparados pela WorkerStartup
     # if not os.path.exists('uploads'):
     #     os.makedirs('uploads')
     setup_database(app)
+    worker_startup.run()
     # (MODIFICADO) Define a porta com base no ambiente, padrão 5001 localmente
     port = int(os.environ.get("PORT", 5001))
     app.run(debug=True, port=port) # debug=True é OK para local, Render ignora
@@ -0,0 +1,40 @@
+import os
+import subprocess
+import sys
+
+# Workers com threads: as conexões SSE (/api/stream) ficam abertas por vários
+# minutos e, com workers 'sync', cada tablet conectado prenderia um worker inteiro.
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', '2'))
+threads = int(os.environ.get('GUNICORN_THREADS', '16'))
+
+# Maior que o heartbeat do SSE (15s), para não derrubar conexões ociosas
+timeout = 60
+
+# O master importa o app uma vez e os workers nascem prontos por fork (sem repetir a
+# importação de Flask/SQLAlchemy em cada um): é a maior parte do cold start do worker.
+# A importação não abre conexões nem threads; o post_fork descarta o pool herdado.
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+# Uma vez por deploy, no master e antes de subir os workers: cria as tabelas e aplica as
+# migrações. Num processo separado, para as conexões da migração não ficarem abertas no
+# master (seriam herdadas pelos workers no fork). Use MIGRATE_ON_START=0 se o deploy já
+# roda 'flask migrate' em outro passo. Se falhar, o gunicorn não sobe.
+def on_starting(server):
+    if os.environ.get('MIGRATE_ON_START', '1') == '1':
+        subprocess.run(
+            [sys.executable, '-m', 'flask', '--app', 'app', 'migrate'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True
+        )
+
+def post_fork(server, worker):
+    if preload_app:
+        from app import app, db
+        with app.app_context():
+            db.engine.dispose(close=False)
+
+# Cada worker prepara pastas, confere o esquema, aquece os caches e sobe as threads de
+# fundo antes de aceitar conexões (ver WorkerStartup em app.py)
+def post_worker_init(worker):
+    from app import worker_startup
+    worker_startup.run()
@@ -0,0 +1,81 @@
+"""
+Renderizador das prévias dos anexos, executado num processo separado pelo
+PreviewWorker (app.py): um PDF que derruba o PDFium, estoura a memória ou trava
+mata só este processo, nunca o worker que atende as requisições.
+
+Uso: python preview_renderer.py <pdf> <destino sem extensão> <largura> <qualidade> <páginas de texto> <máx. de caracteres>
+
+Grava a miniatura da 1ª página em <destino>.webp (ou .png, se o Pillow não tiver
+WebP) e imprime em JSON: formato, largura, altura, páginas e texto.
+"""
+import json
+import os
+import sys
+import tempfile
+
+# Limites do processo: um PDF malicioso não consome a máquina
+MEMORIA_MAX_MB = int(os.environ.get('PREVIA_MEMORIA_MB', '1024'))
+NICE = int(os.environ.get('PREVIA_NICE', '10'))
+
+
+def limit_process():
+    try:
+        import resource
+        limite = MEMORIA_MAX_MB * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limite, limite))
+    except (ImportError, ValueError, OSError):
+        pass
+    try:
+        # Prioridade baixa: a renderização não disputa CPU com as requisições
+        os.nice(NICE)
+    except (AttributeError, OSError):
+        pass
+
+
+def render(caminho, destino, largura, qualidade, texto_paginas, texto_max):
+    import pypdfium2 as pdfium
+    from PIL import features
+
+    pdf = pdfium.PdfDocument(caminho)
+    try:
+        paginas = len(pdf)
+        primeira = pdf[0]
+        imagem = primeira.render(scale=largura / primeira.get_width()).to_pil()
+        textos = []
+        for indice in range(min(paginas, texto_paginas)):
+            textos.append(pdf[indice].get_textpage().get_text_range())
+            if sum(map(len, textos)) >= texto_max:
+                break
+    finally:
+        pdf.close()
+
+    formato = 'webp' if features.check('webp') else 'png'
+    final = f"{destino}.{formato}"
+    os.makedirs(os.path.dirname(final), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix='.previa-', dir=os.path.dirname(final))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if formato == 'webp':
+                imagem.save(f, 'WEBP', quality=qualidade, method=4)
+            else:
+                imagem.save(f, 'PNG', optimize=True)
+        os.replace(temp_path, final)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+    return {
+        "formato": formato,
+        "largura": imagem.width,
+        "altura": imagem.height,
+        "paginas": paginas,
+        # O Postgres não aceita NUL em texto
+        "texto": "\n".join(textos).replace('\x00', '')[:texto_max],
+    }
+
+
+if __name__ == '__main__':
+    caminho, destino, largura, qualidade, texto_paginas, texto_max = sys.argv[1:7]
+    limit_process()
+    dados = render(caminho, destino, int(largura), int(qualidade), int(texto_paginas), int(texto_max))
+    json.dump(dados, sys.stdout, ensure_ascii=False)
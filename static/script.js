@@ -4,6 +4,8 @@ document.addEventListener('DOMContentLoaded', () => {
     const uploadButton = document.getElementById('upload-button');
     const fileInput = document.getElementById('zip-upload');
     const btnCriarManual = document.getElementById('btn-criar-manual');
+    const searchInput = document.getElementById('search-input');
+    const searchResults = document.getElementById('search-results');
 
     // Templates
     const grupoTemplate = document.getElementById('grupo-template');
@@ -56,15 +58,68 @@ document.addEventListener('DOMContentLoaded', () => {
     const modalTarefaSave = document.getElementById('modal-tarefa-save');
     const modalTarefaCancel = document.getElementById('modal-tarefa-cancel');
 
+    // Versão do quadro atualmente renderizada (null = ainda não carregado)
+    let boardVersion = null;
+
+    /**
+     * Atualiza o quadro: busca apenas as alterações desde a última versão
+     * renderizada e aplica no DOM. Usa a carga completa na primeira vez,
+     * quando o servidor pede ({ full: true }) ou quando options.full é passado.
+     */
+    async function loadWorkflow(options = {}) {
+        if (boardVersion === null || options.full) {
+            return loadWorkflowFull();
+        }
+        try {
+            const response = await fetch(`/api/workflow/changes?since=${boardVersion}`);
+            if (!response.ok) throw new Error('Falha ao carregar alterações');
+
+            const changes = await response.json();
+            if (changes.full) {
+                return loadWorkflowFull();
+            }
+
+            applyChanges(changes);
+            boardVersion = changes.versao;
+
+        } catch (error) {
+            console.error('Erro ao carregar alterações:', error);
+        }
+    }
+
+    /**
+     * NOVO: Converte o quadro compacto (/api/workflow?formato=compacto) de volta
+     * para objetos: cada cartão é uma lista de valores na ordem de "campos".
+     */
+    function expandCompactBoard(compacto) {
+        const campos = compacto.campos;
+        const objeto = (nomes, valores) => {
+            const resultado = {};
+            nomes.forEach((nome, i) => { resultado[nome] = valores[i]; });
+            return resultado;
+        };
+        return compacto.grupos.map(grupo => ({
+            ...grupo,
+            orcamentos: grupo.orcamentos.map(valores => {
+                const orcamento = objeto(campos.orcamento, valores);
+                orcamento.tarefas = orcamento.tarefas.map(t => objeto(campos.tarefa, t));
+                orcamento.arquivos = orcamento.arquivos.map(a => objeto(campos.arquivo, a));
+                orcamento.progresso = objeto(campos.progresso, orcamento.progresso);
+                return orcamento;
+            })
+        }));
+    }
+
     /**
      * Carrega todo o workflow da API e renderiza no quadro.
      */
-    async function loadWorkflow() {
+    async function loadWorkflowFull() {
         try {
-            const response = await fetch('/api/workflow');
+            const response = await fetch('/api/workflow?formato=compacto');
             if (!response.ok) throw new Error('Falha ao carregar workflow');
             
-            const grupos = await response.json();
+            const grupos = expandCompactBoard(await response.json());
+            boardVersion = Number(response.headers.get('X-Board-Version'));
             board.innerHTML = '';
             
             grupos.forEach(grupo => {
@@ -88,6 +143,125 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    /**
+     * Conecta no canal SSE (/api/stream) para receber as mudanças feitas por
+     * outros usuários sem precisar recarregar a página.
+     * O EventSource reconecta sozinho e reenvia o Last-Event-ID (versão).
+     */
+    function connectBoardStream() {
+        if (!window.EventSource) return;
+
+        const source = new EventSource('/api/stream');
+        source.addEventListener('board', (e) => {
+            const evento = JSON.parse(e.data);
+            if (boardVersion === null) return; // Carga inicial ainda em andamento
+
+            if (evento.full) {
+                loadWorkflow({ full: true });
+            } else if (evento.versao <= boardVersion) {
+                return; // Já aplicado (ex.: pelo refresh após a própria ação)
+            } else if (evento.desde === null || evento.desde > boardVersion) {
+                loadWorkflow(); // Perdemos versões intermediárias: busca o delta completo
+            } else {
+                applyChanges(evento);
+                boardVersion = evento.versao;
+            }
+        });
+    }
+
+    /**
+     * Aplica no DOM o delta retornado por /api/workflow/changes.
+     */
+    function applyChanges(changes) {
+        (changes.orcamentos_removidos || []).forEach(id => removeOrcamentoRow(id));
+        (changes.orcamentos || []).forEach(orcamento => upsertOrcamentoRow(orcamento));
+        (changes.tarefas_removidas || []).forEach(tarefa => patchTarefa(tarefa, true));
+        (changes.tarefas || []).forEach(tarefa => patchTarefa(tarefa));
+        (changes.arquivos_removidos || []).forEach(arquivo => patchArquivo(arquivo, true));
+        (changes.arquivos || []).forEach(arquivo => patchArquivo(arquivo));
+    }
+
+    function findOrcamentoRow(orcamentoId) {
+        return board.querySelector(`.monday-row[data-orcamento-id="${orcamentoId}"]`);
+    }
+
+    function removeOrcamentoRow(orcamentoId) {
+        const row = findOrcamentoRow(orcamentoId);
+        if (row) row.remove();
+    }
+
+    /**
+     * Substitui (ou cria) a linha de um orçamento no grupo correto,
+     * mantendo a mesma ordem (por id) do /api/workflow.
+     */
+    function upsertOrcamentoRow(orcamento) {
+        removeOrcamentoRow(orcamento.id);
+
+        const grupoEl = board.querySelector(`.monday-group[data-group-id="${orcamento.grupo_id}"]`);
+        if (!grupoEl) return;
+        const row = renderOrcamentoRow(orcamento);
+        if (!row) return;
+
+        const tbody = grupoEl.querySelector('.monday-tbody');
+        const proxima = Array.from(tbody.children).find(tr => Number(tr.dataset.orcamentoId) > orcamento.id);
+        tbody.insertBefore(row, proxima || null);
+    }
+
+    /**
+     * Mesma ordenação do backend: colaborador e depois item.
+     */
+    function compareTarefas(a, b) {
+        const chaveA = [a.colaborador || '', a.item_descricao || ''];
+        const chaveB = [b.colaborador || '', b.item_descricao || ''];
+        if (chaveA[0] !== chaveB[0]) return chaveA[0] < chaveB[0] ? -1 : 1;
+        if (chaveA[1] !== chaveB[1]) return chaveA[1] < chaveB[1] ? -1 : 1;
+        return 0;
+    }
+
+    /**
+     * Atualiza uma tarefa na célula de produção do orçamento (se estiver visível).
+     */
+    function patchTarefa(tarefa, removida = false) {
+        const row = findOrcamentoRow(tarefa.orcamento_id);
+        const cell = row && row.querySelector('.col-tarefas-producao');
+        if (!cell) return; // Fora da Linha de Produção as tarefas não são exibidas
+
+        const tarefas = JSON.parse(cell.dataset.tarefas).filter(t => t.id !== tarefa.id);
+        if (!removida) {
+            tarefas.push(tarefa);
+            tarefas.sort(compareTarefas);
+        }
+        cell.dataset.tarefas = JSON.stringify(tarefas);
+
+        if (cell.querySelector('.tarefas-expanded')) {
+            renderTarefasExpanded(tarefas, tarefa.orcamento_id, cell);
+        } else {
+            renderTarefasCompressed(tarefas, tarefa.orcamento_id, cell);
+        }
+    }
+
+    /**
+     * Adiciona, substitui ou remove o ícone de um arquivo na linha do orçamento.
+     */
+    function patchArquivo(arquivo, removido = false) {
+        const row = findOrcamentoRow(arquivo.orcamento_id);
+        const iconList = row && row.querySelector('.file-list-icons');
+        if (!iconList) return;
+
+        const existente = iconList.querySelector(`[data-arquivo-id="${arquivo.id}"]`);
+        if (removido) {
+            if (existente) existente.remove();
+            return;
+        }
+
+        const link = renderArquivoLink(arquivo);
+        if (existente) {
+            existente.replaceWith(link);
+        } else {
+            iconList.appendChild(link);
+        }
+    }
+
     /**
      * Renderiza um único grupo (seção com tabela).
      */
@@ -110,10 +284,123 @@ document.addEventListener('DOMContentLoaded', () => {
             headerRow.appendChild(th);
         });
         thead.appendChild(headerRow);
+
+        // (NOVO) Orçamentos arquivados não vêm no /api/workflow; são carregados sob demanda
+        if (grupo.tem_arquivados) {
+            const btnArquivados = document.createElement('button');
+            btnArquivados.className = 'btn-secondary btn-arquivados';
+            btnArquivados.textContent = 'Ver arquivados';
+            grupoSection.querySelector('.table-wrapper').appendChild(btnArquivados);
+        }
         
         return grupoSection;
     }
 
+    /**
+     * Busca a próxima página de arquivados do grupo (paginação por cursor:
+     * o id do último orçamento recebido) e insere as linhas no grupo.
+     */
+    async function loadArquivados(buttonEl) {
+        const grupoEl = buttonEl.closest('.monday-group');
+        const params = new URLSearchParams();
+        if (buttonEl.dataset.cursor) params.set('antes', buttonEl.dataset.cursor);
+
+        buttonEl.disabled = true;
+        try {
+            const response = await fetch(`/api/grupo/${grupoEl.dataset.groupId}/arquivados?${params}`);
+            if (!response.ok) throw new Error('Falha ao carregar arquivados');
+            const pagina = await response.json();
+
+            pagina.orcamentos.forEach(orcamento => {
+                upsertOrcamentoRow(orcamento);
+                const row = findOrcamentoRow(orcamento.id);
+                if (row) row.classList.add('row-arquivado');
+            });
+
+            if (pagina.proximo) {
+                buttonEl.dataset.cursor = pagina.proximo;
+                buttonEl.textContent = 'Ver mais arquivados';
+                buttonEl.disabled = false;
+            } else {
+                buttonEl.remove();
+            }
+        } catch (error) {
+            console.error('Erro ao carregar arquivados:', error);
+            buttonEl.disabled = false;
+        }
+    }
+
+    // --- NOVO: Busca de orçamentos (/api/search) ---
+
+    let searchTimer = null;
+    let searchController = null;
+
+    function hideSearchResults() {
+        searchResults.hidden = true;
+        searchResults.innerHTML = '';
+    }
+
+    async function runSearch(consulta) {
+        // Só a última digitação importa: cancela a busca anterior ainda em andamento
+        if (searchController) searchController.abort();
+        searchController = new AbortController();
+        try {
+            const response = await fetch(`/api/search?q=${encodeURIComponent(consulta)}`, { signal: searchController.signal });
+            if (!response.ok) throw new Error('Falha na busca');
+            const data = await response.json();
+            renderSearchResults(data.resultados);
+        } catch (error) {
+            if (error.name !== 'AbortError') console.error('Erro na busca:', error);
+        }
+    }
+
+    function renderSearchResults(resultados) {
+        searchResults.innerHTML = '';
+        if (resultados.length === 0) {
+            const li = document.createElement('li');
+            li.className = 'search-vazio';
+            li.textContent = 'Nenhum orçamento encontrado';
+            searchResults.appendChild(li);
+        }
+        resultados.forEach(resultado => {
+            const li = document.createElement('li');
+            li.dataset.orcamentoId = resultado.id;
+            li.textContent = `${resultado.numero} - ${resultado.cliente}`;
+            const grupo = document.createElement('span');
+            grupo.className = 'search-grupo';
+            grupo.textContent = `${resultado.grupo_nome || ''}${resultado.arquivado ? ' (arquivado)' : ''} · ${resultado.status_atual || ''}`;
+            li.appendChild(grupo);
+            searchResults.appendChild(li);
+        });
+        searchResults.hidden = false;
+    }
+
+    /**
+     * Mostra o orçamento no quadro: abre o grupo e rola até a linha.
+     * Arquivados (fora do quadro) são buscados e inseridos como na página de arquivados.
+     */
+    async function revealOrcamento(orcamentoId) {
+        let row = findOrcamentoRow(orcamentoId);
+        if (!row) {
+            try {
+                const response = await fetch(`/api/orcamento/${orcamentoId}`);
+                if (!response.ok) throw new Error('Orçamento não encontrado');
+                const orcamento = await response.json();
+                upsertOrcamentoRow(orcamento);
+                row = findOrcamentoRow(orcamentoId);
+                if (row && orcamento.arquivado) row.classList.add('row-arquivado');
+            } catch (error) {
+                console.error('Erro ao abrir orçamento:', error);
+                return;
+            }
+        }
+        if (!row) return;
+        row.closest('.monday-group').classList.remove('collapsed');
+        row.scrollIntoView({ behavior: 'smooth', block: 'center' });
+        row.classList.add('row-destaque');
+        setTimeout(() => row.classList.remove('row-destaque'), 2000);
+    }
+
     /**
      * Roteador: Escolhe qual template de LINHA (TR) usar.
      */
@@ -167,6 +454,34 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
     
+    /**
+     * Renderiza o link (ícone) de um arquivo.
+     */
+    function renderArquivoLink(arquivo) {
+        const a = document.createElement('a');
+        a.href = arquivo.url;
+        a.target = '_blank';
+        a.title = arquivo.paginas
+            ? `${arquivo.nome_arquivo} (${arquivo.paginas} página${arquivo.paginas > 1 ? 's' : ''})`
+            : arquivo.nome_arquivo;
+        a.dataset.arquivoId = arquivo.id;
+        
+        // NOVO: Miniatura da 1ª página (gerada em segundo plano; até lá fica o ícone)
+        if (arquivo.previa) {
+            a.className = 'file-link file-link-thumb';
+            const img = document.createElement('img');
+            img.src = arquivo.previa;
+            img.alt = arquivo.nome_arquivo;
+            img.loading = 'lazy';
+            a.appendChild(img);
+        } else if (arquivo.nome_arquivo.toLowerCase().endsWith('.pdf')) {
+            a.className = 'file-link file-link-pdf';
+        } else {
+            a.className = 'file-link file-link-other';
+        }
+        return a;
+    }
+
     /**
      * Renderiza a célula de arquivos (ÍCONES).
      */
@@ -177,17 +492,7 @@ document.addEventListener('DOMContentLoaded', () => {
         const iconList = clone.querySelector('.file-list-icons');
         
         arquivos.forEach(arquivo => {
-            const a = document.createElement('a');
-            a.href = arquivo.url;
-            a.target = '_blank';
-            a.title = arquivo.nome_arquivo;
-            
-            if (arquivo.nome_arquivo.toLowerCase().endsWith('.pdf')) {
-                a.className = 'file-link file-link-pdf';
-            } else {
-                a.className = 'file-link file-link-other';
-            }
-            iconList.appendChild(a);
+            iconList.appendChild(renderArquivoLink(arquivo));
         });
         
         clone.querySelector('.manual-file-upload').dataset.orcamentoId = orcamentoId;
@@ -308,6 +613,8 @@ document.addEventListener('DOMContentLoaded', () => {
         
         // Guarda a referência dos dados das tarefas na própria célula para fácil acesso
         tarefasCell.dataset.tarefas = JSON.stringify(orcamento.tarefas);
+        // (NOVO) Progresso calculado no servidor (contadores do orçamento)
+        tarefasCell.dataset.progresso = JSON.stringify(orcamento.progresso || {});
         
         // Inicia na visualização comprimida (NOVA LÓGICA)
         renderTarefasCompressed(orcamento.tarefas, orcamento.id, tarefasCell);
@@ -338,6 +645,16 @@ document.addEventListener('DOMContentLoaded', () => {
         statusButton.dataset.action = 'expand'; // Ação para o event listener
         
         container.appendChild(statusButton);
+
+        // (NOVO) Itens finalizados / total
+        const progresso = JSON.parse(cell.dataset.progresso || '{}');
+        if (progresso.total) {
+            const progressoEl = document.createElement('span');
+            progressoEl.className = 'tarefas-progresso';
+            progressoEl.textContent = `${progresso.finalizadas}/${progresso.total} (${progresso.percentual}%)`;
+            container.appendChild(progressoEl);
+        }
+
         cell.appendChild(container);
         
         // Botão "+ Adicionar Tarefa" NÃO é adicionado aqui
@@ -439,11 +756,12 @@ document.addEventListener('DOMContentLoaded', () => {
      * Cuida do upload do .zip inicial.
      */
     async function handleUpload() {
-        const file = fileInput.files[0];
-        if (!file) return alert('Por favor, selecione um arquivo .zip.');
+        const files = Array.from(fileInput.files);
+        if (!files.length) return alert('Por favor, selecione um arquivo .zip.');
+        if (files.length > 1) return handleUploadLote(files);
 
         const formData = new FormData();
-        formData.append('file', file);
+        formData.append('file', files[0]);
 
         try {
             const response = await fetch('/api/upload', { method: 'POST', body: formData });
@@ -459,6 +777,31 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    // NOVO: Vários .zip de uma vez (um resultado por arquivo)
+    async function handleUploadLote(files) {
+        const formData = new FormData();
+        files.forEach(file => formData.append('files', file));
+
+        try {
+            const response = await fetch('/api/upload/lote', { method: 'POST', body: formData });
+            const result = await response.json();
+            if (!response.ok) throw new Error(result.error);
+
+            await loadWorkflow();
+            fileInput.value = '';
+
+            if (result.falhas) {
+                const erros = result.resultados
+                    .filter(r => r.erro)
+                    .map(r => `${r.arquivo}: ${r.erro}`);
+                alert(`${result.importados} importado(s), ${result.falhas} com erro:\n\n${erros.join('\n')}`);
+            }
+        } catch (error) {
+            console.error('Erro no upload:', error);
+            alert(`Erro no upload: ${error.message}`);
+        }
+    }
+
     /**
      * Cuida do upload de um arquivo manual em um orçamento existente.
      */
@@ -784,7 +1127,7 @@ document.addEventListener('DOMContentLoaded', () => {
         } catch (error) {
             console.error('Erro ao atualizar status:', error);
             alert(`Erro: ${error.message}`);
-            await loadWorkflow();
+            await loadWorkflow({ full: true });
         }
     }
 
@@ -819,7 +1162,7 @@ document.addEventListener('DOMContentLoaded', () => {
         } catch (error) {
             if (error.message === 'Cancelado pelo usuário') {
                 console.log('Operação cancelada.');
-                loadWorkflow();
+                loadWorkflow({ full: true });
             } else {
                 console.error('Erro no fluxo de atualização:', error);
             }
@@ -923,7 +1266,7 @@ document.addEventListener('DOMContentLoaded', () => {
                                 dados_adicionais = await openProducaoModal();
                             } catch (e) {
                                 console.log('Movimentação cancelada.');
-                                loadWorkflow();
+                                loadWorkflow({ full: true });
                                 return;
                             }
                         }
@@ -959,7 +1302,7 @@ document.addEventListener('DOMContentLoaded', () => {
         } catch (error) {
              console.error('Erro ao mover orçamento:', error);
              alert(`Erro ao mover: ${error.message}`);
-             loadWorkflow();
+             loadWorkflow({ full: true });
         }
     }
 
@@ -1018,11 +1361,41 @@ document.addEventListener('DOMContentLoaded', () => {
         if (e.target.classList.contains('btn-add-tarefa')) {
             openAddTarefaModal(e.target);
         }
+
+        if (e.target.classList.contains('btn-arquivados')) {
+            loadArquivados(e.target);
+        }
     });
 
     modalOverlay.addEventListener('click', () => {
         // Não fecha ao clicar no overlay
     });
 
-    loadWorkflow();
+    searchInput.addEventListener('input', () => {
+        clearTimeout(searchTimer);
+        const consulta = searchInput.value.trim();
+        if (!consulta) {
+            if (searchController) searchController.abort();
+            hideSearchResults();
+            return;
+        }
+        searchTimer = setTimeout(() => runSearch(consulta), 200);
+    });
+
+    searchInput.addEventListener('keydown', (e) => {
+        if (e.key === 'Escape') hideSearchResults();
+    });
+
+    searchResults.addEventListener('click', (e) => {
+        const item = e.target.closest('li[data-orcamento-id]');
+        if (!item) return;
+        hideSearchResults();
+        revealOrcamento(Number(item.dataset.orcamentoId));
+    });
+
+    document.addEventListener('click', (e) => {
+        if (!e.target.closest('.search-container')) hideSearchResults();
+    });
+
+    loadWorkflow().then(connectBoardStream);
 });
@@ -0,0 +1,35 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# O app lê a configuração na importação: banco e pastas vão para um diretório temporário
+PASTA_TESTES = tempfile.mkdtemp(prefix='workflow-testes-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(PASTA_TESTES, 'workflow.db')}"
+os.environ['RENDER_DISK_MOUNT_PATH'] = PASTA_TESTES
+os.environ['METRICS_DIR'] = os.path.join(PASTA_TESTES, 'metricas')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as workflow  # noqa: E402
+
+
+@pytest.fixture
+def app(monkeypatch):
+    """App com banco recém-criado (grupos do 'flask init-db') e sem as threads de fundo."""
+    monkeypatch.setattr(workflow.notification_dispatcher, 'ensure_started', lambda: None)
+    monkeypatch.setattr(workflow.preview_worker, 'ensure_started', lambda: None)
+    monkeypatch.setattr(workflow.metricas, 'ensure_started', lambda: None)
+    with workflow.app.app_context():
+        resultado = workflow.app.test_cli_runner().invoke(args=['init-db'])
+        assert resultado.exit_code == 0, resultado.output
+        # Snapshot de um banco anterior com o mesmo número de versão
+        workflow._board_snapshots.clear()
+        yield workflow.app
+        workflow.db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
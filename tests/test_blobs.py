@@ -0,0 +1,65 @@
+import io
+import os
+
+import pytest
+
+import app as workflow
+from app import ArquivoAnexado, Orcamento, db
+
+
+@pytest.fixture
+def orcamento(app):
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    grupo_id = workflow.grupos_cache.id('Entrada de Orçamento')
+    orcamento = Orcamento(numero='900', cliente='Cliente Blob', grupo_id=grupo_id)
+    db.session.add(orcamento)
+    db.session.commit()
+    return orcamento.id
+
+
+def add_file(client, orcamento_id, conteudo, nome='projeto.pdf'):
+    return client.post(f'/api/orcamento/{orcamento_id}/add_file',
+                       data={'file': (io.BytesIO(conteudo), nome)}, content_type='multipart/form-data')
+
+
+def test_add_file_stores_blob(client, orcamento):
+    resposta = add_file(client, orcamento, b'%PDF-1.4 armazenado')
+
+    assert resposta.status_code == 201
+    anexo = db.session.get(ArquivoAnexado, resposta.get_json()['id'])
+    assert os.path.isfile(workflow.blob_path(anexo.blob_sha256))
+
+
+def test_blob_move_failure_returns_500_and_check_blobs_repairs(app, client, orcamento, monkeypatch, tmp_path):
+    conteudo = b'%PDF-1.4 sem lugar no disco'
+
+    def replace_falha(origem, destino):
+        raise OSError(28, "No space left on device")
+
+    with monkeypatch.context() as m:
+        m.setattr(workflow.os, 'replace', replace_falha)
+        resposta = add_file(client, orcamento, conteudo)
+
+    # O anexo ficou no banco, mas o blob não: a rota não pode responder 201
+    assert resposta.status_code == 500
+    assert 'não foram salvos no disco' in resposta.get_json()['error']
+    anexo = ArquivoAnexado.query.filter_by(orcamento_id=orcamento).one()
+    assert not os.path.exists(workflow.blob_path(anexo.blob_sha256))
+    # O temporário não fica esquecido na pasta de upload
+    assert not [nome for nome in os.listdir(app.config['UPLOAD_FOLDER']) if nome.startswith('.upload-')]
+
+    runner = app.test_cli_runner()
+    resultado = runner.invoke(args=['check-blobs'])
+    assert resultado.exit_code == 1
+    assert f"Faltando {anexo.blob_sha256} (projeto.pdf)" in resultado.output
+
+    # Uma cópia com o mesmo nome e outro conteúdo não serve; a idêntica restaura
+    (tmp_path / 'outra').mkdir()
+    (tmp_path / 'outra' / 'projeto.pdf').write_bytes(b'%PDF-1.4 outro conteudo')
+    (tmp_path / 'copia').mkdir()
+    (tmp_path / 'copia' / 'projeto.pdf').write_bytes(conteudo)
+    resultado = runner.invoke(args=['check-blobs', '--pasta', str(tmp_path / 'outra'), '--pasta', str(tmp_path / 'copia')])
+    assert resultado.exit_code == 0, resultado.output
+    assert '1 restaurado(s)' in resultado.output
+    with open(workflow.blob_path(anexo.blob_sha256), 'rb') as f:
+        assert f.read() == conteudo
@@ -0,0 +1,71 @@
+from sqlalchemy import event
+
+import app as workflow
+from app import ArquivoAnexado, Orcamento, TarefaProducao, db, load_board
+
+
+def seed_board(quantidade, inicio=0):
+    """Orçamentos espalhados pelos grupos, cada um com duas tarefas e um anexo."""
+    grupos = [grupo.id for grupo in workflow.Grupo.query.order_by(workflow.Grupo.ordem)]
+    for indice in range(inicio, inicio + quantidade):
+        orcamento = Orcamento(numero=str(indice), cliente=f"Cliente {indice}", grupo_id=grupos[indice % len(grupos)])
+        db.session.add(orcamento)
+        db.session.flush()
+        db.session.add_all([
+            TarefaProducao(orcamento_id=orcamento.id, colaborador='Luiz', item_descricao='Giratório 2L 5E'),
+            TarefaProducao(orcamento_id=orcamento.id, colaborador='Hélio', item_descricao='Coifa Epoxi'),
+            ArquivoAnexado(orcamento_id=orcamento.id, nome_arquivo=f"projeto-{indice}.pdf"),
+        ])
+    db.session.commit()
+
+
+def count_queries(funcao):
+    consultas = []
+
+    def contar(conn, cursor, statement, parameters, context, executemany):
+        consultas.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', contar)
+    try:
+        funcao()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', contar)
+    return len(consultas)
+
+
+def test_load_board_query_count_does_not_grow_with_board(app):
+    workflow.grupos_cache.id('Entrada de Orçamento') # cache de grupos do worker: uma consulta, só na primeira vez
+    contagens = {}
+    total = 0
+    for tamanho in (5, 50, 200):
+        seed_board(tamanho - total, inicio=total)
+        total = tamanho
+        db.session.expire_all()
+        contagens[tamanho] = (
+            count_queries(lambda: load_board()),
+            count_queries(lambda: load_board(compacto=True)),
+        )
+
+    assert len(set(contagens.values())) == 1, contagens
+    completas, compactas = contagens[200]
+    assert completas <= 6 and compactas <= 6, contagens
+
+
+def test_load_board_returns_every_card_with_children(app):
+    seed_board(20)
+    quadro = load_board()
+    cartoes = [cartao for grupo in quadro for cartao in grupo["orcamentos"]]
+    assert len(cartoes) == 20
+    assert all(len(cartao["tarefas"]) == 2 and len(cartao["arquivos"]) == 1 for cartao in cartoes)
+
+
+def test_workflow_endpoint_query_count_is_constant(client):
+    seed_board(10)
+    # Inicialização do worker e cache de grupos (com o quadro vazio o cache nem é consultado)
+    client.get('/api/workflow')
+    workflow._board_snapshots.clear()
+    pequeno = count_queries(lambda: client.get('/api/workflow', headers={'Cache-Control': 'no-cache'}))
+    seed_board(90, inicio=10)
+    workflow._board_snapshots.clear()
+    grande = count_queries(lambda: client.get('/api/workflow', headers={'Cache-Control': 'no-cache'}))
+    assert pequeno == grande
@@ -0,0 +1,46 @@
+import os
+import subprocess
+import sys
+
+import pytest
+from sqlalchemy import create_engine, text
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def flask(ambiente, *args):
+    return subprocess.run(
+        [sys.executable, '-m', 'flask', '--app', 'app', *args],
+        cwd=RAIZ, env=ambiente, capture_output=True, text=True, timeout=120,
+    )
+
+
+def postgres_url():
+    """Banco Postgres descartável em TEST_POSTGRES_URL; o teste cria as tabelas nele."""
+    url = os.environ.get('TEST_POSTGRES_URL')
+    if not url:
+        pytest.skip("TEST_POSTGRES_URL não definida")
+    try:
+        engine = create_engine(url)
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+        engine.dispose()
+    except Exception as e:
+        pytest.skip(f"Postgres indisponível: {e}")
+    return url
+
+
+@pytest.mark.parametrize('banco', ['sqlite', 'postgresql'])
+def test_hot_paths_use_indexes(banco, tmp_path):
+    """'flask check-indexes' sai com 0: nenhum caminho quente varre uma tabela grande."""
+    url = f"sqlite:///{tmp_path / 'workflow.db'}" if banco == 'sqlite' else postgres_url()
+    # Processo próprio: o app escolhe o banco na importação
+    ambiente = dict(os.environ, DATABASE_URL=url, RENDER_DISK_MOUNT_PATH=str(tmp_path),
+                    METRICS_DIR=str(tmp_path / 'metricas'))
+
+    resultado = flask(ambiente, 'init-db')
+    assert resultado.returncode == 0, resultado.stdout + resultado.stderr
+
+    resultado = flask(ambiente, 'check-indexes')
+    assert resultado.returncode == 0, resultado.stdout + resultado.stderr
+    assert '[FALHA]' not in resultado.stdout
@@ -0,0 +1,216 @@
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import requests
+
+import app as workflow
+
+TELEFONE = "554100000010"
+OUTRO_TELEFONE = "554100000011"
+
+
+class CallMeBotFalso:
+    """Servidor HTTP local no lugar da CallMeBot: guarda as mensagens e responde com 'status'."""
+
+    def __init__(self):
+        self.recebidas = []
+        self.status = 200
+        falso = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parametros = parse_qs(urlparse(self.path).query)
+                falso.recebidas.append({chave: valores[0] for chave, valores in parametros.items()})
+                self.send_response(falso.status)
+                self.end_headers()
+                self.wfile.write(b"ok" if falso.status == 200 else b"erro")
+
+            def log_message(self, *args):
+                pass
+
+        self.servidor = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.servidor.server_port}/whatsapp.php"
+        self._thread = threading.Thread(target=self.servidor.serve_forever, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self.servidor.shutdown()
+        self.servidor.server_close()
+
+
+@pytest.fixture
+def callmebot(app, monkeypatch):
+    falso = CallMeBotFalso()
+    monkeypatch.setattr(workflow, 'API_URL', falso.url)
+    # Sessão HTTP que o ensure_started criaria
+    monkeypatch.setattr(workflow.notification_dispatcher, '_http', requests.Session())
+    yield falso
+    falso.close()
+
+
+def producao(*itens):
+    """Orçamento na Linha de Produção com uma tarefa por item. Devolve (orcamento_id, [tarefa_ids])."""
+    orcamento = workflow.Orcamento(numero='700', cliente='Cliente Digest',
+                                   grupo_id=workflow.grupos_cache.id('Linha de Produção'))
+    workflow.db.session.add(orcamento)
+    workflow.db.session.flush()
+    tarefas = [workflow.TarefaProducao(orcamento_id=orcamento.id, colaborador='Luiz', item_descricao=item) for item in itens]
+    workflow.db.session.add_all(tarefas)
+    workflow.db.session.commit()
+    return orcamento.id, [tarefa.id for tarefa in tarefas]
+
+
+def set_status(client, tarefa_id, status):
+    resposta = client.put(f'/api/tarefa/{tarefa_id}/status', json={"status": status})
+    assert resposta.status_code == 200, resposta.get_json()
+
+
+def enqueue(mensagem, telefone=TELEFONE):
+    workflow.send_whatsapp_notification(mensagem, [telefone])
+    workflow.db.session.commit()
+
+
+def notificacoes():
+    workflow.db.session.expire_all()
+    return workflow.Notificacao.query.order_by(workflow.Notificacao.id).all()
+
+
+def make_due(telefone=TELEFONE):
+    """Antecipa o backoff e o espaçamento do destinatário, como se o tempo tivesse passado."""
+    passado = datetime.utcnow() - timedelta(seconds=1)
+    workflow.db.session.execute(workflow.db.update(workflow.Notificacao).values(proxima_tentativa=passado))
+    workflow.db.session.execute(
+        workflow.db.update(workflow.NotificacaoDestinatario)
+        .where(workflow.NotificacaoDestinatario.telefone == telefone)
+        .values(proximo_envio=passado)
+    )
+    workflow.db.session.commit()
+
+
+def test_delivers_queued_message(callmebot):
+    enqueue("Olá 👋 & até logo")
+
+    assert workflow.notification_dispatcher.process_next() is True
+    assert workflow.notification_dispatcher.process_next() is False
+
+    assert callmebot.recebidas == [{"phone": TELEFONE, "text": "Olá 👋 & até logo", "apikey": workflow.API_KEY}]
+    [notificacao] = notificacoes()
+    assert notificacao.status == 'enviada'
+    assert notificacao.tentativas == 1
+    assert notificacao.enviado_em is not None
+    assert notificacao.ultimo_erro is None
+
+
+def test_failed_send_backs_off_and_retries(callmebot, monkeypatch):
+    monkeypatch.setattr(workflow, 'NOTIFY_BACKOFF_BASE', 30)
+    callmebot.status = 500
+    enqueue("Instalação agendada")
+
+    # 1ª falha: espera a base; 2ª falha: o dobro
+    for tentativa, espera in ((1, 30), (2, 60)):
+        antes = datetime.utcnow()
+        assert workflow.notification_dispatcher.process_next() is True
+        [notificacao] = notificacoes()
+        assert notificacao.status == 'pendente'
+        assert notificacao.tentativas == tentativa
+        assert '500' in notificacao.ultimo_erro
+        assert notificacao.proxima_tentativa >= antes + timedelta(seconds=espera)
+        assert notificacao.proxima_tentativa <= datetime.utcnow() + timedelta(seconds=espera)
+        # Nada sai antes do fim do backoff
+        assert workflow.notification_dispatcher.process_next() is False
+        make_due()
+
+    callmebot.status = 200
+    assert workflow.notification_dispatcher.process_next() is True
+
+    [notificacao] = notificacoes()
+    assert notificacao.status == 'enviada'
+    assert notificacao.tentativas == 3
+    assert len(callmebot.recebidas) == 3
+
+
+def test_messages_to_same_phone_are_spaced(callmebot, monkeypatch):
+    monkeypatch.setattr(workflow, 'NOTIFY_INTERVALO_POR_TELEFONE', 10)
+    enqueue("primeira")
+    enqueue("segunda")
+    enqueue("outro destinatário", OUTRO_TELEFONE)
+
+    assert workflow.notification_dispatcher.process_next() is True
+    # A segunda mensagem para o mesmo número espera; a do outro número não
+    assert workflow.notification_dispatcher.process_next() is True
+    assert workflow.notification_dispatcher.process_next() is False
+    assert [r["text"] for r in callmebot.recebidas] == ["primeira", "outro destinatário"]
+
+    reserva = workflow.db.session.get(workflow.NotificacaoDestinatario, TELEFONE)
+    assert reserva.proximo_envio > datetime.utcnow() + timedelta(seconds=5)
+
+    make_due()
+    assert workflow.notification_dispatcher.process_next() is True
+    assert [r["text"] for r in callmebot.recebidas] == ["primeira", "outro destinatário", "segunda"]
+    assert [n.status for n in notificacoes()] == ['enviada', 'enviada', 'enviada']
+
+
+def test_gives_up_after_max_attempts(callmebot, monkeypatch):
+    monkeypatch.setattr(workflow, 'NOTIFY_MAX_TENTATIVAS', 3)
+    monkeypatch.setattr(workflow, 'NOTIFY_BACKOFF_BASE', 0)
+    monkeypatch.setattr(workflow, 'NOTIFY_INTERVALO_POR_TELEFONE', 0)
+    callmebot.status = 500
+    enqueue("nunca chega")
+
+    for _ in range(3):
+        assert workflow.notification_dispatcher.process_next() is True
+    # Dead-letter: não volta mais para a fila
+    assert workflow.notification_dispatcher.process_next() is False
+
+    [notificacao] = notificacoes()
+    assert notificacao.status == 'falhou'
+    assert notificacao.tentativas == 3
+    assert '500' in notificacao.ultimo_erro
+    assert len(callmebot.recebidas) == 3
+
+
+def test_task_updates_in_window_merge_into_one_message(client):
+    _, (giratorio, moldura) = producao('Giratório 2L 5E', 'Moldura Área de fogo')
+
+    set_status(client, giratorio, 'Iniciou a Produção')
+    set_status(client, moldura, 'Iniciou a Produção')
+
+    # Um digest por destinatário, com os dois itens
+    pendentes = notificacoes()
+    assert sorted(n.telefone for n in pendentes) == sorted(workflow.LISTA_GERAL)
+    for notificacao in pendentes:
+        assert notificacao.status == 'pendente'
+        assert notificacao.proxima_tentativa > datetime.utcnow()
+        assert 'Giratório 2L 5E, Moldura Área de fogo (2 itens)' in notificacao.mensagem
+
+
+def test_merge_keeps_move_to_prontos_notice(client):
+    orcamento_id, (giratorio, moldura) = producao('Giratório 2L 5E', 'Moldura Área de fogo')
+
+    set_status(client, giratorio, 'Produção Finalizada')
+    set_status(client, moldura, 'Produção Finalizada') # última finalizada: vai para Prontos
+    # Voltar uma tarefa dentro da janela não tira o orçamento de Prontos
+    set_status(client, moldura, 'Fase de Acabamento')
+
+    orcamento = workflow.db.session.get(workflow.Orcamento, orcamento_id)
+    assert orcamento.grupo_id == workflow.grupos_cache.id('Prontos')
+    for notificacao in notificacoes():
+        assert 'Itens finalizados: Giratório 2L 5E' in notificacao.mensagem
+        assert 'Itens em fase de acabamento: Moldura Área de fogo' in notificacao.mensagem
+        assert workflow.TAREFA_NOTIFICATION_PRONTOS in notificacao.mensagem
+
+
+def test_prontos_notice_survives_when_no_task_is_finished_anymore(client):
+    orcamento_id, (giratorio,) = producao('Giratório 2L 5E')
+
+    set_status(client, giratorio, 'Produção Finalizada')
+    set_status(client, giratorio, 'Fase de Acabamento')
+
+    orcamento = workflow.db.session.get(workflow.Orcamento, orcamento_id)
+    assert orcamento.grupo_id == workflow.grupos_cache.id('Prontos')
+    for notificacao in notificacoes():
+        assert 'Produção Concluída' not in notificacao.mensagem
+        assert notificacao.mensagem.endswith(workflow.TAREFA_NOTIFICATION_PRONTOS)
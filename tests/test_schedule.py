@@ -0,0 +1,31 @@
+from datetime import date
+
+import pytest
+
+from app import dias_uteis_entre, risco_prazo
+
+SEXTA = date(2026, 10, 16)
+SEGUNDA = date(2026, 10, 19)
+
+
+@pytest.mark.parametrize('inicio, fim, esperado', [
+    (SEXTA, SEXTA, 0),
+    (SEXTA, date(2026, 10, 17), 0), # sábado não conta
+    (SEXTA, SEGUNDA, 1),
+    (SEXTA, date(2026, 10, 30), 10),
+    (SEGUNDA, SEXTA, -1),
+    (SEGUNDA, date(2026, 10, 17), -1),
+])
+def test_dias_uteis_entre(inicio, fim, esperado):
+    assert dias_uteis_entre(inicio, fim) == esperado
+
+
+@pytest.mark.parametrize('conclusao, limite, esperado', [
+    # Conclusão na sexta com prazo na segunda: o fim de semana não é folga
+    (SEXTA, SEGUNDA, ('atencao', 1)),
+    (SEXTA, date(2026, 10, 21), ('ok', 3)),
+    (SEGUNDA, date(2026, 10, 18), ('atrasado', -1)),
+    (SEXTA, None, ('sem_prazo', None)),
+])
+def test_risco_prazo_counts_business_days(conclusao, limite, esperado):
+    assert risco_prazo(conclusao, limite) == esperado
@@ -0,0 +1,53 @@
+import pytest
+
+import app as workflow
+
+
+@pytest.fixture
+def startup(app, monkeypatch):
+    """WorkerStartup nova no lugar da do módulo, com o esquema 'desatualizado' até o teste liberar."""
+    startup = workflow.WorkerStartup()
+    startup.tentativas = 0
+    startup.esquema_ok = False
+
+    def verificar_esquema():
+        startup.tentativas += 1
+        if not startup.esquema_ok:
+            raise RuntimeError("Banco na versão de esquema 0: execute 'flask migrate'")
+        startup.esquema = workflow.SCHEMA_VERSION
+
+    monkeypatch.setattr(startup, '_verificar_esquema', verificar_esquema)
+    monkeypatch.setattr(startup, '_iniciar_threads', lambda: None)
+    monkeypatch.setattr(workflow, 'worker_startup', startup)
+    return startup
+
+
+def test_requests_get_503_until_worker_is_ready(client, startup):
+    resposta = client.get('/api/workflow')
+    assert resposta.status_code == 503
+    assert resposta.headers['Retry-After'] == str(workflow.STARTUP_NOVA_TENTATIVA)
+    assert startup.tentativas == 1
+
+    # O /healthz segue respondendo, com o erro da inicialização
+    resposta = client.get('/healthz')
+    assert resposta.status_code == 503
+    assert 'flask migrate' in resposta.get_json()['erro']
+    # Dentro do intervalo ninguém tenta de novo
+    assert startup.tentativas == 1
+
+    startup.esquema_ok = True
+    startup._ultima_tentativa -= workflow.STARTUP_NOVA_TENTATIVA
+    assert client.get('/api/workflow').status_code == 200
+    assert client.get('/healthz').status_code == 200
+    assert startup.tentativas == 2
+
+
+def test_waiting_request_does_not_retry_right_after_another(startup):
+    # Simula quem passou pela checagem do intervalo e esperou o lock enquanto outra requisição tentava
+    assert startup.run(intervalo=workflow.STARTUP_NOVA_TENTATIVA) is False
+    assert startup.run(intervalo=workflow.STARTUP_NOVA_TENTATIVA) is False
+    assert startup.tentativas == 1
+    # Sem intervalo (gunicorn post_fork, python app.py) sempre tenta
+    startup.esquema_ok = True
+    assert startup.run() is True
+    assert startup.tentativas == 2
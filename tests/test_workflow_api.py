@@ -0,0 +1,46 @@
+import gzip
+import json
+
+from test_board_queries import seed_board
+
+import app as workflow
+
+GZIP = {'Accept-Encoding': 'gzip'}
+IDENTIDADE = {'Accept-Encoding': 'identity'}
+
+
+def test_each_content_coding_has_its_own_etag(client):
+    seed_board(30)
+
+    simples = client.get('/api/workflow', headers=IDENTIDADE)
+    comprimida = client.get('/api/workflow', headers=GZIP)
+
+    assert 'Content-Encoding' not in simples.headers
+    assert comprimida.headers['Content-Encoding'] == 'gzip'
+    versao = simples.headers['X-Board-Version']
+    assert simples.headers['ETag'] == f'"board-v{versao}"'
+    assert comprimida.headers['ETag'] == f'"board-v{versao}-gzip"'
+    assert json.loads(gzip.decompress(comprimida.data)) == simples.get_json()
+
+
+def test_not_modified_only_for_the_negotiated_coding(client):
+    seed_board(30)
+    etag_simples = client.get('/api/workflow', headers=IDENTIDADE).headers['ETag']
+    etag_gzip = client.get('/api/workflow', headers=GZIP).headers['ETag']
+
+    assert client.get('/api/workflow', headers={**GZIP, 'If-None-Match': etag_gzip}).status_code == 304
+    assert client.get('/api/workflow', headers={**IDENTIDADE, 'If-None-Match': etag_simples}).status_code == 304
+
+    # A tag de outra codificação não vale: o corpo vai inteiro, na codificação pedida
+    resposta = client.get('/api/workflow', headers={**IDENTIDADE, 'If-None-Match': etag_gzip})
+    assert resposta.status_code == 200
+    assert 'Content-Encoding' not in resposta.headers
+    resposta = client.get('/api/workflow', headers={**GZIP, 'If-None-Match': etag_simples})
+    assert resposta.status_code == 200
+    assert resposta.headers['Content-Encoding'] == 'gzip'
+
+
+def test_compact_format_etag_includes_coding(client):
+    seed_board(30)
+    resposta = client.get('/api/workflow?formato=compacto', headers=GZIP)
+    assert resposta.headers['ETag'] == f'"board-v{workflow.get_board_version()}-compacto-gzip"'